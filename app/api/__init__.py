@@ -4,5 +4,7 @@
 from .routes import routes_bp
 from .uploads import uploads_bp
 from .processing import processing_bp
+from .jobs import jobs_bp
+from .grading import grading_bp
 
 # No cambiamos nada aquí, solo usamos los mismos nombres de tus blueprints
@@ -0,0 +1,89 @@
+import json
+import time
+import logging
+from flask import Blueprint, request, jsonify
+from app.session import get_session
+from app.core.grading import QuestionLayout, AnswerKey, SheetMarks, grade, session_marks
+
+logger = logging.getLogger(__name__)
+
+grading_bp = Blueprint('grading', __name__)
+
+@grading_bp.route('/api/grade', methods=['POST'])
+def grade_sheets():
+    """
+    Puntuar con una clave de respuestas las hojas ya reconocidas
+
+    Las marcas se toman de los resultados guardados en las sesiones (las
+    páginas de un lote, o la propia sesión), o de 'results' si se envían
+    directamente; no se vuelve a leer ninguna imagen.
+    """
+    try:
+        session_id = request.form.get('session_id')
+        key_json = request.form.get('answer_key')
+
+        if not session_id:
+            return jsonify({"success": False, "error": "ID de sesión no proporcionado"}), 400
+
+        if not key_json:
+            return jsonify({"success": False, "error": "No se proporcionó la clave de respuestas"}), 400
+
+        session = get_session(session_id)
+        if not session:
+            return jsonify({"success": False, "error": "Sesión no válida"}), 400
+
+        try:
+            key_data = json.loads(key_json)
+        except json.JSONDecodeError as e:
+            return jsonify({"success": False, "error": f"Clave de respuestas no válida: {e}"}), 400
+
+        start = time.perf_counter()
+        results_json = request.form.get('results')
+        if results_json:
+            # Resultados enviados por el cliente: una lista con {campo: marcado} por hoja
+            try:
+                results = json.loads(results_json)
+            except json.JSONDecodeError as e:
+                return jsonify({"success": False, "error": f"Resultados no válidos: {e}"}), 400
+            if not isinstance(results, list) or not all(isinstance(r, dict) for r in results):
+                return jsonify({"success": False, "error": "'results' debe ser una lista de objetos"}), 400
+            sheet_marks = SheetMarks.from_results(QuestionLayout.for_session(session), results)
+        else:
+            refresh = request.form.get('refresh', 'false').lower() == 'true'
+            sheet_marks = session_marks(session, refresh=refresh)
+        build_time = time.perf_counter() - start
+
+        layout = sheet_marks.layout
+        if not layout.questions:
+            return jsonify({"success": False, "error": "La plantilla no tiene preguntas"}), 400
+        if not sheet_marks.sheets:
+            return jsonify({"success": False, "error": "No hay hojas con resultados de marcas"}), 400
+
+        try:
+            key = AnswerKey.parse(key_data, layout)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+
+        start = time.perf_counter()
+        result = grade(sheet_marks.marks, key)
+        grade_time = time.perf_counter() - start
+        logger.info(f"{len(sheet_marks.sheets)} hojas puntuadas en {grade_time * 1000:.1f} ms")
+
+        return jsonify({
+            "success": True,
+            "max_score": result.max_score,
+            "scale": key.scale,
+            "questions": layout.questions,
+            "ungraded": [q for q, active in zip(layout.questions, key.active.tolist()) if not active],
+            "students": result.students(sheet_marks.sheets, layout.questions),
+            "question_stats": result.question_stats(layout, key.active),
+            "missing": sheet_marks.missing,
+            "timing": {
+                "build_ms": round(build_time * 1000, 2),
+                "grade_ms": round(grade_time * 1000, 2)
+            }
+        })
+
+    except Exception as e:
+        logger.error(f"Error al puntuar las hojas: {e}", exc_info=True)
+        return jsonify({"success": False, "error": str(e)}), 500
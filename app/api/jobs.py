@@ -0,0 +1,149 @@
+import json
+import logging
+from flask import Blueprint, Response, request, jsonify
+from app.config import settings
+from app.core.utils.page_cache import get_page, page_exists
+from app.session import get_session, save_session, save_results
+from app.core.jobs import submit_job, get_job, JobStoreFull
+from app.core.template_cache import get_session_template
+from app.core.pipeline import plan_fields, processed_fields, session_rois, recognize_page
+
+logger = logging.getLogger(__name__)
+
+jobs_bp = Blueprint('jobs', __name__)
+
+def format_sse(event, data, event_id=None):
+    """Formatear un mensaje de Server-Sent Events"""
+    message = f"event: {event}\n"
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    return message + f"data: {json.dumps(data)}\n\n"
+
+def run_recognition_job(job, session, fields, preprocess_mode=None, scorer=None):
+    """Ejecutar el reconocimiento de marcas y texto de una sesión (en el pool de trabajos)"""
+    # Las etapas que ejecutará `recognize_page`: con el DNI en la rejilla, la
+    # de texto se ejecuta aunque no quede ningún otro campo de texto
+    template = get_session_template(session)
+    text_fields, mark_fields, dni_grid = plan_fields(fields, template)
+    stages = [stage for stage, needed in (('marks', mark_fields), ('text', text_fields or dni_grid is not None)) if needed]
+    job.set_progress(stage=stages[0] if stages else None, completed=0, total=len(stages))
+
+    image = get_page(session.image_path)
+    if image is None:
+        raise ValueError("Error al leer la imagen")
+
+    def on_stage(stage, stage_results):
+        job.emit(stage, {"results": stage_results})
+        if stage not in stages:
+            logger.warning(f"Etapa no prevista en el trabajo {job.id}: {stage}")
+            return
+        completed = stages.index(stage) + 1
+        next_stage = stages[completed] if completed < len(stages) else stage
+        job.set_progress(stage=next_stage, completed=completed)
+
+    results = recognize_page(session, image, fields, preprocess_mode, scorer, on_stage=on_stage)
+    save_results(session, results)
+
+    return {
+        "results": results,
+        "fields_processed": processed_fields(fields, template)
+    }
+
+@jobs_bp.route('/api/jobs', methods=['POST'])
+def create_job():
+    """Crear un trabajo de reconocimiento y devolver su ID sin esperar al resultado"""
+    try:
+        session_id = request.form.get('session_id')
+        fields_json = request.form.get('fields')
+
+        if not session_id:
+            return jsonify({"success": False, "error": "ID de sesión no proporcionado"}), 400
+
+        if not fields_json:
+            return jsonify({"success": False, "error": "No se especificaron campos"}), 400
+
+        # Convertir el string JSON de campos a lista
+        try:
+            fields_list = json.loads(fields_json)
+            if not isinstance(fields_list, list):
+                fields_list = [fields_list]
+        except json.JSONDecodeError:
+            fields_list = [fields_json]
+
+        # Validar sesión
+        session = get_session(session_id)
+        if not session:
+            return jsonify({"success": False, "error": "Sesión no válida"}), 400
+
+        required_steps = ['json_upload', 'pdf_upload']
+        if not all(step in session.completed_steps for step in required_steps):
+            return jsonify({"success": False, "error": "Debe completar los pasos anteriores"}), 400
+
+        if not session.image_path or not page_exists(session.image_path):
+            return jsonify({"success": False, "error": "Imagen no encontrada"}), 400
+
+        # Las ROIs solo dependen del JSON de zonas; la imagen superpuesta no es necesaria
+        if not session.rois:
+            session.rois = session_rois(session)
+            save_session(session)
+
+        try:
+            job = submit_job(
+                'recognize', run_recognition_job, session, fields_list,
+                preprocess_mode=request.form.get('preprocess'),
+                scorer=request.form.get('scorer'),
+                session_id=session.id
+            )
+        except JobStoreFull as e:
+            return jsonify({"success": False, "error": str(e)}), 503
+
+        return jsonify({
+            "success": True,
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": f"/api/jobs/{job.id}",
+            "events_url": f"/api/jobs/{job.id}/events"
+        }), 202
+
+    except Exception as e:
+        logger.error(f"Error al crear el trabajo: {e}", exc_info=True)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@jobs_bp.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Consultar el estado, el progreso y los resultados de un trabajo"""
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "Trabajo no encontrado"}), 404
+
+    return jsonify({"success": True, **job.to_dict()})
+
+@jobs_bp.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """
+    Seguir un trabajo con Server-Sent Events
+
+    Emite 'marks' y 'text' al terminar cada etapa del reconocimiento, 'page'
+    por cada página de un lote y 'done' con el estado final (sin resultados).
+    Al reconectar, el navegador envía Last-Event-ID y se reanuda desde el
+    siguiente evento.
+    """
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "Trabajo no encontrado"}), 404
+
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    start = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+
+    def stream():
+        for index, event, data in job.iter_events(start, timeout=settings.SSE_KEEPALIVE):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield format_sse(event, data, index)
+        yield format_sse('done', job.to_dict(include_results=False))
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
\ No newline at end of file
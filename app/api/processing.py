@@ -7,9 +7,15 @@ from flask import Blueprint, request, jsonify, current_app
 from werkzeug.exceptions import BadRequest
 from app.config import settings
 from app.core.utils.image_utils import overlay_zones_on_image
-from app.session import get_session
-from app.core.processors.handwriting import HandwritingProcessor
-from app.core.processors.mark import MarkProcessor
+from app.core.utils.metrics import span
+from app.core.utils.page_cache import get_page, page_exists
+from app.core.utils.async_utils import DeadlineExceeded
+from app.core.template_cache import get_session_template
+from app.session import get_session, save_session, save_results
+from app.core.pipeline import (
+    is_text_field, is_mark_field, processed_fields, session_rois,
+    collect_rois, run_marks, run_text, recognize_page
+)
 
 # Configurar logger
 logger = logging.getLogger(__name__)
@@ -17,20 +23,15 @@ logger = logging.getLogger(__name__)
 # Crear blueprint con el mismo nombre que usas en tus otros archivos
 processing_bp = Blueprint('processing', __name__)
 
-def is_text_field(field_name):
-    """Determina si un campo es de texto basado en su nombre"""
-    return field_name == "DNI" or len(field_name) >= 4
-
-def is_mark_field(field_name):
-    """Determina si un campo es de marca basado en su nombre"""
-    if not field_name:
-        return False
-    # Reglas para identificar campos de marca (R1A, R2B, etc.)
-    if field_name.startswith(('R', 'M')) and len(field_name) <= 3:
-        return True
-    elif len(field_name) < 4 and field_name != "DNI":
-        return True
-    return False
+def encode_roi_images(roi_fields, rois):
+    """Convertir ROIs a imágenes PNG en base64 para el frontend"""
+    roi_images = {}
+    with span('roi_encode'):
+        for field, roi in zip(roi_fields, rois):
+            _, buffer = cv2.imencode('.png', roi)
+            roi_base64 = base64.b64encode(buffer).decode('utf-8')
+            roi_images[field] = f"data:image/png;base64,{roi_base64}"
+    return roi_images
 
 @processing_bp.route('/api/overlay-zones', methods=['POST'])
 def overlay_zones():
@@ -62,49 +63,23 @@ def overlay_zones():
         result_path = os.path.join(settings.RESULTS_FOLDER, result_filename)
 
         # Generar imagen con zonas superpuestas
-        result_path = overlay_zones_on_image(
-            image_path,
-            zones_info,
-            opacity=opacity,
-            draw_labels=draw_labels,
-            output_path=result_path
-        )
+        with span('overlay'):
+            result_path = overlay_zones_on_image(
+                image_path,
+                zones_info,
+                opacity=opacity,
+                draw_labels=draw_labels,
+                output_path=result_path
+            )
 
         # Guardar las ROIs en la sesión
-        rois = {}
-        
-        # Función para extraer zonas recursivamente
-        def extract_zones(data, prefix=""):
-            if isinstance(data, dict):
-                if 'name' in data and all(k in data for k in ['left', 'top', 'width', 'height']):
-                    field_name = data['name']
-                    x = int(data.get('left', 0))
-                    y = int(data.get('top', 0))
-                    w = int(data.get('width', 0))
-                    h = int(data.get('height', 0))
-                    
-                    if x >= 0 and y >= 0 and w > 0 and h > 0:
-                        rois[field_name] = [x, y, w, h]
-                else:
-                    for key, value in data.items():
-                        new_prefix = f"{prefix}.{key}" if prefix else key
-                        extract_zones(value, new_prefix)
-            elif isinstance(data, list):
-                for i, item in enumerate(data):
-                    new_prefix = f"{prefix}[{i}]"
-                    extract_zones(item, new_prefix)
-        
-        # Procesar zonas según su formato
-        if isinstance(zones_info, list):
-            for zone in zones_info:
-                extract_zones(zone)
-        else:
-            extract_zones(zones_info)
+        rois = session_rois(session)
         
         # Guardar la ruta y las ROIs en la sesión
         session.overlay_path = result_path
         session.rois = rois
         session.add_completed_step('overlay')
+        save_session(session)
 
         # Construir la URL para acceder a la imagen
         # La URL debe ser relativa a /static
@@ -204,6 +179,8 @@ def recognize_text():
             overlay_result = overlay_zones()
             if isinstance(overlay_result, tuple) and overlay_result[1] != 200:
                 return overlay_result
+            # Releer la sesión con las ROIs guardadas por el overlay
+            session = get_session(session_id)
 
         # Verificar que hay ROIs definidas
         if not hasattr(session, 'rois') or not session.rois:
@@ -213,10 +190,10 @@ def recognize_text():
         
         # Leer imagen para extraer ROIs
         image_path = session.image_path
-        if not os.path.exists(image_path):
+        if not page_exists(image_path):
             return jsonify({"success": False, "error": "Imagen no encontrada"}), 400
 
-        image = cv2.imread(image_path)
+        image = get_page(image_path)
         if image is None:
             return jsonify({"success": False, "error": "Error al leer la imagen"}), 400
 
@@ -230,33 +207,14 @@ def recognize_text():
             return jsonify({"success": False, "error": "No se seleccionaron campos de texto válidos"}), 400
         
         # Obtener ROIs para los campos de texto
-        rois = []
-        roi_fields = []
-        roi_images = {}  # Diccionario para almacenar las imágenes en base64
-        
-        for field in text_fields:
-            if field in session.rois:
-                roi_coords = session.rois[field]
-                x, y, w, h = map(int, roi_coords)
-                roi = image[y:y+h, x:x+w]
-                if roi is not None and roi.size > 0:
-                    rois.append(roi)
-                    roi_fields.append(field)
-                    # Convertir ROI a base64
-                    _, buffer = cv2.imencode('.png', roi)
-                    roi_base64 = base64.b64encode(buffer).decode('utf-8')
-                    roi_images[field] = f"data:image/png;base64,{roi_base64}"
-                else:
-                    logger.warning(f"ROI inválida para el campo {field}")
-            else:
-                logger.warning(f"Campo {field} no encontrado en las ROIs disponibles")
+        rois, roi_fields, _ = collect_rois(session, image, text_fields)
+        roi_images = encode_roi_images(roi_fields, rois)  # Imágenes en base64
 
         if not rois:
             return jsonify({"success": False, "error": "No se encontraron ROIs válidas para los campos seleccionados"}), 400
 
         # Procesar texto con Claude
-        processor = HandwritingProcessor()
-        results = processor.process_batch(rois, roi_fields, session.id)
+        results = run_text(session, rois, roi_fields)
 
         # Agregar las imágenes al resultado
         response_data = {
@@ -272,6 +230,9 @@ def recognize_text():
 
         return jsonify(response_data)
 
+    except DeadlineExceeded as e:
+        logger.warning(f"Plazo agotado en reconocimiento de texto: {e}")
+        return jsonify({"success": False, "error": str(e)}), 504
     except Exception as e:
         logger.error(f"Error en reconocimiento de texto: {e}", exc_info=True)
         return jsonify({"success": False, "error": str(e)}), 500
@@ -319,6 +280,8 @@ def recognize_marks():
             overlay_result = overlay_zones()
             if isinstance(overlay_result, tuple) and overlay_result[1] != 200:
                 return overlay_result
+            # Releer la sesión con las ROIs guardadas por el overlay
+            session = get_session(session_id)
 
         # Verificar que hay ROIs definidas
         if not hasattr(session, 'rois') or not session.rois:
@@ -328,10 +291,10 @@ def recognize_marks():
         
         # Leer imagen para extraer ROIs
         image_path = session.image_path
-        if not os.path.exists(image_path):
+        if not page_exists(image_path):
             return jsonify({"success": False, "error": "Imagen no encontrada"}), 400
 
-        image = cv2.imread(image_path)
+        image = get_page(image_path)
         if image is None:
             return jsonify({"success": False, "error": "Error al leer la imagen"}), 400
 
@@ -345,57 +308,18 @@ def recognize_marks():
             return jsonify({"success": False, "error": "No se seleccionaron campos de marca válidos"}), 400
         
         # Obtener ROIs para los campos de marca
-        rois = []
-        roi_fields = []
-        roi_images = {}  # Diccionario para almacenar las imágenes en base64
-        
-        for field in mark_fields:
-            if field in session.rois:
-                roi_coords = session.rois[field]
-                x, y, w, h = map(int, roi_coords)
-                roi = image[y:y+h, x:x+w]
-                if roi is not None and roi.size > 0:
-                    rois.append(roi)
-                    roi_fields.append(field)
-                    # Convertir ROI a base64
-                    _, buffer = cv2.imencode('.png', roi)
-                    roi_base64 = base64.b64encode(buffer).decode('utf-8')
-                    roi_images[field] = f"data:image/png;base64,{roi_base64}"
-                else:
-                    logger.warning(f"ROI inválida para el campo {field}")
-            else:
-                logger.warning(f"Campo {field} no encontrado en las ROIs disponibles")
+        rois, roi_fields, rects = collect_rois(session, image, mark_fields)
+        roi_images = encode_roi_images(roi_fields, rois)  # Imágenes en base64
 
         if not rois:
             return jsonify({"success": False, "error": "No se encontraron ROIs válidas para los campos seleccionados"}), 400
 
-        # Preparar directorio para debug
-        debug_dir = os.path.join(settings.RESULTS_FOLDER, f"debug_{session_id}")
-        os.makedirs(debug_dir, exist_ok=True)
-        
-        # Configurar procesador de marcas
-        processor = MarkProcessor()
-        processor.set_mark_fields(set(roi_fields))
-        processor.set_debug_folder(debug_dir)
-        
-        # Detectar automáticamente el tipo de marca según sus dimensiones
-        mark_types = {}
-        for field, roi in zip(roi_fields, rois):
-            h, w = roi.shape[:2]
-            aspect_ratio = w / h if h > 0 else 1
-            
-            if 0.8 <= aspect_ratio <= 1.2:  # Es casi cuadrado
-                if max(w, h) < 30:  # Es pequeño
-                    mark_types[field] = 'circle'
-                else:
-                    mark_types[field] = 'square'
-            else:
-                mark_types[field] = 'square'
-                
-        processor.set_mark_types(mark_types)
-        
         # Procesar ROIs de marcas
-        results_dict, details = processor.process_batch(rois, roi_fields)
+        results_dict, details = run_marks(
+            session, image, rois, roi_fields, rects,
+            preprocess_mode=request.form.get('preprocess'),
+            scorer=request.form.get('scorer')
+        )
         
         # Formatear resultados para el frontend
         formatted_results = {}
@@ -410,6 +334,12 @@ def recognize_marks():
                 'confidence': percentage / 100.0,
                 'metadata': detail.get('metadata', {})
             }
+
+        # Guardar las marcas en la sesión para la corrección (ver app.core.grading)
+        save_results(session, {
+            field: {'type': 'mark', **{key: value for key, value in result.items() if key != 'metadata'}}
+            for field, result in formatted_results.items()
+        })
         
         # Agregar las imágenes al resultado
         response_data = {
@@ -425,6 +355,9 @@ def recognize_marks():
 
         return jsonify(response_data)
 
+    except DeadlineExceeded as e:
+        logger.warning(f"Plazo agotado en reconocimiento de marcas: {e}")
+        return jsonify({"success": False, "error": str(e)}), 504
     except Exception as e:
         logger.error(f"Error en reconocimiento de marcas: {e}", exc_info=True)
         return jsonify({"success": False, "error": str(e)}), 500
@@ -456,19 +389,6 @@ def recognize_all():
             
         logger.info(f"Campos recibidos para reconocimiento completo: {fields_list}")
         
-        # Separar campos en marcas y texto
-        text_fields = []
-        mark_fields = []
-        
-        for field in fields_list:
-            if is_mark_field(field):
-                mark_fields.append(field)
-            else:
-                text_fields.append(field)
-                
-        # Resultados combinados
-        combined_results = {}
-        
         # Validar sesión
         session = get_session(session_id)
         if not session:
@@ -484,6 +404,8 @@ def recognize_all():
             overlay_result = overlay_zones()
             if isinstance(overlay_result, tuple) and overlay_result[1] != 200:
                 return overlay_result
+            # Releer la sesión con las ROIs guardadas por el overlay
+            session = get_session(session_id)
                 
         # Verificar que hay ROIs definidas
         if not hasattr(session, 'rois') or not session.rois:
@@ -493,128 +415,26 @@ def recognize_all():
         
         # Leer imagen para extraer ROIs
         image_path = session.image_path
-        if not os.path.exists(image_path):
+        if not page_exists(image_path):
             return jsonify({"success": False, "error": "Imagen no encontrada"}), 400
             
-        image = cv2.imread(image_path)
+        image = get_page(image_path)
         if image is None:
             return jsonify({"success": False, "error": "Error al leer la imagen"}), 400
             
-        # Procesar marcas si hay campos de ese tipo
-        if mark_fields:
-            logger.info(f"Procesando {len(mark_fields)} campos de marca: {mark_fields[:5]}...")
-            
-            # Obtener ROIs para los campos de marca
-            mark_rois = []
-            mark_roi_fields = []
-            
-            for field in mark_fields:
-                if field in session.rois:
-                    roi_coords = session.rois[field]
-                    x, y, w, h = map(int, roi_coords)
-                    roi = image[y:y+h, x:x+w]
-                    if roi is not None and roi.size > 0:
-                        mark_rois.append(roi)
-                        mark_roi_fields.append(field)
-                    else:
-                        logger.warning(f"ROI inválida para el campo de marca {field}")
-                else:
-                    logger.warning(f"Campo de marca {field} no encontrado en las ROIs disponibles")
-                    
-            if mark_rois:
-                try:
-                    # Preparar directorio para debug
-                    debug_dir = os.path.join(settings.RESULTS_FOLDER, f"debug_{session_id}")
-                    os.makedirs(debug_dir, exist_ok=True)
-                    
-                    # Configurar procesador de marcas
-                    processor = MarkProcessor()
-                    processor.set_mark_fields(set(mark_roi_fields))
-                    processor.set_debug_folder(debug_dir)
-                    
-                    # Detectar automáticamente el tipo de marca según sus dimensiones
-                    mark_types = {}
-                    for field, roi in zip(mark_roi_fields, mark_rois):
-                        h, w = roi.shape[:2]
-                        aspect_ratio = w / h if h > 0 else 1
-                        
-                        if 0.8 <= aspect_ratio <= 1.2:  # Es casi cuadrado
-                            if max(w, h) < 30:  # Es pequeño
-                                mark_types[field] = 'circle'
-                            else:
-                                mark_types[field] = 'square'
-                        else:
-                            mark_types[field] = 'square'
-                            
-                    processor.set_mark_types(mark_types)
-                    
-                    # Procesar ROIs de marcas
-                    results_dict, details = processor.process_batch(mark_rois, mark_roi_fields)
-                    
-                    # Formatear resultados para el frontend
-                    for field_name, is_marked in results_dict.items():
-                        detail = details.get(field_name, {})
-                        percentage = detail.get('percentage', 0.0)
-                        
-                        combined_results[field_name] = {
-                            'type': 'mark',
-                            'value': 'MARCADO' if is_marked else 'NO MARCADO',
-                            'marked': is_marked,
-                            'confidence': percentage / 100.0,
-                            'percentage': percentage
-                        }
-                    
-                    logger.info(f"Procesados {len(results_dict)} campos de marca")
-                except Exception as e:
-                    logger.error(f"Error procesando marcas: {e}", exc_info=True)
-        
-        # Procesar texto si hay campos de ese tipo
-        if text_fields:
-            logger.info(f"Procesando {len(text_fields)} campos de texto: {text_fields}")
-            
-            # Obtener ROIs para los campos de texto
-            text_rois = []
-            text_roi_fields = []
-            
-            for field in text_fields:
-                if field in session.rois:
-                    roi_coords = session.rois[field]
-                    x, y, w, h = map(int, roi_coords)
-                    roi = image[y:y+h, x:x+w]
-                    if roi is not None and roi.size > 0:
-                        text_rois.append(roi)
-                        text_roi_fields.append(field)
-                    else:
-                        logger.warning(f"ROI inválida para el campo de texto {field}")
-                else:
-                    logger.warning(f"Campo de texto {field} no encontrado en las ROIs disponibles")
-                    
-            if text_rois:
-                try:
-                    # Procesar texto con Claude
-                    processor = HandwritingProcessor()
-                    text_results = processor.process_batch(text_rois, text_roi_fields, session.id)
-                    
-                    # Integrar resultados de texto
-                    for field, value in text_results.items():
-                        combined_results[field] = {
-                            'type': 'text',
-                            'value': value,
-                            'confidence': 0.95  # Valor por defecto para Claude
-                        }
-                    
-                    logger.info(f"Procesados {len(text_results)} campos de texto")
-                except Exception as e:
-                    logger.error(f"Error procesando texto: {e}", exc_info=True)
+        # Procesar marcas y texto
+        combined_results = recognize_page(
+            session, image, fields_list,
+            preprocess_mode=request.form.get('preprocess'),
+            scorer=request.form.get('scorer')
+        )
+        save_results(session, combined_results)
         
         # Construir respuesta final
         response_data = {
             "success": True,
             "results": combined_results,
-            "fields_processed": {
-                "text": text_fields,
-                "mark": mark_fields
-            }
+            "fields_processed": processed_fields(fields_list, get_session_template(session))
         }
         
         logger.info(f"Procesados un total de {len(combined_results)} campos.")
@@ -1,6 +1,8 @@
 import os
-from flask import Blueprint, render_template, send_from_directory
+from flask import Blueprint, Response, render_template, send_from_directory
 from app.config import settings
+from app.core.utils.metrics import render_prometheus
+from app.core.utils.page_cache import wait_page
 
 routes_bp = Blueprint('routes', __name__)
 
@@ -12,6 +14,8 @@ def index():
 @routes_bp.route('/static/<path:path>')
 def serve_static(path):
     """Servir archivos estáticos"""
+    # La copia PNG de una página recién subida puede estar escribiéndose todavía
+    wait_page(os.path.join(settings.STATIC_FOLDER, path))
     return send_from_directory(settings.STATIC_FOLDER, path)
 
 @routes_bp.route('/results/ocr/<path:filename>')
@@ -22,9 +26,16 @@ def download_ocr_file(filename):
 @routes_bp.route('/uploads/<path:filename>')
 def download_upload_file(filename):
     """Descargar archivo subido"""
+    wait_page(os.path.join(settings.UPLOAD_FOLDER, filename))
     return send_from_directory(settings.UPLOAD_FOLDER, filename)
 
 @routes_bp.route('/results/<path:filename>')
 def download_result_file(filename):
     """Descargar archivo de resultados"""
     return send_from_directory(settings.RESULTS_FOLDER, filename)
+
+
+@routes_bp.route('/api/metrics')
+def metrics():
+    """Métricas de tiempos por etapa y de capacidad en formato Prometheus"""
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
\ No newline at end of file
@@ -4,13 +4,16 @@ import logging
 from flask import Blueprint, request, jsonify, current_app
 from werkzeug.utils import secure_filename
 import uuid
-from pdf2image import convert_from_path
-import tempfile
+import cv2
 from app.config import settings
-from app.session import create_session
-from app.core.processors.handwriting import HandwritingProcessor
-from app.core.processors.mark import MarkProcessor
-from PIL import Image
+from app.session import create_session, save_session
+from app.core.utils.pdf_utils import iter_page_images, get_page_count
+from app.core.pipeline import iter_batch_pages
+from app.core.jobs import submit_job, JobStoreFull
+from app.core.template_cache import load_template
+from app.core.utils.page_cache import invalidate_page, write_page, get_page, GRAY
+from app.core.utils.async_utils import Deadline, set_deadline, reset_deadline
+from app.core.registration import register_page, set_reference, has_reference
 
 logger = logging.getLogger(__name__)
 
@@ -21,10 +24,6 @@ def allowed_file(filename, allowed_extensions):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
-def is_text_field(field_name):
-    """Determina si un campo es de texto basado en su nombre"""
-    return field_name == "DNI" or len(field_name) >= 4
-
 @uploads_bp.route('/api/upload-json', methods=['POST'])
 def upload_json():
     """Endpoint para subir archivo JSON de zonas"""
@@ -57,75 +56,76 @@ def upload_json():
         file.save(filepath)
         logger.info(f"Archivo JSON guardado: {filepath}")
         
-        # Leer el contenido del JSON
+        # Compilar la plantilla (o reutilizarla si ya se subió el mismo JSON)
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                zones_info = json.load(f)
+            with open(filepath, 'rb') as f:
+                template = load_template(f.read())
         except Exception as e:
             return jsonify({'success': False, 'error': f'Error al leer JSON: {str(e)}'}), 400
-            
-        # Extraer campos de texto y marca
-        text_fields = []
-        mark_fields = []
         
-        try:
-            text_processor = HandwritingProcessor()
-            mark_processor = MarkProcessor()
-            
-            # Función para extraer campos de forma recursiva
-            def extract_fields(data, prefix=""):
-                if isinstance(data, dict):
-                    if 'name' in data:
-                        field_name = data['name']
-                        # Clasificar como texto o marca
-                        if is_text_field(field_name):
-                            text_fields.append(field_name)
-                        else:
-                            mark_fields.append(field_name)
-                    else:
-                        for key, value in data.items():
-                            new_prefix = f"{prefix}.{key}" if prefix else key
-                            extract_fields(value, new_prefix)
-                elif isinstance(data, list):
-                    for i, item in enumerate(data):
-                        new_prefix = f"{prefix}[{i}]"
-                        extract_fields(item, new_prefix)
-            
-            # Extraer campos según la estructura del JSON
-            if isinstance(zones_info, list):
-                for zone in zones_info:
-                    extract_fields(zone)
-            else:
-                extract_fields(zones_info)
-                
-            logger.info(f"Campos de texto identificados: {text_fields}")
-            logger.info(f"Campos de marca identificados: {mark_fields}")
+        # Imagen de referencia opcional (hoja en blanco) para registrar las páginas
+        reference_file = request.files.get('reference_file')
+        if reference_file and reference_file.filename:
+            if not allowed_file(reference_file.filename, {'png', 'jpg', 'jpeg', 'pdf'}):
+                return jsonify({'success': False, 'error': 'La referencia debe ser un PDF o una imagen'}), 400
+            try:
+                save_reference(reference_file, session.id, template.hash)
+            except Exception as e:
+                logger.error(f"Error al procesar la referencia: {str(e)}", exc_info=True)
+                return jsonify({'success': False, 'error': f'Error al procesar la referencia: {str(e)}'}), 400
             
-        except Exception as e:
-            logger.error(f"Error al procesar zonas: {str(e)}", exc_info=True)
+        text_fields = template.text_fields
+        mark_fields = template.mark_fields
+        
+        logger.info(f"Campos de texto identificados: {text_fields}")
+        logger.info(f"Campos de marca identificados: {mark_fields}")
             
         # Actualizar información de la sesión
         session.json_path = filepath
-        session.zones_info = zones_info
+        session.template_hash = template.hash
+        session.zones_info = template.zones_info
         session.text_fields = text_fields
         session.mark_fields = mark_fields
         session.add_completed_step('json_upload')
-        
-        # Establecer campos de texto para procesadores
-        text_processor.set_text_fields(set(text_fields))
+        save_session(session)
         
         return jsonify({
             'success': True,
             'message': 'Archivo JSON cargado correctamente',
             'session_id': session.id,
             'text_fields': text_fields,
-            'mark_fields': mark_fields
+            'mark_fields': mark_fields,
+            'has_reference': has_reference(template.hash)
         })
         
     except Exception as e:
         logger.error(f"Error al procesar archivo JSON: {str(e)}", exc_info=True)
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def save_reference(file, session_id, template_hash):
+    """
+    Guardar la imagen de referencia de una plantilla (PDF o imagen de la hoja en blanco)
+    
+    La referencia se lleva al tamaño de las plantillas y se precalculan sus
+    fiduciales y descriptores (ver app.core.registration).
+    """
+    os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{session_id}_reference_{secure_filename(file.filename)}")
+    file.save(filepath)
+    
+    if file.filename.lower().endswith('.pdf'):
+        page = next(iter_page_images(filepath, first_page=1, last_page=1), None)
+        image = page[1] if page is not None else None
+    else:
+        image = cv2.imread(filepath)
+        if image is not None:
+            image = cv2.resize(image, settings.PAGE_SIZE, interpolation=cv2.INTER_AREA)
+    if image is None:
+        raise ValueError('No se pudo leer la imagen de referencia')
+    
+    set_reference(template_hash, image)
+    logger.info(f"Referencia de la plantilla {template_hash[:12]} guardada desde {filepath}")
+
 @uploads_bp.route('/api/upload-pdf', methods=['POST'])
 def upload_pdf():
     """Endpoint para subir archivo PDF o imagen"""
@@ -169,6 +169,7 @@ def upload_pdf():
         
         # Determinar si es PDF
         is_pdf = file.filename.lower().endswith('.pdf')
+        registration = None
         
         if is_pdf:
             # Guardar la ruta del PDF original en la sesión
@@ -176,76 +177,70 @@ def upload_pdf():
             session.is_pdf = True
             logger.info(f"PDF guardado: {filepath}")
             
+            # Modo lote: procesar todas las páginas contra la misma plantilla
+            if request.form.get('batch', 'false').lower() == 'true':
+                return upload_pdf_batch(session, filepath)
+            
             # Convertir PDF a imagen
             try:
-                # Crear carpeta temporal para las imágenes
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    # Configurar Poppler según el sistema operativo
-                    if os.name == 'nt':  # Windows
-                        poppler_path = r"C:\Python312\poppler-24.08.0\Library\bin"
-                        logger.info(f"Windows: Usando Poppler desde: {poppler_path}")
-                        conversion_args = {'poppler_path': poppler_path}
-                    else:  # Linux/Unix
-                        logger.info("Linux: Usando Poppler del sistema")
-                        conversion_args = {}
-                    
-                    # Convertir primera página del PDF a imagen con alta resolución
-                    images = convert_from_path(
-                        filepath, 
-                        first_page=1, 
-                        last_page=1,
-                        dpi=200,
-                        output_folder=temp_dir,
-                        thread_count=4,
-                        grayscale=False,
-                        fmt='jpeg',
-                        jpegopt={'quality': 95},
-                        **conversion_args
-                    )
-                    
-                    if not images:
-                        return jsonify({'success': False, 'error': 'No se pudo convertir el PDF a imagen'}), 500
-                    
-                    # Obtener la primera imagen
-                    image = images[0]
-                    
-                    # Redimensionar la imagen al tamaño exacto requerido
-                    target_size = (1786, 2526)
-                    image = image.resize(target_size, Image.Resampling.LANCZOS)
-                    
-                    # Verificar tamaño después del redimensionamiento
-                    width, height = image.size
-                    if width != target_size[0] or height != target_size[1]:
-                        logger.error(f"Error al redimensionar: {width}x{height} (debería ser {target_size[0]}x{target_size[1]})")
-                        return jsonify({'success': False, 'error': 'Error al redimensionar la imagen'}), 400
-                    
-                    logger.info(f"Imagen redimensionada correctamente a {width}x{height}")
-                    
-                    # Guardar la imagen convertida
-                    image_filename = f"{session_id}_converted.jpg"
-                    image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], image_filename)
-                    image.save(image_path, 'JPEG', quality=95)
-                    logger.info(f"Imagen convertida guardada: {image_path}")
-                    
-                    # Guardar ruta de la imagen en la sesión
-                    session.image_path = image_path
+                # Renderizar la primera página del PDF al tamaño exacto de las plantillas
+                pages = iter_page_images(filepath, first_page=1, last_page=1)
+                try:
+                    page = next(pages, None)
+                except ValueError as e:
+                    logger.error(str(e))
+                    return jsonify({'success': False, 'error': 'Error al redimensionar la imagen'}), 400
+                
+                if page is None:
+                    return jsonify({'success': False, 'error': 'No se pudo convertir el PDF a imagen'}), 500
+                
+                image = page[1]
+                height, width = image.shape[:2]
+                logger.info(f"Página renderizada a {width}x{height}")
+                
+                # Alinear la página con la referencia de la plantilla, si la tiene
+                registration = register_page(image, session.template_hash)
+                image = registration.image
+                
+                # Guardar la imagen convertida sin pérdida
+                image_filename = f"{session_id}_converted.png"
+                image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], image_filename)
+                if session.image_path:
+                    invalidate_page(session.image_path)
+                # La página ya está decodificada: queda en la caché y el PNG se escribe en segundo plano
+                write_page(image_path, image)
+                logger.info(f"Imagen convertida guardada: {image_path}")
+                session.image_path = image_path
                     
             except Exception as e:
                 logger.error(f"Error al convertir PDF: {str(e)}", exc_info=True)
                 return jsonify({'success': False, 'error': f'Error al procesar PDF: {str(e)}'}), 500
         else:
             # Es una imagen
+            invalidate_page(filepath)
+            if session.image_path:
+                invalidate_page(session.image_path)
             session.image_path = filepath
             session.is_pdf = False
             logger.info(f"Imagen guardada: {filepath}")
             
+            # Con referencia, guardar la imagen alineada con la plantilla
+            if settings.REGISTRATION_ENABLED and session.template_hash and has_reference(session.template_hash):
+                image = get_page(filepath)
+                if image is not None:
+                    registration = register_page(image, session.template_hash, get_page(filepath, GRAY))
+                    if registration.applied:
+                        image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{session_id}_registered.png")
+                        write_page(image_path, registration.image)
+                        session.image_path = image_path
+            
         # Marcar paso como completado
         session.add_completed_step('pdf_upload')
+        save_session(session)
         
         # Construir URL relativa para la imagen
         if session.image_path:
-            relative_path = os.path.relpath(session.image_path, settings.STATIC_FOLDER)
-            image_url = f"/static/{relative_path.replace(os.sep, '/')}"
+            image_url = image_url_for(session.image_path)
         else:
             image_url = None
             
@@ -253,9 +248,126 @@ def upload_pdf():
             'success': True,
             'message': 'Archivo procesado correctamente',
             'is_pdf': is_pdf,
-            'image_url': image_url
+            'image_url': image_url,
+            'registration': registration.to_dict() if registration is not None and registration.applied else None
         })
         
     except Exception as e:
         logger.error(f"Error al procesar archivo: {str(e)}", exc_info=True)
-        return jsonify({'success': False, 'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def image_url_for(path):
+    """Construir la URL relativa a /static de un archivo"""
+    relative_path = os.path.relpath(path, settings.STATIC_FOLDER)
+    return f"/static/{relative_path.replace(os.sep, '/')}"
+
+def upload_pdf_batch(session, filepath):
+    """
+    Procesar un PDF multipágina (una hoja por alumno) contra la plantilla de la sesión
+    
+    Cada página se renderiza de forma perezosa, se guarda en su propia sesión
+    y pasa por el reconocimiento de los campos indicados en 'fields' (por
+    defecto, todos los campos de la plantilla).
+    """
+    if 'json_upload' not in session.completed_steps:
+        return jsonify({'success': False, 'error': 'Debe cargar primero el JSON de zonas'}), 400
+    
+    # Campos a reconocer en cada página
+    fields_json = request.form.get('fields')
+    if fields_json:
+        try:
+            fields = json.loads(fields_json)
+            if not isinstance(fields, list):
+                fields = [fields]
+        except json.JSONDecodeError:
+            fields = [fields_json]
+    else:
+        fields = list(session.text_fields) + list(session.mark_fields)
+    
+    try:
+        page_count = get_page_count(filepath)
+    except Exception as e:
+        logger.error(f"Error al leer el PDF: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'error': f'Error al procesar PDF: {str(e)}'}), 500
+    
+    if page_count == 0:
+        return jsonify({'success': False, 'error': 'El PDF no tiene páginas'}), 400
+    if page_count > settings.PDF_BATCH_MAX_PAGES:
+        return jsonify({'success': False, 'error': f'El PDF tiene {page_count} páginas. Máximo permitido: {settings.PDF_BATCH_MAX_PAGES}'}), 400
+    
+    logger.info(f"Procesando lote de {page_count} páginas con {len(fields)} campos")
+    
+    preprocess_mode = request.form.get('preprocess')
+    scorer = request.form.get('scorer')
+    
+    # En modo asíncrono el lote se procesa como trabajo y cada página se
+    # publica como evento 'page' en /api/jobs/<id>/events
+    if request.form.get('async', 'false').lower() == 'true':
+        save_session(session)
+        try:
+            job = submit_job(
+                'batch', run_batch_job, session, filepath, fields, page_count,
+                preprocess_mode=preprocess_mode, scorer=scorer, session_id=session.id
+            )
+        except JobStoreFull as e:
+            return jsonify({'success': False, 'error': str(e)}), 503
+        
+        return jsonify({
+            'success': True,
+            'message': f'Lote de {page_count} páginas encolado',
+            'is_pdf': True,
+            'batch': True,
+            'page_count': page_count,
+            'job_id': job.id,
+            'status_url': f'/api/jobs/{job.id}',
+            'events_url': f'/api/jobs/{job.id}/events'
+        }), 202
+    
+    # El plazo de la petición no alcanza para un lote: se sustituye por uno
+    # proporcional a sus páginas. Las que no lleguen a tiempo vuelven con 'error'
+    token = set_deadline(Deadline(settings.PDF_BATCH_PAGE_DEADLINE * page_count))
+    try:
+        pages = []
+        for page in iter_batch_pages(
+            session, filepath, fields, last_page=page_count,
+            preprocess_mode=preprocess_mode, scorer=scorer
+        ):
+            if 'image_path' in page:
+                page['image_url'] = image_url_for(page.pop('image_path'))
+            pages.append(page)
+    finally:
+        reset_deadline(token)
+    
+    session.add_completed_step('pdf_upload')
+    session.add_completed_step('batch')
+    save_session(session)
+    
+    return jsonify({
+        'success': True,
+        'message': f'Procesadas {len(pages)} páginas',
+        'is_pdf': True,
+        'batch': True,
+        'page_count': page_count,
+        'pages': pages
+    })
+
+def run_batch_job(job, session, filepath, fields, page_count, preprocess_mode=None, scorer=None):
+    """Procesar un lote de páginas como trabajo, publicando un evento por página"""
+    job.set_progress(stage='pages', completed=0, total=page_count)
+    
+    pages = []
+    for page in iter_batch_pages(
+        session, filepath, fields, last_page=page_count,
+        preprocess_mode=preprocess_mode, scorer=scorer
+    ):
+        if 'image_path' in page:
+            page['image_url'] = image_url_for(page.pop('image_path'))
+        pages.append(page)
+        job.emit('page', page)
+        job.set_progress(completed=len(pages))
+    
+    session.add_completed_step('pdf_upload')
+    session.add_completed_step('batch')
+    save_session(session)
+    
+    return {'page_count': page_count, 'pages': pages}
\ No newline at end of file
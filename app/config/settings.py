@@ -24,9 +24,98 @@ MAX_CONTENT_LENGTH = 16 * 1024 * 1024
 CLAUDE_MODEL = os.getenv("CLAUDE_MODEL", "claude-3-7-sonnet-20250219")
 CLAUDE_MAX_TOKENS = int(os.getenv("CLAUDE_MAX_TOKENS", "1000"))
 CLAUDE_TIMEOUT = 30
+CLAUDE_DEADLINE = float(os.getenv("CLAUDE_DEADLINE", "120"))  # Espera máxima por petición, reintentos incluidos
+CLAUDE_BASE_URL = os.getenv("CLAUDE_BASE_URL") or None  # Otro servidor compatible con la Messages API
+# Servidor local que imita la Messages API (tools/claude_stub.py), p. ej. http://127.0.0.1:8765;
+# sustituye a la API real y no requiere ANTHROPIC_API_KEY
+CLAUDE_STUB_URL = os.getenv("CLAUDE_STUB_URL") or None
+CLAUDE_MAX_IN_FLIGHT = int(os.getenv("CLAUDE_MAX_IN_FLIGHT", "4"))  # Peticiones simultáneas
+CLAUDE_RPM = int(os.getenv("CLAUDE_RPM", "50"))  # Peticiones por minuto
+CLAUDE_TPM = int(os.getenv("CLAUDE_TPM", "40000"))  # Tokens (entrada + salida) por minuto
+CLAUDE_MAX_RETRIES = int(os.getenv("CLAUDE_MAX_RETRIES", "4"))  # Reintentos ante 429, 5xx y errores de conexión
+CLAUDE_BACKOFF_BASE = float(os.getenv("CLAUDE_BACKOFF_BASE", "1.0"))  # Segundos de la primera espera
+CLAUDE_BACKOFF_MAX = float(os.getenv("CLAUDE_BACKOFF_MAX", "30"))
+CLAUDE_BREAKER_THRESHOLD = int(os.getenv("CLAUDE_BREAKER_THRESHOLD", "5"))  # Fallos seguidos que abren el cortocircuito
+CLAUDE_BREAKER_COOLDOWN = float(os.getenv("CLAUDE_BREAKER_COOLDOWN", "30"))  # Segundos antes de volver a probar
+# Envío de los campos manuscritos: montage (tira con las ROIs recortadas) o document (PDF completo)
+HANDWRITING_MODE = os.getenv("HANDWRITING_MODE", "montage")
+HANDWRITING_RETRIES = int(os.getenv("HANDWRITING_RETRIES", "1"))  # Reintentos de los campos sin respuesta válida
+
+# Caché persistente de resultados de texto manuscrito
+TEXT_CACHE_ENABLED = os.getenv("TEXT_CACHE_ENABLED", "true").lower() == "true"
+TEXT_CACHE_PATH = os.getenv("TEXT_CACHE_PATH", str(ROOT_DIR / 'text_cache.db'))
+TEXT_CACHE_MAX_ENTRIES = int(os.getenv("TEXT_CACHE_MAX_ENTRIES", "100000"))
+
+# Configuración de conversión de PDF
+PAGE_SIZE = (1786, 2526)  # Tamaño de página de las plantillas (ancho, alto)
+PDF_DPI = 200
+PDF_THREAD_COUNT = int(os.getenv("PDF_THREAD_COUNT", "4"))
+PDF_BATCH_MAX_PAGES = int(os.getenv("PDF_BATCH_MAX_PAGES", "300"))
+PDF_BATCH_PAGE_DEADLINE = float(os.getenv("PDF_BATCH_PAGE_DEADLINE", "30"))  # Segundos por página del plazo de un lote síncrono (0 = sin límite)
+# Rasterizador de PDF: auto (PyMuPDF si está instalado), pymupdf o poppler
+PDF_RASTERIZER = os.getenv("PDF_RASTERIZER", "auto")
+# Extraer directamente la imagen de las páginas escaneadas (solo PyMuPDF)
+PDF_EXTRACT_SCANS = os.getenv("PDF_EXTRACT_SCANS", "true").lower() == "true"
+
+# Pool de procesos para lotes de páginas (0 o 1 = procesar en el propio proceso)
+PAGE_WORKERS = int(os.getenv("PAGE_WORKERS", "0"))
+PAGE_WORKER_START_METHOD = os.getenv("PAGE_WORKER_START_METHOD", "spawn")
+
+# Caché de páginas decodificadas (BGR y escala de grises) compartida por los endpoints
+PAGE_CACHE_MB = int(os.getenv("PAGE_CACHE_MB", "256"))
+
+# Trabajos de reconocimiento en segundo plano (/api/jobs)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ENTRIES = int(os.getenv("JOB_MAX_ENTRIES", "1000"))  # Trabajos guardados como máximo
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))  # Segundos que se conserva un trabajo terminado
+SSE_KEEPALIVE = 15  # Segundos sin eventos antes de enviar un comentario keep-alive
+
+# Plazos por petición y ejecutor compartido de tareas con timeout
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "150"))  # Segundos por petición HTTP (0 = sin límite)
+DEADLINE_OPTIONAL_RESERVE = float(os.getenv("DEADLINE_OPTIONAL_RESERVE", "5"))  # Margen por debajo del cual se omite el trabajo opcional (debug)
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", "8"))  # Hilos del ejecutor compartido
+
+# Almacén de sesiones
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")  # 'memory' (por proceso) o 'sqlite' (compartido entre workers)
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))  # Segundos de inactividad antes de caducar
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "2000"))
+SESSION_MEMORY_BUDGET_MB = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "1024"))
+SESSION_STRIPES = 16  # Particiones con lock propio del almacén en memoria
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", str(ROOT_DIR / 'sessions.db'))
+SESSION_SWEEP_INTERVAL = 300  # Segundos entre barridos de sesiones caducadas
+
+# Escribir la copia PNG de las páginas en segundo plano (ver app.core.utils.page_cache).
+# Otros procesos no ven la página hasta que termina: por defecto, solo con sesiones en memoria
+PAGE_WRITE_ASYNC = os.getenv("PAGE_WRITE_ASYNC", "true" if SESSION_BACKEND == "memory" else "false").lower() == "true"
 
 # Configuración de procesamiento
 MARK_THRESHOLD = 25  # Porcentaje de píxeles marcados para detección
+MARK_PREPROCESS_MODE = os.getenv("MARK_PREPROCESS_MODE", "roi")  # 'roi' (por recorte) o 'page' (página completa)
+MARK_SCORER = os.getenv("MARK_SCORER", "default")  # 'default' o 'integral' (tablas integrales, solo marcas cuadradas)
+MARK_VECTORIZED_BATCH = os.getenv("MARK_VECTORIZED_BATCH", "true").lower() == "true"  # Puntuar lotes de ROIs con NumPy
+DNI_GRID_DECODE = os.getenv("DNI_GRID_DECODE", "true").lower() == "true"  # Leer el DNI de la rejilla D{fila}{columna} en lugar de con Claude
+
+# Caché de plantillas compiladas (por SHA-256 del JSON de zonas)
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "16"))
+TEMPLATE_CACHE_PERSIST = os.getenv("TEMPLATE_CACHE_PERSIST", "false").lower() == "true"  # Guardar como .npy (mmap)
+TEMPLATE_CACHE_DIR = MODELS_FOLDER / 'templates'
+
+# Registro de las páginas contra la imagen de referencia de la plantilla (ver app.core.registration)
+REGISTRATION_ENABLED = os.getenv("REGISTRATION_ENABLED", "true").lower() == "true"  # Solo actúa si la plantilla tiene referencia
+REGISTRATION_METHOD = os.getenv("REGISTRATION_METHOD", "auto")  # 'auto', 'fiducials' u 'orb'
+REGISTRATION_WIDTH = int(os.getenv("REGISTRATION_WIDTH", "800"))  # Ancho de la copia reducida en la que se alinea
+REGISTRATION_MAX_FEATURES = int(os.getenv("REGISTRATION_MAX_FEATURES", "1500"))  # Puntos ORB por imagen
+REGISTRATION_MIN_INLIERS = int(os.getenv("REGISTRATION_MIN_INLIERS", "25"))  # Correspondencias ORB mínimas tras RANSAC
+
+# Corrección con clave de respuestas (ver app.core.grading)
+GRADING_CACHE_SIZE = int(os.getenv("GRADING_CACHE_SIZE", "8"))  # Lotes cuyo tensor de marcas se mantiene en memoria
+
+# Imágenes de debug de las marcas (ver app.core.utils.debug_sink)
+DEBUG_POLICY = os.getenv("DEBUG_POLICY", "ambiguous")  # 'off', 'ambiguous', 'sample' o 'all'
+DEBUG_PACKING = os.getenv("DEBUG_PACKING", "files")  # 'files', 'mosaic' o 'zip'
+DEBUG_SAMPLE_RATE = int(os.getenv("DEBUG_SAMPLE_RATE", "10"))  # Uno de cada N campos con 'sample'
+DEBUG_AMBIGUOUS_MARGIN = float(os.getenv("DEBUG_AMBIGUOUS_MARGIN", "5"))  # Puntos alrededor del umbral con 'ambiguous'
+DEBUG_QUEUE_SIZE = int(os.getenv("DEBUG_QUEUE_SIZE", "256"))
 
 # Configuración de logging
 logging.basicConfig(
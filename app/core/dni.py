@@ -0,0 +1,120 @@
+"""
+Lectura del DNI a partir de la rejilla de marcas D{fila}{columna}.
+
+El editor de plantillas (`generateDNIGrid`) crea una rejilla de 10 filas
+(dígitos 0-9) por 8 columnas (posiciones del número). Con los porcentajes de
+relleno de sus casillas se forma una matriz 10×8 y cada dígito es el argmax
+de su columna. Una columna es ambigua si no tiene ninguna casilla marcada o
+tiene más de una; en ese caso el DNI se lee como texto manuscrito.
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+import numpy as np
+from app.config import settings
+from app.core.template_cache import DNI_PATTERN
+
+CONTROL_LETTERS = "TRWAGMYFPDXBNJZSQVHLCKE"
+
+DNI_ROWS = 10  # Dígitos 0-9
+DNI_COLUMNS = 8  # Posiciones del número
+
+def control_letter(number: int) -> str:
+    """Letra de control de un número de DNI"""
+    return CONTROL_LETTERS[number % 23]
+
+class DniGrid:
+    """
+    Rejilla de marcas del DNI de una plantilla
+
+    Attributes:
+        fields: Campos de la rejilla en orden fila a fila
+        positions: {campo: (fila, columna)}
+    """
+
+    def __init__(self, fields: List[str]):
+        self.positions = {}
+        for name in fields:
+            match = DNI_PATTERN.match(name)
+            if match:
+                self.positions[name] = (int(match.group(1)), int(match.group(2)))
+        self.fields = sorted(self.positions, key=lambda name: self.positions[name])
+
+    @classmethod
+    def for_template(cls, template) -> Optional['DniGrid']:
+        """Rejilla de la plantilla si está completa (10×8 casillas con zona válida), o None"""
+        if template is None:
+            return None
+        grid = cls([name for name in template.mark_fields if name in template.rois])
+        return grid if grid.complete else None
+
+    @property
+    def complete(self) -> bool:
+        return len(self.positions) == DNI_ROWS * DNI_COLUMNS
+
+@dataclass
+class DniDecode:
+    """Resultado de leer la rejilla del DNI"""
+
+    digits: str  # Dígitos leídos ('?' en las columnas ambiguas)
+    columns: List[str]  # Estado de cada columna: 'ok', 'blank' o 'multiple'
+    confidence: float  # Menor separación entre la casilla elegida y la siguiente, relativa al umbral
+    letter: Optional[str] = None  # Letra de control (solo si no es ambiguo)
+    candidates: List[int] = field(default_factory=list)  # Argmax de cada columna, aunque sea ambigua
+
+    @property
+    def ambiguous(self) -> bool:
+        return any(status != 'ok' for status in self.columns)
+
+    @property
+    def value(self) -> str:
+        return self.digits + (self.letter or '')
+
+    def to_result(self) -> Dict[str, Any]:
+        """Resultado en el formato de los campos de texto"""
+        return {
+            'type': 'text',
+            'value': self.value,
+            'confidence': round(self.confidence, 4),
+            'source': 'grid',
+            'ambiguous': self.ambiguous,
+            'grid': self.summary()
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        return {'digits': self.digits, 'letter': self.letter, 'columns': self.columns}
+
+def decode_dni(grid: DniGrid, mark_results: Dict[str, Dict[str, Any]]) -> DniDecode:
+    """
+    Leer el DNI con un argmax por columna de la matriz de relleno
+
+    Args:
+        grid: Rejilla completa de la plantilla
+        mark_results: Resultados de marca {campo: {'marked', 'percentage', ...}}
+
+    Returns:
+        Dígitos, estado de cada columna y, si ninguna es ambigua, letra de control
+    """
+    fill = np.zeros((DNI_ROWS, DNI_COLUMNS), dtype=np.float32)
+    marked = np.zeros((DNI_ROWS, DNI_COLUMNS), dtype=bool)
+    for name, (row, column) in grid.positions.items():
+        result = mark_results.get(name) or {}
+        fill[row, column] = result.get('percentage', 0.0)
+        marked[row, column] = bool(result.get('marked', False))
+
+    counts = marked.sum(axis=0)
+    # Con una sola casilla marcada se toma esa; si no, la más rellena como candidata
+    candidates = np.where(counts == 1, marked.argmax(axis=0), fill.argmax(axis=0))
+    columns = ['ok' if count == 1 else 'blank' if count == 0 else 'multiple' for count in counts.tolist()]
+    digits = ''.join(str(d) if status == 'ok' else '?' for d, status in zip(candidates.tolist(), columns))
+
+    # Separación entre la casilla más rellena de cada columna y la siguiente,
+    # relativa al umbral con que MarkProcessor decide las casillas circulares
+    ordered = np.sort(fill, axis=0)
+    margins = (ordered[-1] - ordered[-2]) / getattr(settings, 'CIRCLE_MARK_THRESHOLD', 30)
+    confidence = float(np.clip(margins.min(), 0.0, 1.0))
+
+    decode = DniDecode(digits, columns, confidence, candidates=candidates.tolist())
+    if not decode.ambiguous:
+        decode.letter = control_letter(int(digits))
+    return decode
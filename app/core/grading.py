@@ -0,0 +1,343 @@
+"""
+Corrección de hojas de respuestas con una clave.
+
+Las marcas de las preguntas (campos 1A, 1B... de la plantilla) de todas las
+hojas de un lote se reúnen en un tensor booleano hojas × preguntas × opciones
+(`SheetMarks`), construido a partir de los resultados ya guardados en las
+sesiones de cada página, sin volver a leer ninguna imagen. La clave
+(`AnswerKey`) se expresa con arrays alineados con los mismos ejes, de modo
+que puntuaciones, preguntas en blanco y marcas múltiples se calculan con
+NumPy en una sola pasada (`grade`).
+
+Los tensores se guardan en una caché LRU por sesión de lote: corregir la
+clave y volver a puntuar solo repite la pasada de NumPy.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+import numpy as np
+from app.config import settings
+from app.session import get_session
+from app.core.template_cache import QUESTION_PATTERN, get_session_template
+
+logger = logging.getLogger(__name__)
+
+# Tratamiento de las preguntas con más marcas que opciones correctas
+MULTIPLE_POLICIES = ('wrong', 'blank')
+
+class QuestionLayout:
+    """
+    Preguntas y opciones de una plantilla como ejes del tensor de marcas
+
+    Attributes:
+        questions: Números de pregunta en orden ascendente
+        options: Letras de opción presentes en alguna pregunta, en orden
+        valid: Máscara (preguntas, opciones) de las casillas que existen
+        columns: {campo: índice plano pregunta * opciones + opción}
+    """
+
+    def __init__(self, fields: Sequence[str]):
+        parsed = {}
+        for field in fields:
+            match = QUESTION_PATTERN.match(field)
+            if match:
+                parsed[field] = (int(match.group(1)), field[-1])
+
+        self.questions = sorted({q for q, _ in parsed.values()})
+        self.options = sorted({o for _, o in parsed.values()})
+        question_index = {q: i for i, q in enumerate(self.questions)}
+        option_index = {o: i for i, o in enumerate(self.options)}
+
+        self.valid = np.zeros((len(self.questions), len(self.options)), dtype=bool)
+        self.columns = {}
+        for field, (question, option) in parsed.items():
+            q, o = question_index[question], option_index[option]
+            self.valid[q, o] = True
+            self.columns[field] = q * len(self.options) + o
+        self.question_index = question_index
+        self.option_index = option_index
+
+    @classmethod
+    def for_session(cls, session) -> 'QuestionLayout':
+        """Ejes de la plantilla de una sesión"""
+        template = get_session_template(session)
+        return cls(template.mark_fields if template is not None else session.mark_fields)
+
+    @property
+    def shape(self):
+        return len(self.questions), len(self.options)
+
+class AnswerKey:
+    """
+    Clave de respuestas alineada con un `QuestionLayout`
+
+    Formato JSON:
+
+        {
+            "answers": {"1": "B", "2": "AC", "3": null},
+            "weights": {"2": 2},
+            "default_weight": 1,
+            "penalty": 0.25,
+            "penalties": {"2": 0.5},
+            "multiple": "wrong",
+            "scale": 10
+        }
+
+    `answers` también puede ser una lista (pregunta 1, 2...). Una respuesta
+    nula anula la pregunta; las preguntas de la plantilla que no aparecen
+    en la clave no se puntúan. `penalty` es la fracción del peso que se
+    resta por cada respuesta errónea (0 = sin puntuación negativa) y
+    `multiple` indica si las preguntas con más marcas que opciones
+    correctas cuentan como erróneas o como en blanco.
+
+    Attributes:
+        key: Máscara (preguntas, opciones) de las opciones correctas
+        weights: Peso de cada pregunta (0 si no se puntúa)
+        penalties: Puntos que resta cada pregunta errónea
+        active: Preguntas que se puntúan
+        key_counts: Número de opciones correctas de cada pregunta
+    """
+
+    def __init__(self, layout: QuestionLayout, key: np.ndarray, weights: np.ndarray,
+                 penalties: np.ndarray, active: np.ndarray, multiple: str = 'wrong',
+                 scale: Optional[float] = None):
+        self.layout = layout
+        self.key = key
+        self.weights = weights
+        self.penalties = penalties
+        self.active = active
+        self.key_counts = key.sum(axis=1)
+        self.multiple = multiple
+        self.scale = scale
+
+    @classmethod
+    def parse(cls, data: Dict[str, Any], layout: QuestionLayout) -> 'AnswerKey':
+        """
+        Construir la clave a partir de su JSON
+
+        Raises:
+            ValueError: Si la clave no es coherente con la plantilla
+        """
+        if not isinstance(data, dict) or 'answers' not in data:
+            raise ValueError("La clave debe ser un objeto con 'answers'")
+        answers = data['answers']
+        if isinstance(answers, list):
+            answers = {str(i + 1): answer for i, answer in enumerate(answers)}
+        if not isinstance(answers, dict):
+            raise ValueError("'answers' debe ser un objeto o una lista")
+
+        multiple = data.get('multiple', 'wrong')
+        if multiple not in MULTIPLE_POLICIES:
+            raise ValueError(f"'multiple' debe ser uno de: {', '.join(MULTIPLE_POLICIES)}")
+        scale = data.get('scale')
+        if scale is not None and float(scale) <= 0:
+            raise ValueError("'scale' debe ser positivo")
+
+        shape = layout.shape
+        key = np.zeros(shape, dtype=bool)
+        active = np.zeros(shape[0], dtype=bool)
+        for question, answer in answers.items():
+            q = cls._question(layout, question)
+            if answer is None or answer == '' or answer == []:
+                continue  # Pregunta anulada
+            letters = list(answer) if isinstance(answer, (str, list)) else None
+            if not letters or not all(isinstance(letter, str) for letter in letters):
+                raise ValueError(f"Respuesta no válida para la pregunta {question}: {answer!r}")
+            for letter in letters:
+                o = layout.option_index.get(letter.upper())
+                if o is None or not layout.valid[q, o]:
+                    raise ValueError(f"La pregunta {question} no tiene la opción {letter}")
+                key[q, o] = True
+            active[q] = True
+
+        weights = np.full(shape[0], float(data.get('default_weight', 1)))
+        for question, weight in (data.get('weights') or {}).items():
+            weights[cls._question(layout, question)] = float(weight)
+        if (weights < 0).any():
+            raise ValueError("Los pesos no pueden ser negativos")
+
+        penalty_rates = np.full(shape[0], float(data.get('penalty', 0)))
+        for question, rate in (data.get('penalties') or {}).items():
+            penalty_rates[cls._question(layout, question)] = float(rate)
+        if (penalty_rates < 0).any():
+            raise ValueError("Las penalizaciones no pueden ser negativas")
+
+        weights = np.where(active, weights, 0.0)
+        return cls(layout, key, weights, weights * penalty_rates, active, multiple,
+                   float(scale) if scale is not None else None)
+
+    @staticmethod
+    def _question(layout: QuestionLayout, question) -> int:
+        try:
+            return layout.question_index[int(question)]
+        except (KeyError, ValueError, TypeError):
+            raise ValueError(f"La plantilla no tiene la pregunta {question}")
+
+    @property
+    def max_score(self) -> float:
+        return float(self.weights.sum())
+
+@dataclass
+class SheetMarks:
+    """Marcas de un conjunto de hojas como tensor (hojas, preguntas, opciones)"""
+
+    layout: QuestionLayout
+    sheets: List[Dict[str, Any]]  # Identificación de cada hoja (sesión, página)
+    marks: np.ndarray
+    missing: List[Dict[str, Any]]  # Hojas sin resultados, excluidas del tensor
+
+    @classmethod
+    def from_results(cls, layout: QuestionLayout, results: Sequence[Dict[str, Any]],
+                     sheets: Sequence[Dict[str, Any]] = None) -> 'SheetMarks':
+        """
+        Construir el tensor a partir de los resultados de reconocimiento
+
+        Args:
+            layout: Ejes de la plantilla
+            results: Por hoja, {campo: {'marked': bool, ...}} o {campo: bool}
+            sheets: Identificación de cada hoja (por defecto, su posición)
+
+        Returns:
+            Tensor con las hojas que tienen resultados; las vacías se
+            devuelven en `missing`
+        """
+        sheets = list(sheets) if sheets is not None else [{'index': i} for i in range(len(results))]
+        kept = [i for i, sheet_results in enumerate(results) if sheet_results]
+        questions, options = layout.shape
+        flat = np.zeros((len(kept), questions * options), dtype=bool)
+
+        columns = list(layout.columns.items())
+        for row, i in enumerate(kept):
+            sheet_results = results[i]
+            for field, column in columns:
+                value = sheet_results.get(field)
+                if isinstance(value, dict):
+                    value = value.get('marked')
+                if value:
+                    flat[row, column] = True
+
+        return cls(layout, [sheets[i] for i in kept], flat.reshape(len(kept), questions, options),
+                   [sheets[i] for i in range(len(results)) if not results[i]])
+
+@dataclass
+class GradeResult:
+    """Resultado de puntuar un tensor de marcas con una clave"""
+
+    score: np.ndarray  # (hojas,) puntos
+    grade: Optional[np.ndarray]  # (hojas,) nota en la escala de la clave
+    correct: np.ndarray  # (hojas, preguntas) acertadas
+    wrong: np.ndarray  # (hojas, preguntas) erróneas (penalizadas)
+    blank: np.ndarray  # (hojas, preguntas) sin marcar
+    multiple: np.ndarray  # (hojas, preguntas) con más marcas que opciones correctas
+    option_counts: np.ndarray  # (preguntas, opciones) veces que se marcó cada opción
+    max_score: float
+
+    def students(self, sheets: Sequence[Dict[str, Any]], questions: Sequence[int]) -> List[Dict[str, Any]]:
+        """Resumen por hoja: puntos, nota, recuentos y preguntas con marca múltiple"""
+        questions = np.asarray(questions)
+        scores = np.round(self.score, 4).tolist()
+        grades = np.round(self.grade, 4).tolist() if self.grade is not None else [None] * len(scores)
+        correct = self.correct.sum(axis=1).tolist()
+        wrong = self.wrong.sum(axis=1).tolist()
+        blank = self.blank.sum(axis=1).tolist()
+        rows, cols = np.nonzero(self.multiple)
+        multiple = [[] for _ in scores]
+        for row, question in zip(rows.tolist(), questions[cols].tolist()):
+            multiple[row].append(question)
+        return [
+            {**sheet, 'score': scores[i], 'grade': grades[i], 'correct': correct[i],
+             'wrong': wrong[i], 'blank': blank[i], 'multiple': multiple[i]}
+            for i, sheet in enumerate(sheets)
+        ]
+
+    def question_stats(self, layout: QuestionLayout, active: np.ndarray) -> List[Dict[str, Any]]:
+        """Porcentaje de aciertos, blancos y marcas múltiples y recuento de cada opción por pregunta"""
+        sheets = max(1, len(self.score))
+        correct = (self.correct.sum(axis=0) / sheets).round(4).tolist()
+        blank = (self.blank.sum(axis=0) / sheets).round(4).tolist()
+        multiple = (self.multiple.sum(axis=0) / sheets).round(4).tolist()
+        counts = self.option_counts.tolist()
+        return [
+            {'question': question, 'graded': bool(active[q]), 'correct_rate': correct[q],
+             'blank_rate': blank[q], 'multiple_rate': multiple[q],
+             'options': {option: counts[q][o] for o, option in enumerate(layout.options) if layout.valid[q, o]}}
+            for q, question in enumerate(layout.questions)
+        ]
+
+def grade(marks: np.ndarray, key: AnswerKey) -> GradeResult:
+    """
+    Puntuar todas las hojas en una sola pasada
+
+    Una pregunta es correcta si el conjunto de opciones marcadas coincide
+    exactamente con el de la clave; errónea si tiene alguna marca y no es
+    correcta (con `multiple='blank'`, las de marca múltiple no penalizan).
+
+    Args:
+        marks: Tensor booleano (hojas, preguntas, opciones)
+        key: Clave alineada con los mismos ejes
+    """
+    counts = marks.sum(axis=2)
+    active = key.active[np.newaxis, :]
+    blank = (counts == 0) & active
+    multiple = (counts > np.maximum(key.key_counts, 1)[np.newaxis, :]) & active
+    correct = (marks == key.key[np.newaxis]).all(axis=2) & ~blank & active
+    wrong = active & ~blank & ~correct
+    if key.multiple == 'blank':
+        wrong &= ~multiple
+
+    score = correct @ key.weights - wrong @ key.penalties
+    max_score = key.max_score
+    scaled = score / max_score * key.scale if key.scale and max_score else None
+    return GradeResult(score, scaled, correct, wrong, blank, multiple,
+                       marks.sum(axis=0, dtype=np.int64), max_score)
+
+_marks_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_marks_lock = threading.Lock()
+
+def session_marks(session, refresh: bool = False) -> SheetMarks:
+    """
+    Tensor de marcas de una sesión, a partir de los resultados guardados
+
+    En una sesión de lote se reúnen las hojas de todas sus páginas; en otra
+    sesión, la propia hoja (con los resultados guardados por los endpoints de
+    reconocimiento). El tensor de un lote se guarda en caché mientras no
+    cambien su lista de páginas ni su versión de resultados, que cambia al
+    reconocer de nuevo alguna de sus páginas.
+
+    Args:
+        session: Sesión de lote o de página
+        refresh: Reconstruir el tensor aunque esté en caché
+    """
+    pages = tuple(session.page_sessions)
+    key = (pages, session.results_version)
+    if pages and not refresh:
+        with _marks_lock:
+            cached = _marks_cache.get(session.id)
+            if cached is not None and cached[0] == key:
+                _marks_cache.move_to_end(session.id)
+                return cached[1]
+
+    layout = QuestionLayout.for_session(session)
+    if not pages:
+        return SheetMarks.from_results(layout, [session.results or {}],
+                                       [{'session_id': session.id, 'page': session.page_number}])
+
+    results, sheets = [], []
+    for page_id in pages:
+        page_session = get_session(page_id)
+        results.append(page_session.results if page_session is not None else {})
+        sheets.append({'session_id': page_id,
+                       'page': page_session.page_number if page_session is not None else None})
+    sheet_marks = SheetMarks.from_results(layout, results, sheets)
+    logger.info(f"Tensor de marcas del lote {session.id}: {sheet_marks.marks.shape} "
+                f"({len(sheet_marks.missing)} hojas sin resultados)")
+
+    with _marks_lock:
+        _marks_cache[session.id] = (key, sheet_marks)
+        _marks_cache.move_to_end(session.id)
+        while len(_marks_cache) > settings.GRADING_CACHE_SIZE:
+            _marks_cache.popitem(last=False)
+    return sheet_marks
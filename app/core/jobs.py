@@ -0,0 +1,243 @@
+"""
+Trabajos de reconocimiento en segundo plano.
+
+Un trabajo se registra en un almacén acotado (número máximo de entradas y
+TTL para los terminados) y se ejecuta en un pool de hilos compartido, de
+modo que la petición HTTP que lo crea responde de inmediato y el número de
+reconocimientos simultáneos no depende de los hilos del servidor web.
+"""
+
+import uuid
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Callable, Iterator, Tuple
+from app.config import settings
+from app.core.utils.metrics import register_gauge
+
+logger = logging.getLogger(__name__)
+
+# Estados de un trabajo
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+FINISHED_STATES = (COMPLETED, FAILED)
+
+class JobStoreFull(Exception):
+    """No hay hueco para más trabajos: todos los guardados siguen activos"""
+
+class Job:
+    """Estado y resultados de un trabajo en segundo plano"""
+
+    def __init__(self, kind: str, session_id: str = None):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.session_id = session_id
+        self.status = QUEUED
+        self.progress = {'stage': None, 'completed': 0, 'total': 0}
+        self.results = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._events = []  # (evento, datos) en orden de emisión
+        self._lock = threading.Condition()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def set_progress(self, stage: str = None, completed: int = None, total: int = None):
+        """Actualizar el progreso del trabajo"""
+        with self._lock:
+            if stage is not None:
+                self.progress['stage'] = stage
+            if completed is not None:
+                self.progress['completed'] = completed
+            if total is not None:
+                self.progress['total'] = total
+
+    def emit(self, event: str, data: Any):
+        """Publicar un evento para los clientes que siguen el trabajo"""
+        with self._lock:
+            self._events.append((event, data))
+            self._lock.notify_all()
+
+    def iter_events(self, start: int = 0, timeout: float = None) -> Iterator[Tuple[int, Optional[str], Any]]:
+        """
+        Recorrer los eventos del trabajo, esperando a los nuevos hasta que termine
+
+        Args:
+            start: Índice del primer evento (permite reanudar tras reconectar)
+            timeout: Segundos de espera sin eventos antes de devolver un
+                     evento vacío (para mantener viva la conexión)
+
+        Yields:
+            Tuplas (índice, evento, datos); evento es None si expiró la espera
+        """
+        index = start
+        while True:
+            with self._lock:
+                if index >= len(self._events) and not self.finished:
+                    self._lock.wait(timeout)
+                pending = self._events[index:]
+                finished = self.finished
+
+            for event, data in pending:
+                yield index, event, data
+                index += 1
+
+            if finished and index >= len(self._events):
+                return
+            if not pending:
+                yield index, None, None
+
+    def _start(self):
+        with self._lock:
+            self.status = RUNNING
+            self.started_at = time.time()
+
+    def _finish(self, results: Any = None, error: str = None):
+        with self._lock:
+            self.results = results
+            self.error = error
+            self.status = FAILED if error is not None else COMPLETED
+            self.finished_at = time.time()
+            self._lock.notify_all()
+
+    def to_dict(self, include_results: bool = True) -> Dict[str, Any]:
+        """Convierte el trabajo a diccionario"""
+        with self._lock:
+            data = {
+                'job_id': self.id,
+                'kind': self.kind,
+                'session_id': self.session_id,
+                'status': self.status,
+                'progress': dict(self.progress),
+                'results': self.results,
+                'error': self.error,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at
+            }
+            if not include_results:
+                del data['results']
+            return data
+
+class JobStore:
+    """
+    Almacén de trabajos acotado en tamaño y con caducidad
+
+    Los trabajos terminados caducan `ttl` segundos después de terminar. Si se
+    alcanza `max_entries`, se descartan primero los terminados más antiguos;
+    los trabajos activos nunca se descartan.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, job: Job):
+        """
+        Registrar un trabajo nuevo
+
+        Raises:
+            JobStoreFull: Si el almacén está lleno de trabajos activos
+        """
+        with self._lock:
+            self._purge_expired()
+            if len(self._jobs) >= self.max_entries:
+                self._evict_finished(len(self._jobs) - self.max_entries + 1)
+            if len(self._jobs) >= self.max_entries:
+                raise JobStoreFull(f"Hay {len(self._jobs)} trabajos activos. Máximo permitido: {self.max_entries}")
+            self._jobs[job.id] = job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Obtener un trabajo si existe y no ha caducado"""
+        with self._lock:
+            self._purge_expired()
+            return self._jobs.get(job_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def count(self, status: str) -> int:
+        """Número de trabajos guardados en un estado"""
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.status == status)
+
+    def _purge_expired(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and now - job.finished_at > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+        if expired:
+            logger.debug(f"Eliminados {len(expired)} trabajos caducados")
+
+    def _evict_finished(self, count: int):
+        evicted = [job_id for job_id, job in self._jobs.items() if job.finished][:count]
+        for job_id in evicted:
+            del self._jobs[job_id]
+        if evicted:
+            logger.info(f"Descartados {len(evicted)} trabajos terminados por falta de espacio")
+
+store = JobStore(settings.JOB_MAX_ENTRIES, settings.JOB_TTL)
+
+register_gauge('omr_jobs_queued', 'Trabajos en cola esperando un hilo libre', lambda: store.count(QUEUED))
+register_gauge('omr_jobs_running', 'Trabajos en ejecución', lambda: store.count(RUNNING))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor() -> ThreadPoolExecutor:
+    """Obtener el pool de hilos de los trabajos, creándolo si no existe"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.JOB_WORKERS, thread_name_prefix='job')
+        return _executor
+
+def submit_job(kind: str, func: Callable[..., Any], *args, session_id: str = None, **kwargs) -> Job:
+    """
+    Crear un trabajo y encolarlo en el pool
+
+    Args:
+        kind: Tipo de trabajo (p. ej. 'recognize')
+        func: Función a ejecutar; recibe el Job como primer argumento para
+              informar del progreso y devuelve los resultados
+        session_id: Sesión a la que pertenece el trabajo
+
+    Returns:
+        Job registrado, en estado 'queued'
+
+    Raises:
+        JobStoreFull: Si no hay hueco para más trabajos
+    """
+    job = Job(kind, session_id=session_id)
+    store.add(job)
+
+    def run():
+        job._start()
+        logger.info(f"Trabajo {job.id} ({kind}) iniciado")
+        try:
+            job._finish(results=func(job, *args, **kwargs))
+            logger.info(f"Trabajo {job.id} completado en {job.finished_at - job.started_at:.2f}s")
+        except Exception as e:
+            logger.error(f"Error en el trabajo {job.id}: {e}", exc_info=True)
+            job._finish(error=str(e))
+
+    get_executor().submit(run)
+    logger.info(f"Trabajo {job.id} ({kind}) encolado")
+    return job
+
+def get_job(job_id: str) -> Optional[Job]:
+    """Obtener un trabajo por su ID"""
+    return store.get(job_id)
\ No newline at end of file
@@ -0,0 +1,684 @@
+"""
+Etapas de reconocimiento reutilizables fuera de una petición HTTP.
+
+Los endpoints de `app.api.processing` y el modo lote de `/api/upload-pdf`
+comparten estas funciones para extraer ROIs y ejecutar las etapas de marcas
+y texto sobre la imagen de una sesión.
+"""
+
+import os
+import logging
+from collections import deque
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import cv2
+import numpy as np
+from PIL import Image
+from typing import Dict, Any, Tuple, List, Iterator, Callable, Optional
+from app.config import settings
+from app.session import create_session, save_session
+from app.core.utils.pdf_utils import iter_page_images, get_page_count
+from app.core.utils.page_cache import write_page, get_page, page_version, GRAY
+from app.core.utils.page_pool import get_page_pool
+from app.core.utils.metrics import span
+from app.core.utils.async_utils import (
+    DeadlineExceeded, TaskExecutor, current_deadline, check_deadline, time_budget, allows_optional,
+    get_task_executor
+)
+from app.core.processors.registry import get_mark_processor, get_handwriting_processor
+from app.core.processors.integral import IntegralMarkIndex
+from app.core.template_cache import is_text_field, is_mark_field, get_session_template
+from app.core.registration import register_page
+from app.core.dni import DniGrid, DniDecode, decode_dni
+
+logger = logging.getLogger(__name__)
+
+def split_fields(fields: List[str], template=None) -> Tuple[List[str], List[str]]:
+    """
+    Separar campos en texto y marcas
+
+    Args:
+        fields: Campos a separar
+        template: Plantilla compilada opcional con los tipos ya calculados
+
+    Returns:
+        Tupla (campos_texto, campos_marca)
+    """
+    if template is not None:
+        return template.split(fields)
+    text_fields = []
+    mark_fields = []
+    for field in fields:
+        if is_mark_field(field):
+            mark_fields.append(field)
+        else:
+            text_fields.append(field)
+    return text_fields, mark_fields
+
+def plan_fields(fields: List[str], template=None) -> Tuple[List[str], List[str], Optional[DniGrid]]:
+    """
+    Separar campos en texto y marcas, leyendo el DNI de su rejilla si se puede
+
+    Si se pide el campo 'DNI' y la plantilla tiene completa la rejilla
+    D{fila}{columna} (con DNI_GRID_DECODE activo), el DNI sale de la etapa de
+    texto y las casillas de la rejilla se añaden a las de marca.
+
+    Returns:
+        Tupla (campos_texto, campos_marca, rejilla del DNI o None)
+    """
+    text_fields, mark_fields = split_fields(fields, template)
+    grid = DniGrid.for_template(template) if settings.DNI_GRID_DECODE and 'DNI' in text_fields else None
+    if grid is not None:
+        text_fields = [field for field in text_fields if field != 'DNI']
+        requested = set(mark_fields)
+        mark_fields = mark_fields + [field for field in grid.fields if field not in requested]
+    return text_fields, mark_fields, grid
+
+def processed_fields(fields: List[str], template=None) -> Dict[str, List[str]]:
+    """
+    Campos de texto y de marca que devuelve `recognize_page` para `fields`
+
+    El DNI leído de la rejilla se devuelve como campo de texto y las
+    casillas de la rejilla que no se pidieron no aparecen.
+    """
+    text_fields, mark_fields, grid = plan_fields(fields, template)
+    if grid is not None:
+        requested = set(fields)
+        text_fields = text_fields + ['DNI']
+        mark_fields = [field for field in mark_fields if field in requested]
+    return {"text": text_fields, "mark": mark_fields}
+
+def extract_rois(zones_info) -> Dict[str, List[int]]:
+    """
+    Extraer las ROIs {campo: [x, y, w, h]} del JSON de zonas
+
+    Args:
+        zones_info: Contenido del JSON de zonas (lista o diccionario anidado)
+
+    Returns:
+        Diccionario con las coordenadas de cada zona válida
+    """
+    rois = {}
+
+    # Función para extraer zonas recursivamente
+    def extract_zones(data, prefix=""):
+        if isinstance(data, dict):
+            if 'name' in data and all(k in data for k in ['left', 'top', 'width', 'height']):
+                field_name = data['name']
+                x = int(data.get('left', 0))
+                y = int(data.get('top', 0))
+                w = int(data.get('width', 0))
+                h = int(data.get('height', 0))
+
+                if x >= 0 and y >= 0 and w > 0 and h > 0:
+                    rois[field_name] = [x, y, w, h]
+            else:
+                for key, value in data.items():
+                    new_prefix = f"{prefix}.{key}" if prefix else key
+                    extract_zones(value, new_prefix)
+        elif isinstance(data, list):
+            for i, item in enumerate(data):
+                new_prefix = f"{prefix}[{i}]"
+                extract_zones(item, new_prefix)
+
+    # Procesar zonas según su formato
+    if isinstance(zones_info, list):
+        for zone in zones_info:
+            extract_zones(zone)
+    else:
+        extract_zones(zones_info)
+
+    return rois
+
+def session_rois(session) -> Dict[str, List[int]]:
+    """
+    Obtener las ROIs de una sesión
+
+    Con plantilla compilada se devuelven sus ROIs (compartidas entre las
+    sesiones de la misma plantilla); si no, se extraen del JSON de zonas.
+    """
+    template = get_session_template(session)
+    if template is not None:
+        return template.rois
+    return extract_rois(session.zones_info)
+
+def collect_rois(session, image: np.ndarray, fields: List[str], kind: str = "") -> Tuple[List[np.ndarray], List[str], List[Tuple[int, int, int, int]]]:
+    """
+    Recortar de la imagen las ROIs de los campos indicados
+
+    Args:
+        session: Sesión con las ROIs calculadas
+        image: Imagen de la página
+        fields: Campos a recortar
+        kind: Descripción del tipo de campo para los mensajes de log
+
+    Returns:
+        Tupla (rois, campos, rectángulos) con solo los campos válidos
+    """
+    rois = []
+    roi_fields = []
+    rects = []
+    label = f"{kind} " if kind else ""
+
+    for field in fields:
+        if field in session.rois:
+            x, y, w, h = map(int, session.rois[field])
+            roi = image[y:y+h, x:x+w]
+            if roi is not None and roi.size > 0:
+                rois.append(roi)
+                roi_fields.append(field)
+                rects.append((x, y, w, h))
+            else:
+                logger.warning(f"ROI inválida para el campo {label}{field}")
+        else:
+            logger.warning(f"Campo {label}{field} no encontrado en las ROIs disponibles")
+
+    return rois, roi_fields, rects
+
+def detect_mark_types(roi_fields: List[str], rois: List[np.ndarray]) -> Dict[str, str]:
+    """Detectar automáticamente el tipo de marca según sus dimensiones"""
+    mark_types = {}
+    for field, roi in zip(roi_fields, rois):
+        h, w = roi.shape[:2]
+        aspect_ratio = w / h if h > 0 else 1
+
+        if 0.8 <= aspect_ratio <= 1.2:  # Es casi cuadrado
+            if max(w, h) < 30:  # Es pequeño
+                mark_types[field] = 'circle'
+            else:
+                mark_types[field] = 'square'
+        else:
+            mark_types[field] = 'square'
+    return mark_types
+
+def session_gray(session, image):
+    """
+    Versión en grises de la página de la sesión, desde la caché de páginas
+
+    Evita un cvtColor por petición (o por ROI). Si la caché no la tiene o no
+    corresponde a `image`, se devuelve `image` y los procesadores convierten.
+    """
+    gray = get_page(session.image_path, GRAY) if session.image_path else None
+    return gray if gray is not None and gray.shape == image.shape[:2] else image
+
+def get_binary_page(session, image, processor):
+    """
+    Obtener la página binarizada de la sesión
+
+    La página se preprocesa una sola vez y se guarda en la sesión; se
+    recalcula solo si la imagen de la sesión cambia. La sesión se vuelve a
+    guardar para que el almacén cuente su nuevo tamaño en el presupuesto
+    (que puede descartarla en cualquier momento: ver `Session.drop_transient`).
+    """
+    source = (session.image_path, page_version(session.image_path))
+    binary_page = session.binary_page
+    if binary_page is None or session.binary_page_source != source:
+        with span('page_binarize'):
+            binary_page = processor.preprocess_page(session_gray(session, image))
+        session.binary_page = binary_page
+        session.binary_page_source = source
+        save_session(session)
+        logger.info(f"Página binarizada guardada en sesión {session.id}")
+    return binary_page
+
+def bounding_rect(rects) -> Tuple[int, int, int, int]:
+    """Obtener el rectángulo (x, y, w, h) que envuelve una lista de rectángulos"""
+    x0 = min(r[0] for r in rects)
+    y0 = min(r[1] for r in rects)
+    x1 = max(r[0] + r[2] for r in rects)
+    y1 = max(r[1] + r[3] for r in rects)
+    return x0, y0, x1 - x0, y1 - y0
+
+def get_mark_index(session, image, processor, rects):
+    """
+    Obtener el índice integral de la página binarizada de la sesión
+
+    El índice cubre la caja que envuelve todas las zonas de marca de la
+    sesión, de modo que se construye una vez y sirve para cualquier
+    subconjunto de campos. Como la página binarizada, cuenta en el
+    presupuesto de memoria de las sesiones.
+    """
+    binary_page = get_binary_page(session, image, processor)
+    index = session.mark_index
+    if (index is None or session.mark_index_source != session.binary_page_source
+            or not all(index.contains(rect) for rect in rects)):
+        template = get_session_template(session)
+        if template is not None and template.mark_bounds is not None:
+            zone_rects = [template.mark_bounds] + list(rects)
+        else:
+            zone_rects = [session.rois[f] for f in session.mark_fields if f in session.rois] + list(rects)
+        index = IntegralMarkIndex(binary_page, bounding_rect(zone_rects))
+        session.mark_index = index
+        session.mark_index_source = session.binary_page_source
+        save_session(session)
+    return index
+
+def score_marks(processor, image, rois, roi_fields, rects, debug_dir: str,
+                preprocess_mode: str = None, scorer: str = None, session=None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Puntuar ROIs de marca con un procesador dado
+
+    Es el núcleo común de la ejecución en proceso y de los workers del pool
+    de páginas. Con sesión, la página binarizada y el índice integral se
+    reutilizan de la sesión; sin ella se calculan para esta llamada.
+
+    Args:
+        processor: MarkProcessor a usar (compartido; no se modifica)
+        image: Imagen de la página
+        rois, roi_fields, rects: Salida de `collect_rois`
+        debug_dir: Carpeta para imágenes de debug
+        preprocess_mode: 'roi' o 'page' (por defecto MARK_PREPROCESS_MODE)
+        scorer: 'default' o 'integral' (por defecto MARK_SCORER)
+        session: Sesión opcional donde cachear la página binarizada
+
+    Returns:
+        Tupla (resultados_simples, resultados_detallados) de `process_batch`
+    """
+    scorer = scorer or settings.MARK_SCORER
+    # El scorer 'integral' trabaja siempre sobre la página binarizada
+    preprocess_mode = 'page' if scorer == 'integral' else (preprocess_mode or settings.MARK_PREPROCESS_MODE)
+
+    # Las imágenes de debug son opcionales: se omiten si queda poco plazo
+    if debug_dir and not allows_optional():
+        logger.warning("Sin margen en el plazo de la petición: se omiten las imágenes de debug")
+        debug_dir = None
+
+    # En modo página, binarizar la página una vez y recortar de ella
+    binary_page = None
+    if preprocess_mode == 'page':
+        try:
+            if session is not None:
+                binary_page = get_binary_page(session, image, processor)
+            else:
+                binary_page = processor.preprocess_page(image)
+        except Exception as e:
+            logger.error(f"Error binarizando la página, se preprocesará por ROI: {e}", exc_info=True)
+            scorer = 'default'
+    binary_rois = [binary_page[y:y+h, x:x+w] if binary_page is not None else None for (x, y, w, h) in rects]
+
+    mark_index = None
+    if scorer == 'integral' and rects:
+        if session is not None:
+            mark_index = get_mark_index(session, image, processor, rects)
+        else:
+            mark_index = IntegralMarkIndex(binary_page, bounding_rect(rects))
+    check_deadline('la puntuación de marcas')
+    return processor.process_batch(rois, roi_fields, binary_rois, mark_index, rects,
+                                   mark_types=detect_mark_types(roi_fields, rois), debug_folder=debug_dir)
+
+def get_debug_dir(session) -> str:
+    """Obtener (y crear) la carpeta de debug de una sesión"""
+    debug_dir = os.path.join(settings.RESULTS_FOLDER, f"debug_{session.id}")
+    os.makedirs(debug_dir, exist_ok=True)
+    return debug_dir
+
+def run_marks(session, image, rois, roi_fields, rects, preprocess_mode: str = None, scorer: str = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Ejecutar la etapa de marcas sobre ROIs ya recortadas
+
+    Args:
+        session: Sesión de la página
+        image: Imagen de la página
+        rois, roi_fields, rects: Salida de `collect_rois`
+        preprocess_mode: 'roi' o 'page' (por defecto MARK_PREPROCESS_MODE)
+        scorer: 'default' o 'integral' (por defecto MARK_SCORER)
+
+    Returns:
+        Tupla (resultados_simples, resultados_detallados) de `process_batch`
+    """
+    check_deadline('las marcas')
+    # Recortar de la página en grises cacheada: el procesador no tiene que convertir cada ROI
+    gray = session_gray(session, image)
+    if gray is not image:
+        rois = [gray[y:y+h, x:x+w] for (x, y, w, h) in rects]
+    with span('marks'):
+        return score_marks(
+            get_mark_processor(), image, rois, roi_fields, rects, get_debug_dir(session),
+            preprocess_mode, scorer, session=session
+        )
+
+def run_text(session, rois, roi_fields) -> Dict[str, str]:
+    """Ejecutar la etapa de texto manuscrito con Claude"""
+    check_deadline('el texto')
+    with span('text'):
+        return get_handwriting_processor().process_batch(rois, roi_fields, session.id)
+
+def submit_page_marks(pool, session, image, fields: List[str], preprocess_mode: str = None, scorer: str = None):
+    """
+    Enviar la etapa de marcas de una página al pool de procesos
+
+    Returns:
+        Future con (resultados_simples, resultados_detallados), o None si la
+        página no tiene ROIs de marca válidas
+    """
+    _, mark_fields, _ = plan_fields(fields, get_session_template(session))
+    _, mark_roi_fields, mark_rects = collect_rois(session, image, mark_fields, "de marca")
+    if not mark_roi_fields:
+        return None
+    return pool.submit_marks(image, mark_rects, mark_roi_fields, get_debug_dir(session), preprocess_mode, scorer)
+
+def start_dni(session, image, grid: DniGrid, mark_results: Dict[str, Any]):
+    """
+    Leer el DNI de la rejilla y, si es ambiguo, lanzar la lectura manuscrita
+
+    Returns:
+        Tupla (lectura de la rejilla, Future de `run_text` con el campo 'DNI'
+        o None si no hace falta o la plantilla no tiene zona de DNI)
+    """
+    decode = decode_dni(grid, mark_results)
+    if not decode.ambiguous:
+        logger.info(f"DNI leído de la rejilla: {decode.value}")
+        return decode, None
+
+    rois, roi_fields, _ = collect_rois(session, image, ['DNI'], "de texto")
+    if not rois:
+        logger.warning(f"DNI ambiguo en la rejilla ({decode.digits}) y sin zona manuscrita")
+        return decode, None
+    logger.info(f"DNI ambiguo en la rejilla ({decode.digits}): se lee como manuscrito")
+    return decode, get_task_executor().submit(run_text, session, rois, roi_fields)
+
+def finish_dni(decode: Optional[DniDecode], future) -> Dict[str, Any]:
+    """Resultado del campo DNI: el de la rejilla o, si era ambiguo, el manuscrito"""
+    if decode is None:
+        # Sin etapa de marcas no hay rejilla que leer
+        decode = DniDecode('?' * 8, ['blank'] * 8, 0.0)
+    if future is None:
+        return decode.to_result()
+    try:
+        with span('text_wait'):
+            value = future.result().get('DNI')
+    except Exception as e:
+        logger.warning(f"Lectura manuscrita del DNI fallida: {e}")
+        value = None
+    if value is None:
+        return decode.to_result()
+    return {
+        'type': 'text',
+        'value': value,
+        'confidence': 0.95,  # Valor por defecto para Claude
+        'source': 'handwriting',
+        'grid': decode.summary()
+    }
+
+def recognize_page(session, image, fields: List[str], preprocess_mode: str = None, scorer: str = None,
+                   mark_future=None, on_stage: Callable[[str, Dict[str, Any]], None] = None) -> Dict[str, Any]:
+    """
+    Reconocer texto y marcas de una página
+
+    Si hay campos de ambos tipos, la etapa de texto (la más lenta, espera a
+    Claude) arranca primero en el ejecutor compartido y las marcas se
+    puntúan mientras tanto en este hilo, de modo que la página tarda
+    aproximadamente lo que la más lenta de las dos. `on_stage` se sigue
+    llamando con las marcas antes que con el texto.
+
+    El DNI se lee de su rejilla de marcas cuando la plantilla la tiene (ver
+    `plan_fields`); solo si alguna columna es ambigua se envía su zona a
+    Claude, solapada con el resto del texto.
+
+    Los errores de una etapa se registran y no impiden devolver los
+    resultados de la otra. Lo mismo ocurre si vence el plazo de la petición
+    (ver `app.core.utils.async_utils`): se devuelven las etapas terminadas.
+
+    Args:
+        session: Sesión con las ROIs calculadas
+        image: Imagen de la página
+        fields: Campos a reconocer
+        preprocess_mode: Modo de preprocesamiento de marcas
+        scorer: Scorer de marcas
+        mark_future: Future de `submit_page_marks` si las marcas ya se
+                     enviaron al pool de procesos
+        on_stage: Función opcional llamada al terminar cada etapa con
+                  ('marks' o 'text', resultados de la etapa)
+
+    Returns:
+        Diccionario {campo: resultado} con 'type' 'mark' o 'text'
+    """
+    text_fields, mark_fields, dni_grid = plan_fields(fields, get_session_template(session))
+    combined_results = {}
+
+    # Lanzar el texto antes que las marcas para solapar ambas etapas
+    text_future = None
+    text_rois = []
+    if text_fields:
+        logger.info(f"Procesando {len(text_fields)} campos de texto: {text_fields}")
+        text_rois, text_roi_fields, _ = collect_rois(session, image, text_fields, "de texto")
+        if text_rois and mark_fields:
+            text_future = get_task_executor().submit(run_text, session, text_rois, text_roi_fields)
+
+    # Procesar marcas si hay campos de ese tipo
+    if mark_fields:
+        logger.info(f"Procesando {len(mark_fields)} campos de marca: {mark_fields[:5]}...")
+        if mark_future is not None:
+            mark_rois = [mark_future]
+        else:
+            mark_rois, mark_roi_fields, mark_rects = collect_rois(session, image, mark_fields, "de marca")
+
+        if mark_rois:
+            try:
+                if mark_future is not None:
+                    with span('marks_wait'):
+                        try:
+                            results_dict, details = mark_future.result(timeout=time_budget())
+                        except FutureTimeoutError:
+                            mark_future.cancel()
+                            raise DeadlineExceeded("Plazo agotado esperando las marcas")
+                else:
+                    results_dict, details = run_marks(
+                        session, image, mark_rois, mark_roi_fields, mark_rects, preprocess_mode, scorer
+                    )
+
+                # Formatear resultados para el frontend
+                for field_name, is_marked in results_dict.items():
+                    detail = details.get(field_name, {})
+                    percentage = detail.get('percentage', 0.0)
+
+                    combined_results[field_name] = {
+                        'type': 'mark',
+                        'value': 'MARCADO' if is_marked else 'NO MARCADO',
+                        'marked': is_marked,
+                        'confidence': percentage / 100.0,
+                        'percentage': percentage
+                    }
+
+                logger.info(f"Procesados {len(results_dict)} campos de marca")
+            except DeadlineExceeded as e:
+                logger.warning(f"Etapa de marcas omitida: {e}")
+            except Exception as e:
+                logger.error(f"Error procesando marcas: {e}", exc_info=True)
+
+        # DNI desde la rejilla; las casillas que no se pidieron no se devuelven
+        dni_decode, dni_future = None, None
+        if dni_grid is not None:
+            dni_decode, dni_future = start_dni(session, image, dni_grid, combined_results)
+            requested = set(fields)
+            for field in dni_grid.fields:
+                if field not in requested:
+                    combined_results.pop(field, None)
+
+        if on_stage:
+            on_stage('marks', {field: result for field, result in combined_results.items() if result['type'] == 'mark'})
+
+    # Recoger el texto si hay campos de ese tipo
+    if text_fields or dni_grid is not None:
+        if text_rois:
+            try:
+                if text_future is not None:
+                    with span('text_wait'):
+                        text_results = text_future.result()
+                else:
+                    text_results = run_text(session, text_rois, text_roi_fields)
+
+                # Integrar resultados de texto
+                for field, value in text_results.items():
+                    combined_results[field] = {
+                        'type': 'text',
+                        'value': value,
+                        'confidence': 0.95  # Valor por defecto para Claude
+                    }
+
+                logger.info(f"Procesados {len(text_results)} campos de texto")
+            except DeadlineExceeded as e:
+                logger.warning(f"Etapa de texto omitida: {e}")
+            except Exception as e:
+                logger.error(f"Error procesando texto: {e}", exc_info=True)
+
+        if dni_grid is not None:
+            combined_results['DNI'] = finish_dni(dni_decode, dni_future)
+
+        if on_stage:
+            on_stage('text', {field: result for field, result in combined_results.items() if result['type'] == 'text'})
+
+    return combined_results
+
+def create_page_session(parent, page_number: int, page_image) -> Any:
+    """
+    Crear la sesión de una página de un PDF multipágina
+
+    La sesión hereda la plantilla y las ROIs de la sesión padre, y guarda la
+    página como imagen PNG sin pérdida y como PDF de una página, de modo que
+    los endpoints habituales pueden volver a procesarla por separado.
+
+    Args:
+        parent: Sesión del lote (con el JSON de zonas cargado)
+        page_number: Número de página dentro del PDF
+        page_image: Imagen BGR de la página con el tamaño de las plantillas
+
+    Returns:
+        Nueva sesión de la página
+    """
+    page_session = create_session()
+    page_session.update(
+        json_path=parent.json_path,
+        template_hash=parent.template_hash,
+        zones_info=parent.zones_info,
+        text_fields=parent.text_fields,
+        mark_fields=parent.mark_fields,
+        rois=parent.rois,
+        parent_id=parent.id,
+        page_number=page_number,
+        is_pdf=True
+    )
+    page_session.add_completed_step('json_upload')
+
+    # Guardar la página como imagen y como PDF de una sola página
+    image_path = os.path.join(settings.UPLOAD_FOLDER, f"{page_session.id}_converted.png")
+    write_page(image_path, page_image)
+    pdf_path = os.path.join(settings.UPLOAD_FOLDER, f"{page_session.id}_page.pdf")
+    Image.fromarray(cv2.cvtColor(page_image, cv2.COLOR_BGR2RGB)).save(pdf_path, 'PDF', resolution=settings.PDF_DPI)
+
+    page_session.image_path = image_path
+    page_session.pdf_path = pdf_path
+    page_session.add_completed_step('pdf_upload')
+    save_session(page_session)
+    return page_session
+
+def iter_batch_pages(session, pdf_path: str, fields: List[str], last_page: int = None,
+                     preprocess_mode: str = None, scorer: str = None) -> Iterator[Dict[str, Any]]:
+    """
+    Procesar un PDF multipágina página a página contra una misma plantilla
+
+    Las páginas se renderizan de forma perezosa (ver `iter_page_images`), cada
+    una en su propia sesión, y pasan por las etapas de marcas y texto.
+
+    Todo el lote comparte el plazo actual. Una página que no llega a
+    empezar o que termina con el plazo vencido (con resultados incompletos)
+    se devuelve con 'error', y las que quedan por renderizar también.
+
+    Args:
+        session: Sesión del lote con el JSON de zonas cargado
+        pdf_path: Ruta al PDF multipágina
+        fields: Campos a reconocer en cada página
+        last_page: Última página a procesar (por defecto, todas)
+        preprocess_mode: Modo de preprocesamiento de marcas
+        scorer: Scorer de marcas
+
+    Yields:
+        Diccionario por página con 'page', 'session_id', 'image_path' y
+        'results' (o 'error' si la página no se pudo procesar)
+    """
+    if not session.rois:
+        session.rois = session_rois(session)
+
+    # Con pool de procesos se mantienen tantas páginas en vuelo como workers:
+    # las marcas se puntúan en paralelo mientras este hilo renderiza las
+    # páginas siguientes. Con campos de texto, además, la etapa de texto de
+    # varias páginas espera a Claude a la vez (hasta CLAUDE_MAX_IN_FLIGHT).
+    pool = get_page_pool()
+    text_fields, _ = split_fields(fields, get_session_template(session))
+    text_workers = settings.CLAUDE_MAX_IN_FLIGHT if text_fields else 1
+    window = max(pool.workers if pool is not None else 1, text_workers)
+    # Ejecutor propio: las páginas envían su texto al compartido y no deben ocupar sus hilos
+    executor = TaskExecutor(text_workers, name='batch-page') if text_workers > 1 else None
+    deadline = current_deadline()
+    pending = deque()
+
+    def finish(page_number, page_session, image, mark_future):
+        try:
+            check_deadline(f"la página {page_number}")
+            results = recognize_page(page_session, image, fields, preprocess_mode, scorer, mark_future) if fields else {}
+            # El lote cambia de páginas al terminar, no hace falta cambiar su versión
+            page_session.store_results(results)
+            save_session(page_session)
+            if deadline.expired():
+                raise DeadlineExceeded(f"Plazo agotado procesando la página {page_number}: resultados incompletos")
+            logger.info(f"Página {page_number} procesada: {len(results)} campos")
+            return {
+                'page': page_number,
+                'session_id': page_session.id,
+                'image_path': page_session.image_path,
+                'results': results
+            }
+        except DeadlineExceeded as e:
+            logger.warning(str(e))
+            return {'page': page_number, 'session_id': page_session.id, 'error': str(e)}
+        except Exception as e:
+            logger.error(f"Error procesando la página {page_number}: {e}", exc_info=True)
+            return {'page': page_number, 'error': str(e)}
+
+    def start(page_number, page_session, image):
+        mark_future = None
+        if pool is not None:
+            mark_future = submit_page_marks(pool, page_session, image, fields, preprocess_mode, scorer)
+        if executor is not None:
+            return page_number, page_session, executor.submit(finish, page_number, page_session, image, mark_future)
+        return page_number, page_session, image, mark_future
+
+    def collect(item):
+        if executor is None:
+            return finish(*item)
+        page_number, page_session, future = item
+        try:
+            return future.result()
+        except DeadlineExceeded as e:
+            # El ejecutor no llegó a empezar la página
+            logger.warning(f"Página {page_number} omitida: {e}")
+            return {'page': page_number, 'session_id': page_session.id, 'error': str(e)}
+
+    try:
+        next_page = 1
+        for page_number, image in iter_page_images(pdf_path, last_page=last_page):
+            if deadline.expired():
+                break
+            next_page = page_number + 1
+            try:
+                image = register_page(image, session.template_hash).image
+                page_session = create_page_session(session, page_number, image)
+                session.page_sessions.append(page_session.id)
+            except Exception as e:
+                logger.error(f"Error procesando la página {page_number}: {e}", exc_info=True)
+                yield {'page': page_number, 'error': str(e)}
+                continue
+
+            pending.append(start(page_number, page_session, image))
+            while len(pending) >= window:
+                yield collect(pending.popleft())
+
+        while pending:
+            yield collect(pending.popleft())
+
+        # Con el plazo vencido no se renderizan las páginas restantes
+        if deadline.expired():
+            for page_number in range(next_page, (last_page or get_page_count(pdf_path)) + 1):
+                yield {'page': page_number, 'error': "Plazo agotado antes de procesar la página"}
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
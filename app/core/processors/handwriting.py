@@ -1,48 +1,138 @@
 import os
 import json
 import logging
-import anthropic
 import cv2
 import base64
 import numpy as np
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 from app.config import settings
-from app.core.utils.async_utils import process_with_timeout
+from app.core.utils.claude_client import get_claude_gateway
+from app.core.utils.metrics import span
+from app.core.utils.async_utils import DeadlineExceeded, time_budget, allows_optional
+from app.core.utils.text_cache import get_text_cache, hash_roi, hash_file, hash_text, make_key
 from . import BaseProcessor
 from app.session import SessionManager
 
 logger = logging.getLogger(__name__)
 
+MODES = ('montage', 'document')
+
+# Tira de recortes: ancho máximo recomendado por Claude y alto máximo de imagen
+MONTAGE_MAX_WIDTH = 1568
+MONTAGE_MAX_HEIGHT = 7990
+MONTAGE_LABEL_WIDTH = 240  # Columna con el nombre de cada campo
+MONTAGE_MIN_ROW_HEIGHT = 32
+MONTAGE_PADDING = 8
+MONTAGE_JPEG_QUALITY = 90
+
+def parse_response_json(text: str) -> Dict[str, Any]:
+    """
+    Interpretar el JSON de una respuesta de Claude
+
+    Si el texto no es un JSON válido se intenta con el objeto entre la
+    primera '{' y la última '}' (respuestas envueltas en ```json o con
+    texto alrededor).
+
+    Raises:
+        json.JSONDecodeError: Si no se encuentra un JSON válido
+    """
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        start, end = text.find('{'), text.rfind('}')
+        if start == -1 or end <= start:
+            raise
+        return json.loads(text[start:end + 1])
+
+def build_text_montage(rois: List[np.ndarray], field_names: List[str]) -> np.ndarray:
+    """
+    Componer las ROIs de texto en una tira vertical etiquetada
+
+    Cada fila lleva el nombre del campo entre corchetes y, a su derecha, el
+    recorte en escala de grises a su resolución original (reducido solo si
+    no cabe en MONTAGE_MAX_WIDTH). Las filas se separan con una línea gris.
+
+    Args:
+        rois: Recortes de los campos
+        field_names: Nombre de cada recorte
+
+    Returns:
+        Imagen en escala de grises de la tira
+    """
+    content_width = MONTAGE_MAX_WIDTH - MONTAGE_LABEL_WIDTH - 2 * MONTAGE_PADDING
+    crops = []
+    for roi in rois:
+        gray = roi if roi.ndim == 2 else cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+        h, w = gray.shape
+        if w > content_width:
+            gray = cv2.resize(gray, (content_width, max(1, round(h * content_width / w))), interpolation=cv2.INTER_AREA)
+        crops.append(gray)
+
+    width = MONTAGE_LABEL_WIDTH + max(crop.shape[1] for crop in crops) + 2 * MONTAGE_PADDING
+    rows = []
+    for crop, field_name in zip(crops, field_names):
+        h, w = crop.shape
+        row_height = max(h, MONTAGE_MIN_ROW_HEIGHT) + 2 * MONTAGE_PADDING
+        row = np.full((row_height, width), 255, dtype=np.uint8)
+
+        # Reducir la fuente si el nombre no cabe en la columna de etiquetas
+        label = f"[{field_name}]"
+        (text_width, text_height), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 2)
+        scale = min(0.7, (MONTAGE_LABEL_WIDTH - 2 * MONTAGE_PADDING) / max(text_width, 1))
+        baseline_y = (row_height + int(text_height * scale)) // 2
+        cv2.putText(row, label, (MONTAGE_PADDING, baseline_y), cv2.FONT_HERSHEY_SIMPLEX, scale, 0, 2 if scale >= 0.5 else 1)
+
+        y = (row_height - h) // 2
+        x = MONTAGE_LABEL_WIDTH + MONTAGE_PADDING
+        row[y:y + h, x:x + w] = crop
+        row[-1, :] = 160
+        rows.append(row)
+
+    montage = np.vstack(rows)
+    if montage.shape[0] > MONTAGE_MAX_HEIGHT:
+        scale = MONTAGE_MAX_HEIGHT / montage.shape[0]
+        montage = cv2.resize(montage, (max(1, int(width * scale)), MONTAGE_MAX_HEIGHT), interpolation=cv2.INTER_AREA)
+    return montage
+
 class HandwritingProcessor(BaseProcessor):
+    """
+    Reconocimiento de texto manuscrito con Claude
+
+    Los prompts se cargan y la pasarela se obtiene una sola vez al crearlo;
+    la sesión y los campos de cada petición se pasan como argumentos, así
+    que una misma instancia (ver `app.core.processors.registry`) se comparte
+    entre hilos.
+    """
     def __init__(self):
         self._client = None
-        self._text_fields = set()
-        self._claude_results = None
-        self._session_id = None
         self._initialize_client()
         self._load_prompt()
 
     def _load_prompt(self):
-        """Cargar el prompt desde el archivo"""
+        """Cargar los prompts (documento PDF y tira de recortes) desde sus archivos"""
         try:
             # Corregir la ruta para buscar en app/core/prompt.txt
-            prompt_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'prompt.txt')
+            prompt_dir = os.path.dirname(os.path.dirname(__file__))
+            prompt_path = os.path.join(prompt_dir, 'prompt.txt')
             logger.info(f"Intentando cargar prompt desde: {prompt_path}")
             with open(prompt_path, 'r', encoding='utf-8') as f:
                 self._prompt_template = f.read()
+            with open(os.path.join(prompt_dir, 'prompt_montage.txt'), 'r', encoding='utf-8') as f:
+                self._montage_prompt_template = f.read()
+            # La versión de cada prompt forma parte de la clave de la caché de resultados
+            self._prompt_versions = {
+                'document': hash_text(self._prompt_template),
+                'montage': hash_text(self._montage_prompt_template)
+            }
             logger.info("Prompt cargado exitosamente")
         except Exception as e:
             logger.error(f"Error al cargar el prompt: {e}", exc_info=True)
             raise
 
     def _initialize_client(self):
-        """Inicializar el cliente de Anthropic"""
+        """Obtener la pasarela compartida hacia Claude (ver `app.core.utils.claude_client`)"""
         try:
-            logger.info("Inicializando cliente de Anthropic")
-            api_key = os.getenv("ANTHROPIC_API_KEY")
-            if not api_key or api_key == "your_api_key_here":
-                raise ValueError("ANTHROPIC_API_KEY no está configurada en el archivo .env")
-            self._client = anthropic.Anthropic(api_key=api_key)
+            self._client = get_claude_gateway()
         except Exception as e:
             logger.error(f"Error al inicializar cliente de Anthropic: {e}", exc_info=True)
             raise
@@ -52,10 +142,6 @@ class HandwritingProcessor(BaseProcessor):
         # Ya se inicializa en el constructor
         pass
 
-    def set_text_fields(self, fields: set):
-        """Establecer los campos de texto a procesar"""
-        self._text_fields = fields
-
     def process_text(self, roi) -> str:
         """Procesar una ROI para extraer texto manuscrito"""
         try:
@@ -89,11 +175,7 @@ class HandwritingProcessor(BaseProcessor):
             }
 
             # Llamar a Claude
-            response = process_with_timeout(
-                self._client.messages.create,
-                args=message,
-                timeout=settings.CLAUDE_TIMEOUT
-            )
+            response = self._client.create(deadline=time_budget(settings.CLAUDE_DEADLINE), **message)
 
             if response and response.content:
                 return response.content[0].text.strip()
@@ -103,17 +185,22 @@ class HandwritingProcessor(BaseProcessor):
             logger.error(f"Error procesando texto: {e}", exc_info=True)
             return "ERROR"
 
-    def process(self, image, zones, session_id: str):
-        """Implementación del método abstracto"""
-        # Guardar session_id para uso posterior
-        self._session_id = session_id
-        
+    def process(self, image, zones, session_id: str, text_fields: set = None):
+        """
+        Implementación del método abstracto
+
+        Args:
+            image: Imagen de la página
+            zones: Lista de zonas (dict con 'name', 'left', 'top', 'width', 'height')
+            session_id: Sesión de la página
+            text_fields: Campos de texto a procesar (por defecto todas las zonas)
+        """
         # Extraer ROIs del texto
         rois = []
         field_names = []
         
         for zone in zones:
-            if zone['name'] not in self._text_fields:
+            if text_fields is not None and zone['name'] not in text_fields:
                 continue
                 
             x = int(zone.get('left', 0))
@@ -134,97 +221,197 @@ class HandwritingProcessor(BaseProcessor):
         # Procesar las ROIs
         return self.process_batch(rois, field_names, session_id)
 
+    def _montage_content(self, rois: List[np.ndarray], field_names: List[str]) -> List[Dict[str, Any]]:
+        """Construir el contenido del mensaje con la tira de recortes como bloque de imagen"""
+        with span('montage'):
+            montage = build_text_montage(rois, field_names)
+            _, buffer = cv2.imencode('.jpg', montage, [cv2.IMWRITE_JPEG_QUALITY, MONTAGE_JPEG_QUALITY])
+        logger.info(f"Tira de {len(field_names)} recortes: {montage.shape[1]}x{montage.shape[0]}, "
+                    f"{len(buffer) / 1024:.1f} KB")
+
+        return [
+            {
+                "type": "text",
+                "text": self._montage_prompt_template.format(fields=", ".join(field_names))
+            },
+            {
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": "image/jpeg",
+                    "data": base64.b64encode(buffer).decode('utf-8')
+                }
+            }
+        ]
+
+    def _document_content(self, file_path: str, field_names: List[str]) -> List[Dict[str, Any]]:
+        """Construir el contenido del mensaje con el PDF original como bloque de documento"""
+        logger.info(f"Usando PDF original: {file_path}")
+
+        # Verificar tamaño del archivo
+        file_size = os.path.getsize(file_path)
+        logger.info(f"Tamaño del PDF: {file_size / (1024*1024):.2f} MB")
+        if file_size > 10 * 1024 * 1024:  # 10MB
+            raise ValueError(f"El PDF es demasiado grande: {file_size / (1024*1024):.2f} MB. Máximo permitido: 10MB")
+
+        # Leer el archivo y convertirlo a base64
+        with open(file_path, "rb") as file:
+            file_base64 = base64.b64encode(file.read()).decode('utf-8')
+
+        logger.info(f"PDF convertido a base64, longitud: {len(file_base64)}")
+
+        # USANDO "document" para PDFs
+        return [
+            {
+                "type": "text",
+                "text": self._prompt_template.format(fields=", ".join(field_names))
+            },
+            {
+                "type": "document",
+                "source": {
+                    "type": "base64",
+                    "media_type": "application/pdf",
+                    "data": file_base64
+                }
+            }
+        ]
+
     def process_batch(self, rois: List[np.ndarray], field_names: List[str], session_id: str) -> Dict[str, str]:
-        """Procesa un lote de ROIs y extrae el texto usando Claude"""
+        """
+        Procesa un lote de ROIs y extrae el texto usando Claude
+
+        En modo 'montage' (HANDWRITING_MODE) se envían las ROIs ya recortadas
+        en una sola imagen etiquetada (ver `build_text_montage`). En modo
+        'document' se envía el PDF original completo; si la sesión no tiene
+        PDF (imagen subida directamente) se usa la tira de recortes.
+
+        Los campos ya reconocidos con el mismo contenido, prompt y modelo se
+        sirven desde la caché de resultados (ver `app.core.utils.text_cache`)
+        y solo los demás se envían a Claude. Si la respuesta no se puede
+        interpretar o le faltan campos, se reintentan solo esos campos hasta
+        HANDWRITING_RETRIES veces, siempre que quede margen en el plazo de la
+        petición. La espera a Claude nunca supera el tiempo restante.
+
+        Raises:
+            DeadlineExceeded: Si el plazo vence antes de obtener ningún campo
+        """
+        results = {}
         try:
             # Verificar que tenemos una sesión válida
             session = SessionManager.get_session(session_id)
             if not session:
                 raise ValueError("Sesión no válida o expirada")
-                
-            # Verificar que tenemos el archivo PDF
-            if not hasattr(session, 'pdf_path'):
-                logger.warning("La sesión no tiene atributo pdf_path, añadiendo...")
-                session.pdf_path = None
-                
-            # Verificar que el PDF está disponible
-            if not (hasattr(session, 'pdf_path') and session.pdf_path):
-                raise ValueError("No hay PDF cargado en la sesión")
-
-            # Usar el PDF original
-            file_path = session.pdf_path
-            media_type = "application/pdf"
-            logger.info(f"Usando PDF original: {file_path}")
-                
-            # Verificar tamaño del archivo
-            file_size = os.path.getsize(file_path)
-            logger.info(f"Tamaño del PDF: {file_size / (1024*1024):.2f} MB")
-            if file_size > 10 * 1024 * 1024:  # 10MB
-                raise ValueError(f"El PDF es demasiado grande: {file_size / (1024*1024):.2f} MB. Máximo permitido: 10MB")
-                
-            # Leer el archivo y convertirlo a base64
-            with open(file_path, "rb") as file:
-                file_content = file.read()
-                file_base64 = base64.b64encode(file_content).decode('utf-8')
-                
-            logger.info(f"PDF convertido a base64, longitud: {len(file_base64)}")
 
-            # Construir el mensaje con el archivo - USANDO "document" para PDFs
-            message_content = [
-                {
-                    "type": "text",
-                    "text": self._prompt_template.format(fields=", ".join(field_names))
-                },
+            if not field_names:
+                return {}
+
+            mode = settings.HANDWRITING_MODE
+            if mode not in MODES:
+                raise ValueError(f"Modo de texto manuscrito no válido: {mode}. Opciones: {', '.join(MODES)}")
+            if mode == 'document' and not getattr(session, 'pdf_path', None):
+                logger.info("La sesión no tiene PDF: se envía la tira de recortes")
+                mode = 'montage'
+
+            rois_by_field = dict(zip(field_names, rois))
+            cache = get_text_cache()
+            keys = {}
+            if cache is not None:
+                if mode == 'montage':
+                    content_hashes = {field: hash_roi(roi) for field, roi in rois_by_field.items()}
+                else:
+                    document_hash = hash_file(session.pdf_path)
+                    content_hashes = {field: document_hash for field in field_names}
+                keys = {field: make_key(content_hashes[field], field, self._prompt_versions[mode], settings.CLAUDE_MODEL)
+                        for field in field_names}
+                cached = cache.get_many(keys.values())
+                results = {field: cached[key] for field, key in keys.items() if key in cached}
+                if results:
+                    logger.info(f"{len(results)} de {len(field_names)} campos de texto servidos desde la caché")
+
+            pending = [field for field in field_names if field not in results]
+            failure = None
+            for attempt in range(settings.HANDWRITING_RETRIES + 1):
+                if not pending:
+                    break
+                if attempt and not allows_optional():
+                    logger.warning(f"Sin margen en el plazo para reintentar {len(pending)} campos de texto")
+                    break
+                if attempt:
+                    logger.warning(f"Reintentando {len(pending)} campos de texto ({attempt}/{settings.HANDWRITING_RETRIES}): {pending}")
+
+                recognized, failure = self._request_fields(mode, session, rois_by_field, pending)
+                recognized = {field: value for field, value in recognized.items() if field in pending}
+                results.update(recognized)
+                if cache is not None:
+                    cache.put_many({keys[field]: value for field, value in recognized.items()})
+                pending = [field for field in pending if field not in recognized]
+
+            # Los campos que siguen sin respuesta válida conservan el código de error
+            if failure:
+                results.update({field: failure for field in pending})
+
+            logger.info(f"Resultados procesados: {len(results)} campos")
+            return results
+
+        except DeadlineExceeded:
+            if not results:
+                raise
+            logger.warning(f"Plazo agotado: se devuelven {len(results)} campos ya reconocidos")
+            return {field: results.get(field, "ERROR: Plazo agotado") for field in field_names}
+        except Exception as e:
+            logger.error(f"Error en process_batch: {e}", exc_info=True)
+            return {field: results.get(field, f"ERROR: {str(e)}") for field in field_names}
+
+    def _request_fields(self, mode: str, session, rois_by_field: Dict[str, np.ndarray],
+                        field_names: List[str]) -> Tuple[Dict[str, str], Optional[str]]:
+        """
+        Enviar a Claude una petición con los campos indicados
+
+        Returns:
+            Tupla (resultados por campo, código de error o None). El código es
+            'ERROR_JSON' si la respuesta no es un JSON válido y 'ERROR_PROCESO'
+            si no tiene el formato esperado.
+        """
+        if mode == 'montage':
+            message_content = self._montage_content([rois_by_field[field] for field in field_names], field_names)
+        else:
+            message_content = self._document_content(session.pdf_path, field_names)
+
+        # Construir la petición completa
+        request_data = {
+            "model": settings.CLAUDE_MODEL,
+            "max_tokens": settings.CLAUDE_MAX_TOKENS,
+            "messages": [
                 {
-                    "type": "document",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "application/pdf",
-                        "data": file_base64
-                    }
+                    "role": "user",
+                    "content": message_content
                 }
             ]
+        }
 
-            # Construir la petición completa
-            request_data = {
-                "model": "claude-3-7-sonnet-20250219",
-                "max_tokens": 1000,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": message_content
-                    }
-                ]
-            }
+        logger.info(f"Enviando petición a Claude para analizar {len(field_names)} campos...")
+        # Enviar mensaje a Claude
+        with span('claude'):
+            response = self._client.create(deadline=time_budget(settings.CLAUDE_DEADLINE), **request_data)
 
-            logger.info(f"Enviando petición a Claude para analizar {len(field_names)} campos...")
-            # Enviar mensaje a Claude
-            response = self._client.messages.create(**request_data)
+        # Procesar respuesta
+        try:
+            response_text = response.content[0].text
+            logger.info(f"Respuesta de Claude recibida, longitud: {len(response_text)}")
+            logger.debug(f"Respuesta de Claude: {response_text}")
 
-            # Procesar respuesta
-            try:
-                response_text = response.content[0].text
-                logger.info(f"Respuesta de Claude recibida, longitud: {len(response_text)}")
-                logger.debug(f"Respuesta de Claude: {response_text}")
-                
-                # Convertir la respuesta a JSON
-                response_json = json.loads(response_text)
-                
-                # Convertir el formato de respuesta a un diccionario simple
-                results = {}
-                for campo in response_json.get("campos", []):
-                    results[campo["nombre"]] = campo["valor"]
-                
-                logger.info(f"Resultados procesados: {len(results)} campos")
-                return results
-                
-            except json.JSONDecodeError as e:
-                logger.error(f"Error al decodificar JSON de Claude: {e}")
-                return {field: "ERROR_JSON" for field in field_names}
-            except Exception as e:
-                logger.error(f"Error al procesar respuesta de Claude: {e}", exc_info=True)
-                return {field: "ERROR_PROCESO" for field in field_names}
+            # Convertir la respuesta a JSON
+            response_json = parse_response_json(response_text)
 
+            # Convertir el formato de respuesta a un diccionario simple
+            results = {}
+            for campo in response_json.get("campos", []):
+                results[campo["nombre"]] = campo["valor"]
+            return results, None
+
+        except json.JSONDecodeError as e:
+            logger.error(f"Error al decodificar JSON de Claude: {e}")
+            return {}, "ERROR_JSON"
         except Exception as e:
-            logger.error(f"Error en process_batch: {e}", exc_info=True)
-            return {field: f"ERROR: {str(e)}" for field in field_names}
\ No newline at end of file
+            logger.error(f"Error al procesar respuesta de Claude: {e}", exc_info=True)
+            return {}, "ERROR_PROCESO"
@@ -4,54 +4,52 @@ import numpy as np
 import logging
 from typing import Dict, Any, Tuple, List
 from app.config import settings
+from app.core.utils.debug_sink import get_debug_sink
 
 logger = logging.getLogger(__name__)
 
+class MarkContext:
+    """
+    Estado de una llamada a `MarkProcessor.process_batch`
+    
+    Los tipos de marca, la carpeta de debug y las etapas pendientes del sink
+    pertenecen a la petición y no al procesador, de modo que una misma
+    instancia (ver `app.core.processors.registry`) se comparte entre hilos.
+    """
+    def __init__(self, mark_types: Dict[str, str] = None, debug_folder: str = None):
+        self.mark_types = mark_types or {}  # {campo: 'circle' | 'square'}
+        self.debug_folder = debug_folder
+        self.debug_stages = {}  # Etapas de preprocesamiento pendientes del sink de debug
+        if debug_folder:
+            os.makedirs(debug_folder, exist_ok=True)
+
 class MarkProcessor:
     """
     Procesador mejorado para la detección de marcas OMR en formularios.
+    
+    No guarda estado de ninguna petición: los campos, tipos de marca y la
+    carpeta de debug se pasan a `process_batch`.
     """
     def __init__(self):
-        self._mark_fields = set()
-        self._debug_folder = None
-        self._mark_types = {}  # Almacena tipos de marca (círculo, cuadrado)
         self._thresholds = {}  # Umbrales específicos por campo
         self._calibration_data = {}  # Datos de calibración por tipo de formulario
+        # Máscaras circulares por tamaño de celda; compartida entre hilos (en
+        # una carrera dos hilos calculan la misma geometría y gana cualquiera)
+        self._geometry_cache = {}
         
     def initialize(self):
         """Inicializar el procesador de marcas"""
         logger.info("Inicializando procesador de marcas OMR")
         # No requiere inicialización especial más que logging
         
-    def set_mark_fields(self, fields: set):
-        """Establecer los campos de marca a procesar"""
-        self._mark_fields = fields
-        logger.info(f"Campos de marca configurados: {len(fields)} campos")
-        
-    def set_mark_types(self, mark_types: Dict[str, str]):
-        """
-        Establecer los tipos de marcas para cada campo
-        
-        Args:
-            mark_types: Diccionario {nombre_campo: tipo_marca}
-                       donde tipo_marca puede ser 'circle' o 'square'
-        """
-        self._mark_types = mark_types
-        logger.info(f"Tipos de marca configurados para {len(mark_types)} campos")
-        
-    def set_debug_folder(self, folder: str):
-        """Establecer la carpeta para guardar imágenes de debug"""
-        self._debug_folder = folder
-        os.makedirs(folder, exist_ok=True)
-        logger.info(f"Carpeta de debug configurada: {folder}")
-        
-    def preprocess_roi(self, roi, field_name: str = None) -> np.ndarray:
+    def preprocess_roi(self, roi, field_name: str = None, context: MarkContext = None) -> np.ndarray:
         """
         Preprocesar una ROI para mejorar la detección de marcas
         
         Args:
             roi: Imagen ROI en formato numpy
             field_name: Nombre del campo para opciones específicas
+            context: Estado de la petición (etapas de debug), opcional
             
         Returns:
             Imagen preprocesada
@@ -90,14 +88,16 @@ class MarkProcessor:
             kernel_close = np.ones((3,3), np.uint8)
             cleaned = cv2.morphologyEx(cleaned, cv2.MORPH_CLOSE, kernel_close)
             
-            # Guardar las etapas intermedias si estamos en modo debug
-            if self._debug_folder and field_name:
-                base_filename = f"{field_name}_"
-                cv2.imwrite(os.path.join(self._debug_folder, f"{base_filename}1_gray.png"), gray)
-                cv2.imwrite(os.path.join(self._debug_folder, f"{base_filename}2_equalized.png"), equalized)
-                cv2.imwrite(os.path.join(self._debug_folder, f"{base_filename}3_denoised.png"), denoised)
-                cv2.imwrite(os.path.join(self._debug_folder, f"{base_filename}4_binary.png"), binary)
-                cv2.imwrite(os.path.join(self._debug_folder, f"{base_filename}5_cleaned.png"), cleaned)
+            # Guardar las etapas intermedias si estamos en modo debug; el
+            # sink decide al conocer el porcentaje si se escriben
+            if context and context.debug_folder and field_name and get_debug_sink().enabled:
+                context.debug_stages[field_name] = [
+                    ('1_gray', gray),
+                    ('2_equalized', equalized),
+                    ('3_denoised', denoised),
+                    ('4_binary', binary),
+                    ('5_cleaned', cleaned)
+                ]
                 
             return cleaned
             
@@ -105,20 +105,61 @@ class MarkProcessor:
             logger.error(f"Error en preprocesamiento de ROI: {e}", exc_info=True)
             return None
     
-    def detect_shape(self, roi, field_name: str = None) -> Tuple[str, List[Any]]:
+    def preprocess_page(self, image) -> np.ndarray:
+        """
+        Preprocesar la página completa una sola vez
+        
+        Aplica la misma cadena que `preprocess_roi` (grises, CLAHE, filtro
+        bilateral, umbral adaptativo y morfología) sobre toda la página, de
+        forma que las ROIs se recortan ya binarizadas y el umbral adaptativo
+        no sufre efectos de borde en recortes pequeños.
+        
+        Args:
+            image: Imagen de la página en formato numpy (BGR o grises)
+            
+        Returns:
+            Imagen binaria de la página (marcas en blanco)
+        """
+        if len(image.shape) == 3:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = image
+            
+        # Mejorar contraste con CLAHE (teselas proporcionales a la página)
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(16, 16))
+        equalized = clahe.apply(gray)
+        
+        # Reducir ruido con filtro bilateral
+        denoised = cv2.bilateralFilter(equalized, 5, 75, 75)
+        
+        # Umbral adaptativo con la misma ventana que por ROI
+        binary = cv2.adaptiveThreshold(
+            denoised, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+            cv2.THRESH_BINARY_INV, 9, 3
+        )
+        
+        # Operaciones morfológicas para limpiar ruido y cerrar huecos
+        cleaned = cv2.morphologyEx(binary, cv2.MORPH_OPEN, np.ones((2,2), np.uint8))
+        cleaned = cv2.morphologyEx(cleaned, cv2.MORPH_CLOSE, np.ones((3,3), np.uint8))
+        
+        logger.info(f"Página preprocesada: {cleaned.shape[1]}x{cleaned.shape[0]}")
+        return cleaned
+    
+    def detect_shape(self, roi, field_name: str = None, mark_types: Dict[str, str] = None) -> Tuple[str, List[Any]]:
         """
         Detecta la forma predominante en una ROI (círculo o cuadrado)
         
         Args:
             roi: Imagen ROI en formato numpy
             field_name: Nombre del campo
+            mark_types: Tipos ya conocidos {campo: tipo_marca}, opcional
             
         Returns:
             Tupla (tipo_forma, contornos)
         """
         # Si el tipo ya está definido, usarlo
-        if field_name and field_name in self._mark_types:
-            return self._mark_types[field_name], []
+        if field_name and mark_types and field_name in mark_types:
+            return mark_types[field_name], []
         
         # De lo contrario, intentar detectar automáticamente
         try:
@@ -172,20 +213,68 @@ class MarkProcessor:
             # Por defecto, asumir cuadrado
             return 'square', []
     
-    def process_mark(self, roi, field_name: str = None) -> Tuple[bool, float, Dict[str, Any]]:
+    def _get_threshold(self, field_name: str, shape_type: str, w: int, h: int) -> float:
+        """
+        Obtener el umbral de decisión para un campo
+        
+        Args:
+            field_name: Nombre del campo
+            shape_type: Tipo de marca ('circle' o 'square')
+            w: Ancho original de la ROI
+            h: Alto original de la ROI
+            
+        Returns:
+            Umbral en porcentaje, ajustado según el área de la ROI
+        """
+        if field_name in self._thresholds:
+            threshold = self._thresholds[field_name]
+        elif shape_type == 'circle':
+            threshold = getattr(settings, 'CIRCLE_MARK_THRESHOLD', 30)  # Punto medio entre 25 y 35
+        else:
+            threshold = getattr(settings, 'MARK_THRESHOLD', 25)  # Ajustado a 25% para capturar marcas en ese rango
+        
+        # Ajuste dinámico del umbral
+        area = w * h
+        if area < 400:  # ROI pequeña
+            threshold *= 0.9  # Reducción moderada
+        elif area > 2000:  # ROI grande
+            threshold *= 1.1  # Aumento moderado
+            
+        return threshold
+    
+    def process_mark(self, roi, field_name: str = None, binary_roi: np.ndarray = None,
+                     context: MarkContext = None) -> Tuple[bool, float, Dict[str, Any]]:
+        """
+        Procesar una ROI para detectar si está marcada
+        
+        Args:
+            roi: Imagen ROI en formato numpy
+            field_name: Nombre del campo
+            binary_roi: ROI ya binarizada recortada de la página preprocesada
+                        (ver `preprocess_page`); si se indica, no se
+                        preprocesa la ROI
+            context: Estado de la petición (tipos de marca y debug), opcional
+            
+        Returns:
+            Tupla (está_marcado, porcentaje, metadatos)
+        """
         metadata = {}
+        context = context or MarkContext()
         
         try:
             # Obtener tipo de marca
-            shape_type, contours = self.detect_shape(roi, field_name)
+            shape_type, contours = self.detect_shape(roi, field_name, context.mark_types)
             metadata['shape_type'] = shape_type
             
             # Guardar tamaño original
             h, w = roi.shape[:2]
             metadata['original_size'] = (w, h)
             
-            # Preprocesar ROI
-            processed_roi = self.preprocess_roi(roi, field_name)
+            # Preprocesar ROI (salvo que ya venga binarizada de la página)
+            if binary_roi is not None:
+                processed_roi = binary_roi
+            else:
+                processed_roi = self.preprocess_roi(roi, field_name, context)
             if processed_roi is None:
                 return False, 0.0, metadata
             
@@ -277,20 +366,9 @@ class MarkProcessor:
                 if num_labels > 4:  # Más de 3 regiones separadas
                     mark_percentage *= 0.85
             
-            # Determinar umbral
-            if field_name in self._thresholds:
-                threshold = self._thresholds[field_name]
-            elif shape_type == 'circle':
-                threshold = getattr(settings, 'CIRCLE_MARK_THRESHOLD', 30)  # Punto medio entre 25 y 35
-            else:
-                threshold = getattr(settings, 'MARK_THRESHOLD', 25)  # Ajustado a 25% para capturar marcas en ese rango
-            
-            # Ajuste dinámico del umbral
+            # Determinar umbral (con ajuste dinámico según el área)
+            threshold = self._get_threshold(field_name, shape_type, w, h)
             area = w * h
-            if area < 400:  # ROI pequeña
-                threshold *= 0.9  # Reducción moderada
-            elif area > 2000:  # ROI grande
-                threshold *= 1.1  # Aumento moderado
             
             # Decisión final
             is_marked = mark_percentage > threshold
@@ -306,12 +384,7 @@ class MarkProcessor:
             })
             
             # Debug
-            if self._debug_folder and field_name:
-                cv2.imwrite(os.path.join(self._debug_folder, f"{field_name}_final.png"), processed_roi)
-                if contours and len(roi.shape) == 3:
-                    roi_with_contours = roi.copy()
-                    cv2.drawContours(roi_with_contours, contours, -1, (0, 255, 0), 2)
-                    cv2.imwrite(os.path.join(self._debug_folder, f"{field_name}_contours.png"), roi_with_contours)
+            self._save_debug(context, field_name, roi, processed_roi, contours, mark_percentage, threshold)
             
             # Logging detallado
             logger.info(f"Procesamiento de marca {field_name}:")
@@ -332,13 +405,17 @@ class MarkProcessor:
             logger.error(f"Error procesando marca: {e}", exc_info=True)
             return False, 0.0, metadata
     
-    def process(self, image, zones):
+    def process(self, image, zones, mark_fields: set = None, mark_types: Dict[str, str] = None,
+                debug_folder: str = None):
         """
         Implementación del método abstracto para procesar la imagen
         
         Args:
             image: Imagen en formato numpy
             zones: Lista de zonas (dict con 'name', 'left', 'top', 'width', 'height')
+            mark_fields: Campos de marca a procesar (por defecto todas las zonas)
+            mark_types: Tipos conocidos {campo: 'circle' | 'square'}, opcional
+            debug_folder: Carpeta para imágenes de debug, opcional
             
         Returns:
             Dict con resultados
@@ -348,7 +425,7 @@ class MarkProcessor:
         field_names = []
         
         for zone in zones:
-            if zone['name'] not in self._mark_fields:
+            if mark_fields is not None and zone['name'] not in mark_fields:
                 continue
                 
             x = int(zone.get('left', 0))
@@ -367,46 +444,89 @@ class MarkProcessor:
             field_names.append(zone['name'])
         
         # Procesar las ROIs
-        results, details = self.process_batch(rois, field_names)
+        results, details = self.process_batch(rois, field_names, mark_types=mark_types, debug_folder=debug_folder)
         return {"results": results, "details": details}
     
-    def process_batch(self, rois: list, field_names: list) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    def process_batch(self, rois: list, field_names: list, binary_rois: list = None,
+                      mark_index=None, rects: list = None, mark_types: Dict[str, str] = None,
+                      debug_folder: str = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
         """
         Procesar un lote de ROIs de marca
         
+        Por defecto usa el motor vectorizado (ver `_process_batch_vectorized`).
+        Con MARK_VECTORIZED_BATCH desactivado se procesa cada ROI por separado
+        con `process_mark`. Si se indica un índice integral, las marcas
+        cuadradas se puntúan con él (ver `_score_integral`) y el resto por la
+        vía normal.
+        
         Args:
             rois: Lista de imágenes ROI
             field_names: Lista de nombres de campos
+            binary_rois: Lista opcional de ROIs ya binarizadas (modo página),
+                         alineada con `rois`
+            mark_index: IntegralMarkIndex opcional de la página binarizada
+            rects: Lista de rectángulos (x, y, w, h) de cada ROI en la página,
+                   necesaria con `mark_index`
+            mark_types: Tipos conocidos {campo: 'circle' | 'square'}; los
+                        demás se detectan con `detect_shape`
+            debug_folder: Carpeta donde el sink de debug guarda las etapas
+                          de esta hoja, opcional
             
         Returns:
             Tupla (resultados_simples, resultados_detallados)
         """
-        results = {}
-        mark_results = {}
+        context = MarkContext(mark_types, debug_folder)
+        if binary_rois is None:
+            binary_rois = [None] * len(rois)
+            
+        input_fields = list(field_names)
+        integral_results = {}
+        if mark_index is not None and rects is not None:
+            integral_items = []
+            remaining = []
+            for roi, field_name, binary_roi, rect in zip(rois, field_names, binary_rois, rects):
+                shape_type, _ = self.detect_shape(roi, field_name, context.mark_types)
+                if shape_type == 'square' and mark_index.covers(rect):
+                    integral_items.append((field_name, rect))
+                else:
+                    remaining.append((roi, field_name, binary_roi))
+            
+            if integral_items:
+                integral_results = self._score_integral(mark_index, integral_items)
+            rois, field_names, binary_rois = (list(t) for t in zip(*remaining)) if remaining else ([], [], [])
+            
+        if getattr(settings, 'MARK_VECTORIZED_BATCH', True):
+            mark_results = self._process_batch_vectorized(rois, field_names, binary_rois, context)
+        else:
+            mark_results = {}
+            for roi, field_name, binary_roi in zip(rois, field_names, binary_rois):
+                try:
+                    marked, percentage, metadata = self.process_mark(roi, field_name, binary_roi, context)
+                    mark_results[field_name] = {
+                        'marked': marked,
+                        'percentage': percentage,
+                        'metadata': metadata
+                    }
+                    
+                    logger.info(f"Resultado para marca {field_name}: {'MARCADO' if marked else 'NO MARCADO'} ({percentage:.2f}%)")
+                    
+                except Exception as e:
+                    logger.error(f"Error procesando marca {field_name}: {e}")
+                    mark_results[field_name] = {
+                        'marked': False,
+                        'percentage': 0.0,
+                        'metadata': {'error': str(e)}
+                    }
         
-        for roi, field_name in zip(rois, field_names):
-            if field_name not in self._mark_fields and self._mark_fields:
-                continue
-                
-            try:
-                marked, percentage, metadata = self.process_mark(roi, field_name)
-                mark_results[field_name] = {
-                    'marked': marked,
-                    'percentage': percentage,
-                    'metadata': metadata
-                }
-                results[field_name] = marked
-                
-                logger.info(f"Resultado para marca {field_name}: {'MARCADO' if marked else 'NO MARCADO'} ({percentage:.2f}%)")
-                
-            except Exception as e:
-                logger.error(f"Error procesando marca {field_name}: {e}")
-                mark_results[field_name] = {
-                    'marked': False,
-                    'percentage': 0.0,
-                    'metadata': {'error': str(e)}
-                }
-                results[field_name] = False
+        if integral_results:
+            mark_results.update(integral_results)
+            mark_results = {f: mark_results[f] for f in input_fields if f in mark_results}
+            
+        results = {field_name: info['marked'] for field_name, info in mark_results.items()}
+        
+        # Cerrar la hoja en el sink de debug (mosaico o zip)
+        if context.debug_folder:
+            get_debug_sink().end_sheet(context.debug_folder)
         
         # Mostrar resumen de resultados
         if mark_results:
@@ -422,6 +542,339 @@ class MarkProcessor:
             
         return results, mark_results
         
+    def _save_debug(self, context: MarkContext, field_name: str, roi, processed_roi, contours,
+                    percentage: float, threshold: float):
+        """
+        Entregar al sink de debug las etapas de un campo ya puntuado
+        
+        La política del sink (ver `app.core.utils.debug_sink`) decide si se
+        guardan; la imagen de contornos solo se dibuja si es así.
+        """
+        stages = context.debug_stages.pop(field_name, [])
+        if not (context.debug_folder and field_name):
+            return
+        sink = get_debug_sink()
+        if not sink.enabled or not sink.wants(percentage, threshold):
+            return
+            
+        stages.append(('final', processed_roi))
+        if contours:
+            roi_with_contours = roi.copy() if len(roi.shape) == 3 else cv2.cvtColor(roi, cv2.COLOR_GRAY2BGR)
+            cv2.drawContours(roi_with_contours, contours, -1, (0, 255, 0), 2)
+            stages.append(('contours', roi_with_contours))
+        sink.submit(context.debug_folder, field_name, stages)
+        
+    def _process_batch_vectorized(self, rois: list, field_names: list, binary_rois: list,
+                                  context: MarkContext) -> Dict[str, Any]:
+        """
+        Procesar un lote de ROIs agrupando las de igual tamaño
+        
+        El preprocesamiento sigue siendo por ROI (CLAHE y el umbral adaptativo
+        dependen del recorte) salvo en modo página, pero la puntuación se hace con reducciones de
+        NumPy sobre pilas N×H×W de ROIs del mismo tamaño y tipo. Las rejillas
+        de respuestas y DNI del editor tienen celdas iguales, así que cada
+        rejilla se puntúa de una sola vez. Las decisiones coinciden con las
+        de `process_mark`.
+        
+        Args:
+            rois: Lista de imágenes ROI
+            field_names: Lista de nombres de campos
+            binary_rois: Lista de ROIs ya binarizadas o None por elemento
+            context: Estado de la petición (tipos de marca y debug)
+            
+        Returns:
+            Diccionario {campo: {'marked', 'percentage', 'metadata'}} en el
+            orden de entrada
+        """
+        mark_results = {}
+        groups = {}
+        
+        for roi, field_name, binary_roi in zip(rois, field_names, binary_rois):
+            try:
+                shape_type, contours = self.detect_shape(roi, field_name, context.mark_types)
+                h, w = roi.shape[:2]
+                
+                if binary_roi is not None:
+                    processed_roi = binary_roi
+                else:
+                    processed_roi = self.preprocess_roi(roi, field_name, context)
+                if processed_roi is None:
+                    mark_results[field_name] = {
+                        'marked': False,
+                        'percentage': 0.0,
+                        'metadata': {'shape_type': shape_type, 'original_size': (w, h)}
+                    }
+                    continue
+                    
+                key = (shape_type, w, h, processed_roi.shape)
+                groups.setdefault(key, []).append((field_name, roi, processed_roi, contours))
+                
+            except Exception as e:
+                logger.error(f"Error procesando marca {field_name}: {e}")
+                mark_results[field_name] = {
+                    'marked': False,
+                    'percentage': 0.0,
+                    'metadata': {'error': str(e)}
+                }
+        
+        for (shape_type, w, h, _), items in groups.items():
+            try:
+                mark_results.update(self._score_stack(shape_type, w, h, items, context))
+            except Exception as e:
+                logger.error(f"Error puntuando grupo de {len(items)} marcas {w}x{h}: {e}", exc_info=True)
+                for field_name, _, _, _ in items:
+                    mark_results[field_name] = {
+                        'marked': False,
+                        'percentage': 0.0,
+                        'metadata': {'error': str(e)}
+                    }
+        
+        logger.info(f"Puntuadas {len(mark_results)} marcas en {len(groups)} grupos")
+        
+        # Conservar el orden de entrada
+        return {field_name: mark_results[field_name] for field_name in field_names if field_name in mark_results}
+    
+    def _get_circle_geometry(self, shape: Tuple[int, int], center: Tuple[int, int], radius: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Obtener la máscara circular y la rejilla de distancias al centro
+        
+        Se calculan una sola vez por tamaño de celda y se reutilizan.
+        
+        Returns:
+            Tupla (máscara booleana H×W, distancias H×W)
+        """
+        key = (shape, center, radius)
+        geometry = self._geometry_cache.get(key)
+        if geometry is None:
+            mask = np.zeros(shape, dtype=np.uint8)
+            cv2.circle(mask, center, radius, 255, -1)
+            yy, xx = np.indices(shape)
+            distances = np.sqrt((xx - center[0])**2 + (yy - center[1])**2)
+            geometry = (mask > 0, distances)
+            self._geometry_cache[key] = geometry
+        return geometry
+    
+    @staticmethod
+    def _count_components(stack: np.ndarray) -> np.ndarray:
+        """
+        Contar componentes conectados de cada ROI de una pila N×H×W
+        
+        Las ROIs se apilan en vertical separadas por una fila vacía, de modo
+        que basta una llamada a connectedComponents para toda la pila.
+        
+        Returns:
+            Array de N enteros con el número de componentes (sin fondo)
+        """
+        n, h, w = stack.shape
+        mosaic = np.zeros((n, h + 1, w), dtype=np.uint8)
+        mosaic[:, :h] = stack
+        num_labels, labels = cv2.connectedComponents(mosaic.reshape(n * (h + 1), w))
+        labels = labels.reshape(n, h + 1, w)[:, :h]
+        
+        foreground = labels > 0
+        cells = np.broadcast_to(np.arange(n).reshape(n, 1, 1), labels.shape)[foreground]
+        pairs = np.unique(cells.astype(np.int64) * num_labels + labels[foreground])
+        return np.bincount(pairs // num_labels, minlength=n)
+    
+    def _score_integral(self, mark_index, items: list) -> Dict[str, Any]:
+        """
+        Puntuar marcas cuadradas con un índice integral de la página
+        
+        Relleno, centro de masa y dispersión salen del índice en O(1) por
+        zona y reciben las mismas penalizaciones que la vía normal. La única
+        diferencia es que no se valida la conectividad: frente al modo página
+        de `process_mark`, el porcentaje coincide (salvo redondeo, < 1e-9)
+        excepto en ROIs con más de 3 componentes separados, donde la vía
+        normal aplica un factor 0.85 adicional. Por tanto el porcentaje puede
+        ser hasta un 17.6% (1/0.85) mayor en marcas muy fragmentadas.
+        
+        Args:
+            mark_index: IntegralMarkIndex de la página binarizada
+            items: Lista de tuplas (campo, (x, y, w, h))
+            
+        Returns:
+            Diccionario {campo: {'marked', 'percentage', 'metadata'}}
+        """
+        rects = [rect for _, rect in items]
+        stats = mark_index.stats(rects)
+        w = np.array([rect[2] for rect in rects], dtype=np.float64)
+        h = np.array([rect[3] for rect in rects], dtype=np.float64)
+        
+        marked_pixels = stats['count']
+        percentages = (marked_pixels / (w * h)) * 100
+        percentages, extra_metadata = self._apply_square_penalties(
+            percentages, marked_pixels, stats['mean_x'], stats['mean_y'],
+            stats['std_x'] / w, stats['std_y'] / h, w, h
+        )
+        
+        mark_results = {}
+        for i, (field_name, (x, y, rw, rh)) in enumerate(items):
+            threshold = self._get_threshold(field_name, 'square', rw, rh)
+            mark_percentage = float(percentages[i])
+            is_marked = mark_percentage > threshold
+            
+            metadata = {'shape_type': 'square', 'original_size': (rw, rh), 'scorer': 'integral'}
+            metadata.update(extra_metadata[i])
+            metadata.update({
+                'total_pixels': rw * rh,
+                'marked_pixels': int(marked_pixels[i]),
+                'mark_percentage': mark_percentage,
+                'threshold': threshold,
+                'area': rw * rh
+            })
+            
+            mark_results[field_name] = {
+                'marked': is_marked,
+                'percentage': mark_percentage,
+                'metadata': metadata
+            }
+            
+        logger.info(f"Puntuadas {len(mark_results)} marcas con el índice integral")
+        return mark_results
+    
+    @staticmethod
+    def _apply_square_penalties(percentages, marked_pixels, mean_x, mean_y, x_std, y_std, w, h) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+        """
+        Aplicar las penalizaciones de distribución espacial de marcas cuadradas
+        
+        Args:
+            percentages: Porcentajes de relleno sin penalizar
+            marked_pixels: Píxeles marcados por ROI
+            mean_x, mean_y: Centro de masa en coordenadas de la ROI
+            x_std, y_std: Dispersión normalizada por el ancho/alto
+            w, h: Tamaño original de las ROIs
+            
+        Returns:
+            Tupla (porcentajes penalizados, metadatos por ROI)
+        """
+        has_marks = marked_pixels > 0
+        
+        concentrated = (x_std < 0.12) | (y_std < 0.12)
+        dispersed = ~concentrated & ((x_std > 0.4) | (y_std > 0.4))
+        percentages = np.where(has_marks & concentrated, percentages * 0.8, percentages)
+        percentages = np.where(has_marks & dispersed, percentages * 0.85, percentages)
+        
+        center_deviation = np.sqrt(
+            ((mean_x - w/2)/(w/2))**2 + 
+            ((mean_y - h/2)/(h/2))**2
+        )
+        percentages = np.where(has_marks & (center_deviation > 0.35), percentages * 0.9, percentages)
+        
+        extra_metadata = []
+        for i in range(len(percentages)):
+            if has_marks[i]:
+                extra_metadata.append({
+                    'spatial_distribution': (float(x_std[i]), float(y_std[i])),
+                    'center_deviation': float(center_deviation[i])
+                })
+            else:
+                extra_metadata.append({})
+                
+        return percentages, extra_metadata
+    
+    def _score_stack(self, shape_type: str, w: int, h: int, items: list, context: MarkContext) -> Dict[str, Any]:
+        """
+        Puntuar una pila de ROIs preprocesadas del mismo tamaño y tipo
+        
+        Reproduce los cálculos de `process_mark` (porcentaje, desviación del
+        centro, dispersión y penalizaciones) como reducciones vectorizadas.
+        
+        Args:
+            shape_type: Tipo de marca común ('circle' o 'square')
+            w: Ancho original de las ROIs
+            h: Alto original de las ROIs
+            items: Lista de tuplas (campo, roi, roi_preprocesada, contornos)
+            context: Estado de la petición (debug)
+            
+        Returns:
+            Diccionario {campo: {'marked', 'percentage', 'metadata'}}
+        """
+        stack = np.stack([processed for _, _, processed, _ in items]) > 0
+        n, ph, pw = stack.shape
+        extra_metadata = []
+        
+        if shape_type == 'circle':
+            center_x, center_y = w // 2, h // 2
+            radius = min(w, h) // 2
+            center_radius = int(radius * 0.55)
+            mask, distances = self._get_circle_geometry((ph, pw), (center_x, center_y), center_radius)
+            
+            region = stack & mask
+            center_pixels = np.count_nonzero(mask)
+            marked_pixels = region.sum(axis=(1, 2))
+            if center_pixels > 0:
+                percentages = (marked_pixels / center_pixels) * 100
+            else:
+                percentages = np.zeros(n)
+            
+            has_marks = marked_pixels > 0
+            counts = np.maximum(marked_pixels, 1)
+            avg_distance = (distances * region).sum(axis=(1, 2)) / counts
+            deviation = distances[np.newaxis] - avg_distance[:, np.newaxis, np.newaxis]
+            std_distance = np.sqrt((deviation**2 * region).sum(axis=(1, 2)) / counts)
+            
+            percentages = np.where(has_marks & (std_distance > center_radius * 0.35), percentages * 0.85, percentages)
+            percentages = np.where(has_marks & (avg_distance > center_radius * 0.6), percentages * 0.9, percentages)
+            
+            for i in range(n):
+                if has_marks[i]:
+                    extra_metadata.append({
+                        'center_deviation': float(avg_distance[i] / radius),
+                        'distance_std': float(std_distance[i] / radius)
+                    })
+                else:
+                    extra_metadata.append({})
+        else:
+            region = stack
+            marked_pixels = region.sum(axis=(1, 2))
+            percentages = (marked_pixels / region[0].size) * 100
+            
+            counts = np.maximum(marked_pixels, 1)
+            yy, xx = np.indices((ph, pw))
+            mean_x = (xx * region).sum(axis=(1, 2)) / counts
+            mean_y = (yy * region).sum(axis=(1, 2)) / counts
+            x_std = np.sqrt(((xx[np.newaxis] - mean_x[:, np.newaxis, np.newaxis])**2 * region).sum(axis=(1, 2)) / counts) / w
+            y_std = np.sqrt(((yy[np.newaxis] - mean_y[:, np.newaxis, np.newaxis])**2 * region).sum(axis=(1, 2)) / counts) / h
+            
+            percentages, extra_metadata = self._apply_square_penalties(
+                percentages, marked_pixels, mean_x, mean_y, x_std, y_std, w, h
+            )
+        
+        # Validar conectividad (más de 3 regiones separadas)
+        num_components = self._count_components(region)
+        percentages = np.where(num_components > 3, percentages * 0.85, percentages)
+        
+        mark_results = {}
+        for i, (field_name, roi, processed_roi, contours) in enumerate(items):
+            threshold = self._get_threshold(field_name, shape_type, w, h)
+            mark_percentage = float(percentages[i])
+            is_marked = mark_percentage > threshold
+            
+            metadata = {'shape_type': shape_type, 'original_size': (w, h)}
+            metadata.update(extra_metadata[i])
+            metadata.update({
+                'total_pixels': processed_roi.size,
+                'marked_pixels': int(marked_pixels[i]),
+                'mark_percentage': mark_percentage,
+                'threshold': threshold,
+                'area': w * h,
+                'num_components': int(num_components[i])
+            })
+            
+            # Debug
+            self._save_debug(context, field_name, roi, processed_roi, contours, mark_percentage, threshold)
+            
+            logger.debug(f"Marca {field_name}: {shape_type} {w}x{h}, {mark_percentage:.2f}% "
+                         f"(umbral {threshold:.2f}%) -> {'MARCADO' if is_marked else 'NO MARCADO'}")
+            
+            mark_results[field_name] = {
+                'marked': is_marked,
+                'percentage': mark_percentage,
+                'metadata': metadata
+            }
+            
+        return mark_results
+        
     def set_field_threshold(self, field_name: str, threshold: float):
         """
         Establecer un umbral personalizado para un campo específico
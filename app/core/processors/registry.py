@@ -0,0 +1,61 @@
+"""
+Registro de procesadores de larga duración.
+
+Cada procesador se crea una sola vez por proceso, la primera vez que se
+pide, y se comparte entre peticiones e hilos. Así la carga de prompts y la
+creación de la pasarela de Claude (con su pool de conexiones keep-alive)
+quedan fuera del camino de cada petición. Los procesadores no guardan
+estado de ninguna petición: la sesión, los campos y la carpeta de debug se
+pasan como argumentos.
+"""
+
+import logging
+import threading
+from typing import Any, Callable, Dict
+from app.core.processors.mark import MarkProcessor
+from app.core.processors.handwriting import HandwritingProcessor
+
+logger = logging.getLogger(__name__)
+
+_factories: Dict[str, Callable[[], Any]] = {
+    'mark': MarkProcessor,
+    'handwriting': HandwritingProcessor
+}
+
+_processors: Dict[str, Any] = {}
+_registry_lock = threading.Lock()
+
+def get_processor(name: str):
+    """
+    Obtener el procesador del proceso con el nombre indicado, creándolo si no existe
+
+    Args:
+        name: 'mark' o 'handwriting'
+
+    Raises:
+        ValueError: Si el nombre no está registrado
+        Exception: La del constructor del procesador (p. ej. si falta
+            ANTHROPIC_API_KEY); no se guarda nada y se reintenta en la
+            siguiente llamada
+    """
+    processor = _processors.get(name)
+    if processor is not None:
+        return processor
+    if name not in _factories:
+        raise ValueError(f"Procesador desconocido: {name}. Opciones: {', '.join(_factories)}")
+    with _registry_lock:
+        processor = _processors.get(name)
+        if processor is None:
+            processor = _factories[name]()
+            processor.initialize()
+            _processors[name] = processor
+            logger.info(f"Procesador '{name}' creado")
+        return processor
+
+def get_mark_processor() -> MarkProcessor:
+    """Obtener el MarkProcessor compartido del proceso"""
+    return get_processor('mark')
+
+def get_handwriting_processor() -> HandwritingProcessor:
+    """Obtener el HandwritingProcessor compartido del proceso"""
+    return get_processor('handwriting')
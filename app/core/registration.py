@@ -0,0 +1,512 @@
+"""
+Registro de las páginas escaneadas contra la plantilla.
+
+Cada plantilla puede tener una imagen de referencia (la hoja en blanco, que
+se sube junto al JSON de zonas). De ella se calculan una sola vez, y se
+guardan en caché por hash de plantilla, las marcas fiduciales de las
+esquinas, los puntos clave y descriptores ORB y una miniatura. Cada página
+se alinea con la referencia en una copia reducida (REGISTRATION_WIDTH):
+
+    fiducials   Cuadrados o círculos rellenos cerca de las cuatro esquinas;
+                homografía exacta a partir de los cuatro centros
+    orb         Correspondencias ORB filtradas con el test de Lowe y
+                transformación de semejanza estimada con RANSAC
+
+Con fiduciales idénticos la orientación es ambigua: se prueban la
+transformación directa y la girada 180° y se elige la que más se parece a
+la miniatura de referencia. ORB es invariante a la rotación, así que ya
+estima el giro. La transformación se escala al tamaño completo y se aplica
+a la página; si no se encuentra o empeora la alineación, la página se deja
+como estaba.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+import cv2
+import numpy as np
+from app.config import settings
+from app.core.utils.metrics import span
+
+logger = logging.getLogger(__name__)
+
+METHODS = ('auto', 'fiducials', 'orb')
+THUMBNAIL_WIDTH = 160  # Ancho de las miniaturas con las que se valida la alineación
+FIDUCIAL_CORNER_REGION = 0.25  # Fracción del ancho/alto en la que se buscan los fiduciales
+FIDUCIAL_SIZE_RANGE = (0.008, 0.06)  # Lado admitido, como fracción del ancho de la página
+FIDUCIAL_MIN_FILL = 0.75  # Proporción de la caja ocupada (un círculo relleno ocupa ~0.785)
+FIDUCIAL_SIZE_TOLERANCE = 0.4  # Desviación admitida respecto al tamaño de los fiduciales de referencia
+ORB_RATIO = 0.75  # Test de Lowe
+ORB_RANSAC_THRESHOLD = 3.0  # Píxeles de la copia reducida
+MAX_SCALE_DEVIATION = 0.2  # Escala admitida en la transformación estimada (1 ± 0.2)
+IDENTITY_TOLERANCE = 0.5  # Desplazamiento máximo de las esquinas (px) para no deformar la página
+SCORE_TOLERANCE = 0.01  # Pérdida de similitud admitida frente a la página sin registrar
+
+@dataclass
+class TemplateReference:
+    """Datos precalculados de la imagen de referencia de una plantilla"""
+
+    template_hash: str
+    size: Tuple[int, int]  # (ancho, alto) de la imagen completa
+    scale: float  # Escala de la copia reducida respecto a la imagen completa
+    fiducials: Optional[np.ndarray]  # Centros (4, 2) TL, TR, BR, BL en la copia reducida
+    fiducial_side: float  # Lado medio de los fiduciales en la copia reducida
+    keypoints: np.ndarray  # Coordenadas (N, 2) de los puntos ORB en la copia reducida
+    descriptors: np.ndarray  # Descriptores ORB (N, 32)
+    thumbnail: np.ndarray  # Miniatura en grises para validar la orientación
+
+    @property
+    def small_size(self) -> Tuple[int, int]:
+        """(ancho, alto) de la copia reducida"""
+        return round(self.size[0] * self.scale), round(self.size[1] * self.scale)
+
+    @classmethod
+    def compute(cls, template_hash: str, image: np.ndarray) -> 'TemplateReference':
+        """Calcular fiduciales, descriptores y miniatura de una imagen de referencia"""
+        gray = to_gray(image)
+        height, width = gray.shape
+        # Factor de reducción entero: INTER_AREA tiene un camino rápido para él
+        scale = 1 / max(1, round(width / settings.REGISTRATION_WIDTH))
+        small = resize(gray, scale)
+
+        fiducials = detect_fiducials(small)
+        side = 0.0
+        if fiducials is not None:
+            fiducials, sides = fiducials
+            side = float(np.mean(sides))
+            fiducials = refine_fiducials(gray, fiducials, scale, side)
+
+        keypoints, descriptors = get_orb().detectAndCompute(small, None)
+        points = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2)
+        if descriptors is None:
+            descriptors = np.zeros((0, 32), np.uint8)
+
+        return cls(template_hash, (width, height), scale, fiducials, side,
+                   points, descriptors, thumbnail(small))
+
+    def save(self, path: str):
+        """Guardar los datos precalculados como .npz"""
+        np.savez(
+            path,
+            size=np.int32(self.size), scale=np.float64(self.scale),
+            fiducials=self.fiducials if self.fiducials is not None else np.zeros((0, 2), np.float32),
+            fiducial_side=np.float64(self.fiducial_side),
+            keypoints=self.keypoints, descriptors=self.descriptors, thumbnail=self.thumbnail
+        )
+
+    @classmethod
+    def load(cls, template_hash: str, path: str) -> 'TemplateReference':
+        """Cargar los datos precalculados guardados con `save`"""
+        with np.load(path) as data:
+            fiducials = data['fiducials']
+            return cls(
+                template_hash, tuple(int(v) for v in data['size']), float(data['scale']),
+                fiducials if len(fiducials) == 4 else None, float(data['fiducial_side']),
+                data['keypoints'], data['descriptors'], data['thumbnail']
+            )
+
+@dataclass
+class RegistrationResult:
+    """Resultado del registro de una página"""
+
+    image: np.ndarray  # Página alineada (o la original si no se ha podido alinear)
+    method: Optional[str] = None  # 'fiducials', 'orb' o None si no se ha aplicado
+    rotated: bool = False  # La página estaba girada 180°
+    inliers: int = 0  # Puntos que respaldan la transformación
+    score: float = 0.0  # Correlación con la miniatura de referencia
+
+    @property
+    def applied(self) -> bool:
+        return self.method is not None
+
+    def to_dict(self):
+        return {'method': self.method, 'rotated': self.rotated,
+                'inliers': self.inliers, 'score': round(self.score, 3)}
+
+_orb_local = threading.local()
+
+def get_orb():
+    """Detector ORB del hilo actual (los objetos de OpenCV no se comparten entre hilos)"""
+    orb = getattr(_orb_local, 'orb', None)
+    if orb is None:
+        orb = cv2.ORB_create(nfeatures=settings.REGISTRATION_MAX_FEATURES)
+        _orb_local.orb = orb
+    return orb
+
+def to_gray(image: np.ndarray) -> np.ndarray:
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+def resize(gray: np.ndarray, scale: float) -> np.ndarray:
+    if scale == 1.0:
+        return gray
+    height, width = gray.shape
+    return cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+def thumbnail(gray: np.ndarray) -> np.ndarray:
+    """Miniatura suavizada para comparar orientación y alineación"""
+    height, width = gray.shape
+    size = (THUMBNAIL_WIDTH, max(1, round(height * THUMBNAIL_WIDTH / width)))
+    return cv2.GaussianBlur(cv2.resize(gray, size, interpolation=cv2.INTER_AREA), (3, 3), 0)
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Correlación normalizada entre dos miniaturas del mismo tamaño"""
+    return float(cv2.matchTemplate(a, b, cv2.TM_CCOEFF_NORMED)[0, 0])
+
+def detect_fiducials(gray: np.ndarray, expected_side: float = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Buscar una marca fiducial rellena cerca de cada esquina
+
+    Args:
+        gray: Página en escala de grises
+        expected_side: Lado esperado (el de la referencia) para descartar
+            marcas de otro tamaño
+
+    Returns:
+        Tupla (centros (4, 2) en orden TL, TR, BR, BL, lados (4,)) o None si
+        falta alguna esquina
+    """
+    height, width = gray.shape
+    min_side, max_side = (f * width for f in FIDUCIAL_SIZE_RANGE)
+    if expected_side:
+        min_side = max(min_side, expected_side * (1 - FIDUCIAL_SIZE_TOLERANCE))
+        max_side = min(max_side, expected_side * (1 + FIDUCIAL_SIZE_TOLERANCE))
+
+    # Solo se binarizan las esquinas, con un umbral propio para cada una
+    region_w, region_h = int(width * FIDUCIAL_CORNER_REGION), int(height * FIDUCIAL_CORNER_REGION)
+    origins = ((0, 0), (width - region_w, 0), (width - region_w, height - region_h), (0, height - region_h))
+    corners = ((0, 0), (width, 0), (width, height), (0, height))
+    centers, sides = [], []
+    for (x0, y0), corner in zip(origins, corners):
+        region = gray[y0:y0 + region_h, x0:x0 + region_w]
+        _, binary = cv2.threshold(region, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        best = None
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            x, y = x + x0, y + y0
+            if not (min_side <= w <= max_side and min_side <= h <= max_side) or not 0.75 <= w / h <= 1.33:
+                continue
+            # Un fiducial cortado por el borde del escaneo desplazaría su centro
+            if x == 0 or y == 0 or x + w >= width or y + h >= height:
+                continue
+            if cv2.contourArea(contour) < FIDUCIAL_MIN_FILL * w * h:
+                continue
+            center = (x + w / 2, y + h / 2)
+            distance = float(np.hypot(center[0] - corner[0], center[1] - corner[1]))
+            if best is None or distance < best[0]:
+                best = (distance, center, (w + h) / 2)
+        if best is None:
+            return None
+        centers.append(best[1])
+        sides.append(best[2])
+
+    return np.float32(centers), np.float32(sides)
+
+def refine_fiducials(gray: np.ndarray, points: np.ndarray, scale: float, side: float) -> np.ndarray:
+    """
+    Centroides subpíxel de los fiduciales medidos en la imagen completa
+
+    Args:
+        gray: Imagen completa en escala de grises
+        points: Centros aproximados en la copia reducida
+        scale: Escala de la copia reducida
+        side: Lado de los fiduciales en la copia reducida
+
+    Returns:
+        Centros (4, 2) refinados, en coordenadas de la copia reducida
+    """
+    radius = int(np.ceil(0.75 * side / scale))
+    height, width = gray.shape
+    refined = []
+    for x, y in points / scale:
+        x0, y0 = max(0, int(x) - radius), max(0, int(y) - radius)
+        patch = gray[y0:min(height, int(y) + radius + 1), x0:min(width, int(x) + radius + 1)]
+        _, binary = cv2.threshold(patch, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        moments = cv2.moments(binary, binaryImage=True)
+        if moments['m00']:
+            x, y = x0 + moments['m10'] / moments['m00'], y0 + moments['m01'] / moments['m00']
+        refined.append((x, y))
+    return np.float32(refined) * scale
+
+def check_transform(matrix: np.ndarray) -> bool:
+    """Descartar transformaciones degeneradas o con una escala inverosímil"""
+    if matrix is None or not np.all(np.isfinite(matrix)):
+        return False
+    scale = np.sqrt(abs(np.linalg.det(matrix[:2, :2])))
+    return abs(scale - 1) <= MAX_SCALE_DEVIATION
+
+def warp_thumbnail(page_thumbnail: np.ndarray, small_width: int, matrix: np.ndarray,
+                   reference: TemplateReference) -> np.ndarray:
+    """
+    Llevar la miniatura de la página al marco de la miniatura de referencia
+
+    Se transforma la miniatura, no la copia reducida: la matriz (definida
+    entre copias reducidas) se conjuga con las escalas de ambas miniaturas.
+    """
+    height, width = reference.thumbnail.shape
+    to_reference = width / reference.small_size[0]
+    from_page = page_thumbnail.shape[1] / small_width
+    matrix = np.diag([to_reference, to_reference, 1.0]) @ matrix @ np.diag([1 / from_page, 1 / from_page, 1.0])
+    return cv2.warpPerspective(page_thumbnail, matrix, (width, height), borderValue=255)
+
+def estimate_fiducials(gray: np.ndarray, small: np.ndarray, scale: float, page_thumbnail: np.ndarray,
+                       reference: TemplateReference):
+    """
+    Homografía a partir de los fiduciales de las esquinas
+
+    Args:
+        gray: Página completa en escala de grises
+        small: Copia reducida de la página
+        scale: Escala de la copia reducida
+        page_thumbnail: Miniatura de la página
+        reference: Datos precalculados de la referencia
+
+    Returns:
+        Tupla (matriz 3x3, girada 180°, puntuación) o None
+    """
+    if reference.fiducials is None:
+        return None
+    found = detect_fiducials(small, reference.fiducial_side)
+    if found is None:
+        return None
+    points = refine_fiducials(gray, found[0], scale, reference.fiducial_side)
+
+    best = None
+    # Girada 180°, la esquina TL de la página corresponde a la BR de la plantilla
+    for rotated, source in ((False, points), (True, np.roll(points, 2, axis=0))):
+        matrix = cv2.getPerspectiveTransform(source, reference.fiducials)
+        if not check_transform(matrix):
+            continue
+        score = similarity(warp_thumbnail(page_thumbnail, small.shape[1], matrix, reference), reference.thumbnail)
+        if best is None or score > best[2]:
+            best = (matrix, rotated, score)
+    return best
+
+def estimate_orb(small: np.ndarray, reference: TemplateReference):
+    """
+    Semejanza estimada con RANSAC sobre correspondencias ORB
+
+    Returns:
+        Tupla (matriz 3x3, girada 180°, inliers) o None
+    """
+    if len(reference.descriptors) < settings.REGISTRATION_MIN_INLIERS:
+        return None
+    keypoints, descriptors = get_orb().detectAndCompute(small, None)
+    if descriptors is None or len(keypoints) < settings.REGISTRATION_MIN_INLIERS:
+        return None
+
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    good = [m for m, n in (pair for pair in matcher.knnMatch(descriptors, reference.descriptors, k=2)
+                           if len(pair) == 2)
+            if m.distance < ORB_RATIO * n.distance]
+    if len(good) < settings.REGISTRATION_MIN_INLIERS:
+        return None
+
+    source = np.float32([keypoints[m.queryIdx].pt for m in good])
+    target = reference.keypoints[[m.trainIdx for m in good]]
+    affine, mask = cv2.estimateAffinePartial2D(source, target, method=cv2.RANSAC,
+                                               ransacReprojThreshold=ORB_RANSAC_THRESHOLD)
+    inliers = int(mask.sum()) if mask is not None else 0
+    if affine is None or inliers < settings.REGISTRATION_MIN_INLIERS:
+        return None
+
+    matrix = np.vstack([affine, [0, 0, 1]])
+    if not check_transform(matrix):
+        return None
+    rotated = abs(np.degrees(np.arctan2(affine[1, 0], affine[0, 0]))) > 90
+    return matrix, rotated, inliers
+
+def is_identity(matrix: np.ndarray, size: Tuple[int, int]) -> bool:
+    """Indicar si la transformación apenas mueve las esquinas de la página"""
+    width, height = size
+    corners = np.float32([[[0, 0]], [[width, 0]], [[width, height]], [[0, height]]])
+    moved = cv2.perspectiveTransform(corners, matrix)
+    return float(np.abs(moved - corners).max()) < IDENTITY_TOLERANCE
+
+def register(image: np.ndarray, reference: TemplateReference, method: str = None,
+             gray: np.ndarray = None) -> RegistrationResult:
+    """
+    Alinear una página con la imagen de referencia de su plantilla
+
+    Args:
+        image: Página BGR o en escala de grises
+        reference: Datos precalculados de la referencia
+        method: 'auto' (fiduciales y, si fallan, ORB), 'fiducials' u 'orb'
+            (por defecto, REGISTRATION_METHOD)
+        gray: Página ya convertida a grises (p. ej. de la caché de páginas), opcional
+
+    Returns:
+        Resultado con la página alineada al marco de la plantilla, o con la
+        original si no se ha podido alinear
+    """
+    method = method or settings.REGISTRATION_METHOD
+    if method not in METHODS:
+        raise ValueError(f"Método de registro desconocido: {method}. Opciones: {', '.join(METHODS)}")
+
+    gray = to_gray(image) if gray is None else gray
+    small_scale = reference.small_size[0] / gray.shape[1]
+    small = resize(gray, small_scale)
+    page_thumbnail = thumbnail(small)
+    # Alineación sin registro: la página redimensionada sin más al marco de la plantilla
+    baseline = similarity(cv2.resize(page_thumbnail, reference.thumbnail.shape[::-1], interpolation=cv2.INTER_AREA),
+                          reference.thumbnail)
+
+    found = None
+    if method in ('auto', 'fiducials'):
+        estimate = estimate_fiducials(gray, small, small_scale, page_thumbnail, reference)
+        if estimate is not None:
+            matrix, rotated, score = estimate
+            found = ('fiducials', matrix, rotated, 4, score)
+    if found is None and method in ('auto', 'orb'):
+        estimate = estimate_orb(small, reference)
+        if estimate is not None:
+            matrix, rotated, inliers = estimate
+            score = similarity(warp_thumbnail(page_thumbnail, small.shape[1], matrix, reference),
+                               reference.thumbnail)
+            found = ('orb', matrix, rotated, inliers, score)
+
+    if found is None:
+        return RegistrationResult(image, score=baseline)
+
+    # Transformación de la imagen completa: reducir, transformar y ampliar
+    name, matrix, rotated, inliers, score = found
+    full = np.diag([1 / reference.scale, 1 / reference.scale, 1.0]) @ matrix @ np.diag([small_scale, small_scale, 1.0])
+    if gray.shape[::-1] == reference.size and is_identity(full, reference.size):
+        return RegistrationResult(image, name, rotated, inliers, score)
+
+    if score < baseline - SCORE_TOLERANCE:
+        logger.warning(f"Registro ({name}) descartado: empeora la alineación ({score:.3f} < {baseline:.3f})")
+        return RegistrationResult(image, score=baseline)
+
+    border = (255,) * image.shape[2] if image.ndim == 3 else 255
+    warped = cv2.warpPerspective(image, full, reference.size, flags=cv2.INTER_LINEAR,
+                                 borderMode=cv2.BORDER_CONSTANT, borderValue=border)
+    return RegistrationResult(warped, name, rotated, inliers, score)
+
+class ReferenceCache:
+    """
+    Caché LRU de los datos de referencia de cada plantilla
+
+    Las imágenes de referencia se guardan siempre en disco junto a las
+    plantillas (`<hash>_reference.png`); los descriptores se calculan una vez
+    y, con TEMPLATE_CACHE_PERSIST, se guardan también como .npz.
+    """
+
+    def __init__(self, max_entries: int, directory: str, persist: bool = False):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.persist = persist
+        self._references: "OrderedDict[str, TemplateReference]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def image_path(self, template_hash: str) -> str:
+        return os.path.join(self.directory, f"{template_hash}_reference.png")
+
+    def _data_path(self, template_hash: str) -> str:
+        return os.path.join(self.directory, f"{template_hash}_reference.npz")
+
+    def _put(self, reference: TemplateReference):
+        self._references[reference.template_hash] = reference
+        self._references.move_to_end(reference.template_hash)
+        while len(self._references) > self.max_entries:
+            self._references.popitem(last=False)
+
+    def has(self, template_hash: str) -> bool:
+        """Indicar si la plantilla tiene imagen de referencia"""
+        with self._lock:
+            if template_hash in self._references:
+                return True
+        return os.path.exists(self.image_path(template_hash))
+
+    def get(self, template_hash: str) -> Optional[TemplateReference]:
+        """Obtener los datos de referencia de una plantilla (None si no tiene)"""
+        with self._lock:
+            reference = self._references.get(template_hash)
+            if reference is not None:
+                self._references.move_to_end(template_hash)
+                return reference
+
+        if self.persist and os.path.exists(self._data_path(template_hash)):
+            try:
+                reference = TemplateReference.load(template_hash, self._data_path(template_hash))
+            except Exception as e:
+                logger.warning(f"No se pudo cargar la referencia {template_hash[:12]} de disco: {e}")
+
+        if reference is None:
+            path = self.image_path(template_hash)
+            image = cv2.imread(path, cv2.IMREAD_GRAYSCALE) if os.path.exists(path) else None
+            if image is None:
+                return None
+            reference = self._compute(template_hash, image)
+
+        with self._lock:
+            self._put(reference)
+        return reference
+
+    def set(self, template_hash: str, image: np.ndarray) -> TemplateReference:
+        """
+        Guardar la imagen de referencia de una plantilla y precalcular sus datos
+
+        Args:
+            template_hash: Hash de la plantilla
+            image: Hoja en blanco con el tamaño de las plantillas
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if not cv2.imwrite(self.image_path(template_hash), image, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+            raise IOError(f"No se pudo guardar la referencia de la plantilla {template_hash[:12]}")
+        reference = self._compute(template_hash, image)
+        with self._lock:
+            self._put(reference)
+        return reference
+
+    def _compute(self, template_hash: str, image: np.ndarray) -> TemplateReference:
+        reference = TemplateReference.compute(template_hash, image)
+        logger.info(f"Referencia de la plantilla {template_hash[:12]}: "
+                    f"{'4 fiduciales' if reference.fiducials is not None else 'sin fiduciales'}, "
+                    f"{len(reference.keypoints)} puntos ORB")
+        if self.persist:
+            try:
+                reference.save(self._data_path(template_hash))
+            except Exception as e:
+                logger.warning(f"No se pudo guardar la referencia {template_hash[:12]}: {e}")
+        return reference
+
+reference_cache = ReferenceCache(
+    settings.TEMPLATE_CACHE_SIZE, str(settings.TEMPLATE_CACHE_DIR), settings.TEMPLATE_CACHE_PERSIST
+)
+
+set_reference = reference_cache.set
+has_reference = reference_cache.has
+
+def register_page(image: np.ndarray, template_hash: Optional[str], gray: np.ndarray = None) -> RegistrationResult:
+    """
+    Alinear una página con la referencia de su plantilla, si la tiene
+
+    `gray` es la página en grises si ya se tiene (ver `register`).
+
+    Con REGISTRATION_ENABLED desactivado, sin plantilla o sin referencia, o
+    si el registro falla, se devuelve la página sin cambios.
+    """
+    if not settings.REGISTRATION_ENABLED or not template_hash:
+        return RegistrationResult(image)
+    reference = reference_cache.get(template_hash)
+    if reference is None:
+        return RegistrationResult(image)
+
+    with span('register'):
+        try:
+            result = register(image, reference, gray=gray)
+        except Exception as e:
+            logger.warning(f"Error al registrar la página: {e}", exc_info=True)
+            return RegistrationResult(image)
+
+    if result.applied:
+        logger.info(f"Página registrada ({result.method}{', girada 180°' if result.rotated else ''}, "
+                    f"{result.inliers} puntos, similitud {result.score:.3f})")
+    else:
+        logger.warning(f"No se pudo registrar la página contra la plantilla {template_hash[:12]}")
+    return result
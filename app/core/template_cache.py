@@ -0,0 +1,326 @@
+"""
+Plantillas de zonas compiladas y cacheadas por el hash de su JSON.
+
+El JSON de zonas se recorre una sola vez por contenido: los nombres, los
+rectángulos, el tipo de cada campo (texto o marca), el tipo de casilla
+(círculo o cuadrado) y las agrupaciones de rejilla se guardan en arrays de
+NumPy dentro de un `CompiledTemplate`. Las plantillas se indexan por el
+SHA-256 del JSON en una caché LRU y, opcionalmente, se persisten como un
+directorio de .npy (abiertos con mmap) para sobrevivir a reinicios. Las sesiones guardan el hash y comparten la
+misma plantilla en lugar de llevar su propia copia.
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Tipos de campo
+TEXT = 0
+MARK = 1
+
+# Tipos de casilla de marca
+NO_MARK_TYPE = 0
+CIRCLE = 1
+SQUARE = 2
+
+MARK_TYPE_NAMES = {CIRCLE: 'circle', SQUARE: 'square'}
+
+# Agrupaciones de rejilla: preguntas (1A, 1B...), reservas (R1A...) y columnas del DNI (D{fila}{columna})
+QUESTION_PATTERN = re.compile(r'^(\d+)[A-Z]$')
+RESERVE_PATTERN = re.compile(r'^R(\d+)[A-Z]$')
+DNI_PATTERN = re.compile(r'^D(\d)(\d)$')
+
+def is_text_field(field_name):
+    """Determina si un campo es de texto basado en su nombre"""
+    return field_name == "DNI" or len(field_name) >= 4
+
+def is_mark_field(field_name):
+    """Determina si un campo es de marca basado en su nombre"""
+    if not field_name:
+        return False
+    # Reglas para identificar campos de marca (R1A, R2B, etc.)
+    if field_name.startswith(('R', 'M')) and len(field_name) <= 3:
+        return True
+    elif len(field_name) < 4 and field_name != "DNI":
+        return True
+    return False
+
+def mark_type_for(w: int, h: int) -> int:
+    """Tipo de casilla según sus dimensiones (misma regla que `detect_mark_types`)"""
+    aspect_ratio = w / h if h > 0 else 1
+    if 0.8 <= aspect_ratio <= 1.2 and max(w, h) < 30:  # Casi cuadrado y pequeño
+        return CIRCLE
+    return SQUARE
+
+def group_for(field_name: str) -> Optional[str]:
+    """Grupo de rejilla de un campo, o None si no pertenece a ninguno"""
+    match = RESERVE_PATTERN.match(field_name)
+    if match:
+        return f"R{int(match.group(1))}"
+    match = QUESTION_PATTERN.match(field_name)
+    if match:
+        return f"Q{int(match.group(1))}"
+    match = DNI_PATTERN.match(field_name)
+    if match:
+        return f"DNI{match.group(2)}"
+    return None
+
+def hash_zones(raw: bytes) -> str:
+    """SHA-256 del contenido de un JSON de zonas"""
+    return hashlib.sha256(raw).hexdigest()
+
+class CompiledTemplate:
+    """
+    JSON de zonas ya analizado
+
+    Attributes:
+        hash: SHA-256 del JSON
+        zones_info: JSON analizado (compartido; no debe modificarse)
+        names: Nombres de los campos en el orden del JSON
+        kinds: Tipo de cada campo (TEXT o MARK) según `is_text_field`
+        rects: Rectángulos (x, y, w, h) en int32; -1 si la zona no es válida
+        valid: Máscara de zonas con rectángulo válido
+        mark_types: Tipo de casilla (CIRCLE o SQUARE; NO_MARK_TYPE si no es marca)
+        group_names: Nombres de los grupos de rejilla
+        group_of: Índice en `group_names` de cada campo (-1 si no tiene grupo)
+    """
+
+    def __init__(self, template_hash: str, zones_info, names: List[str], rects: np.ndarray,
+                 group_names: List[str] = None, group_of: np.ndarray = None):
+        self.hash = template_hash
+        self.zones_info = zones_info
+        self.names = list(names)
+        self.rects = np.asarray(rects, dtype=np.int32).reshape(-1, 4)
+        self.valid = self.rects[:, 2] > 0
+        self.kinds = np.array([TEXT if is_text_field(name) else MARK for name in self.names], dtype=np.int8)
+
+        is_mark = (self.kinds == MARK) & self.valid
+        self.mark_types = np.full(len(self.names), NO_MARK_TYPE, dtype=np.int8)
+        for i in np.flatnonzero(is_mark):
+            self.mark_types[i] = mark_type_for(int(self.rects[i, 2]), int(self.rects[i, 3]))
+
+        if group_names is None:
+            groups = [group_for(name) for name in self.names]
+            group_names = sorted({g for g in groups if g is not None})
+            position = {g: i for i, g in enumerate(group_names)}
+            group_of = np.array([position[g] if g is not None else -1 for g in groups], dtype=np.int16)
+        self.group_names = list(group_names)
+        self.group_of = np.asarray(group_of, dtype=np.int16)
+
+        # Vistas derivadas para el resto de la aplicación
+        self.text_fields = [n for n, k in zip(self.names, self.kinds) if k == TEXT]
+        self.mark_fields = [n for n, k in zip(self.names, self.kinds) if k == MARK]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.rois = {name: [int(v) for v in self.rects[i]] for i, name in enumerate(self.names) if self.valid[i]}
+
+        # Caja que envuelve todas las zonas de marca (región del índice integral)
+        self.mark_bounds = None
+        if is_mark.any():
+            marks = self.rects[is_mark]
+            x0, y0 = marks[:, 0].min(), marks[:, 1].min()
+            x1, y1 = (marks[:, 0] + marks[:, 2]).max(), (marks[:, 1] + marks[:, 3]).max()
+            self.mark_bounds = (int(x0), int(y0), int(x1 - x0), int(y1 - y0))
+
+    @classmethod
+    def compile(cls, raw: bytes, zones_info=None) -> "CompiledTemplate":
+        """
+        Compilar un JSON de zonas
+
+        Args:
+            raw: Contenido del JSON tal como se subió
+            zones_info: JSON ya analizado (opcional, para no analizarlo dos veces)
+        """
+        if zones_info is None:
+            zones_info = json.loads(raw)
+
+        names = []
+        rects = []
+
+        # Recorrer el JSON una sola vez recogiendo nombres y rectángulos
+        def walk(data):
+            if isinstance(data, dict):
+                if 'name' in data:
+                    names.append(data['name'])
+                    rect = [-1, -1, -1, -1]
+                    if all(k in data for k in ['left', 'top', 'width', 'height']):
+                        x, y = int(data['left']), int(data['top'])
+                        w, h = int(data['width']), int(data['height'])
+                        if x >= 0 and y >= 0 and w > 0 and h > 0:
+                            rect = [x, y, w, h]
+                    rects.append(rect)
+                else:
+                    for value in data.values():
+                        walk(value)
+            elif isinstance(data, list):
+                for item in data:
+                    walk(item)
+
+        walk(zones_info)
+        return cls(hash_zones(raw), zones_info, names, rects)
+
+    def split(self, fields: List[str]) -> Tuple[List[str], List[str]]:
+        """Separar campos en (texto, marca) usando los tipos precalculados"""
+        text_fields = []
+        mark_fields = []
+        for field in fields:
+            i = self.index.get(field)
+            if i is None:
+                is_mark = is_mark_field(field)
+            else:
+                is_mark = self.kinds[i] == MARK
+            (mark_fields if is_mark else text_fields).append(field)
+        return text_fields, mark_fields
+
+    def groups(self) -> Dict[str, List[str]]:
+        """Campos de cada grupo de rejilla, en el orden del JSON"""
+        groups = {name: [] for name in self.group_names}
+        for name, group in zip(self.names, self.group_of):
+            if group >= 0:
+                groups[self.group_names[group]].append(name)
+        return groups
+
+    def save(self, path: str):
+        """
+        Guardar la plantilla como un directorio con un .npy por array
+
+        Se escribe en un directorio temporal que después se renombra, de
+        modo que otro proceso nunca ve una plantilla a medio guardar.
+        """
+        arrays = {
+            'zones_json': np.frombuffer(json.dumps(self.zones_info).encode('utf-8'), dtype=np.uint8),
+            'names': np.array(self.names, dtype=str),
+            'rects': self.rects,
+            'group_names': np.array(self.group_names, dtype=str),
+            'group_of': self.group_of
+        }
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(path):  # Si otro proceso la guardó antes, no es un error
+                raise
+
+    @classmethod
+    def load(cls, template_hash: str, path: str) -> "CompiledTemplate":
+        """
+        Cargar una plantilla guardada con `save`
+
+        Los arrays se abren con mmap en solo lectura: los rectángulos y los
+        grupos se comparten entre procesos a través de la caché de páginas
+        del sistema en lugar de copiarse.
+        """
+        def array(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+
+        zones_info = json.loads(array('zones_json').tobytes().decode('utf-8'))
+        return cls(
+            template_hash, zones_info,
+            [str(name) for name in array('names')], array('rects'),
+            [str(name) for name in array('group_names')], array('group_of')
+        )
+
+class TemplateCache:
+    """Caché LRU de plantillas compiladas, con persistencia opcional en disco"""
+
+    def __init__(self, max_entries: int, persist_dir: str = None):
+        self.max_entries = max_entries
+        self.persist_dir = persist_dir
+        self._templates: "OrderedDict[str, CompiledTemplate]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, template_hash: str) -> str:
+        return os.path.join(self.persist_dir, template_hash)
+
+    def _put(self, template: CompiledTemplate):
+        self._templates[template.hash] = template
+        self._templates.move_to_end(template.hash)
+        while len(self._templates) > self.max_entries:
+            evicted, _ = self._templates.popitem(last=False)
+            logger.debug(f"Plantilla {evicted[:12]} descartada de la caché")
+
+    def get(self, template_hash: str, json_path: str = None) -> Optional[CompiledTemplate]:
+        """
+        Obtener una plantilla por su hash
+
+        Si no está en memoria se busca en disco y, en último caso, se
+        recompila desde `json_path`.
+        """
+        with self._lock:
+            template = self._templates.get(template_hash)
+            if template is not None:
+                self._templates.move_to_end(template_hash)
+                return template
+
+        if self.persist_dir and os.path.exists(self._path(template_hash)):
+            try:
+                template = CompiledTemplate.load(template_hash, self._path(template_hash))
+            except Exception as e:
+                logger.warning(f"No se pudo cargar la plantilla {template_hash[:12]} de disco: {e}")
+
+        if template is None and json_path and os.path.exists(json_path):
+            with open(json_path, 'rb') as f:
+                raw = f.read()
+            if hash_zones(raw) == template_hash:
+                template = CompiledTemplate.compile(raw)
+
+        if template is not None:
+            with self._lock:
+                self._put(template)
+        return template
+
+    def load(self, raw: bytes, zones_info=None) -> CompiledTemplate:
+        """
+        Obtener la plantilla de un JSON de zonas, compilándola si es nueva
+
+        Args:
+            raw: Contenido del JSON
+            zones_info: JSON ya analizado (opcional)
+        """
+        template_hash = hash_zones(raw)
+        template = self.get(template_hash)
+        if template is not None:
+            logger.info(f"Plantilla {template_hash[:12]} reutilizada de la caché")
+            return template
+
+        template = CompiledTemplate.compile(raw, zones_info)
+        logger.info(f"Plantilla {template_hash[:12]} compilada: {len(template.names)} campos, "
+                    f"{len(template.group_names)} grupos")
+
+        if self.persist_dir:
+            try:
+                os.makedirs(self.persist_dir, exist_ok=True)
+                template.save(self._path(template_hash))
+            except Exception as e:
+                logger.warning(f"No se pudo guardar la plantilla {template_hash[:12]}: {e}")
+
+        with self._lock:
+            self._put(template)
+        return template
+
+template_cache = TemplateCache(
+    settings.TEMPLATE_CACHE_SIZE,
+    str(settings.TEMPLATE_CACHE_DIR) if settings.TEMPLATE_CACHE_PERSIST else None
+)
+
+load_template = template_cache.load
+get_template = template_cache.get
+
+def get_session_template(session) -> Optional[CompiledTemplate]:
+    """Obtener la plantilla compilada de una sesión, si la tiene"""
+    if not getattr(session, 'template_hash', None):
+        return None
+    return get_template(session.template_hash, session.json_path)
\ No newline at end of file
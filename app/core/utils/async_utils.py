@@ -1,33 +1,213 @@
-import threading
+"""
+Plazos por petición y ejecutor compartido de tareas con timeout.
+
+Cada petición HTTP abre un plazo (REQUEST_DEADLINE) que se guarda en una
+variable de contexto; las etapas lo consultan para saber cuánto tiempo les
+queda (`time_budget`), se detienen en puntos de control si ha vencido
+(`check_deadline`) y omiten el trabajo opcional cuando queda poco margen
+(`allows_optional`).
+
+Las tareas con timeout se ejecutan en un único pool de hilos acotado
+(TASK_WORKERS) en lugar de crear un hilo por llamada. Si una tarea vence, se
+cancela su plazo para que se detenga en su siguiente punto de control; si
+ya estaba en marcha se cuenta como abandonada hasta que termina.
+"""
+
+import time
 import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Optional
+from app.config import settings
+from app.core.utils.metrics import register_gauge
 
 logger = logging.getLogger(__name__)
 
-def process_with_timeout(func, args=(), timeout=30):
-    """Ejecutar una función con timeout usando threading"""
-    result = [None]
-    error = [None]
-    
-    def worker():
+class DeadlineExceeded(TimeoutError):
+    """Se ha agotado el plazo de la petición o de la tarea"""
+
+class Deadline:
+    """
+    Plazo con cancelación cooperativa
+
+    Un plazo hijo vence cuando vence el suyo o el de su padre, de modo que
+    el presupuesto de la petición llega a todas las etapas.
+    """
+
+    def __init__(self, seconds: float = None, parent: 'Deadline' = None):
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        self.parent = parent
+        self._cancelled = threading.Event()
+
+    def remaining(self) -> float:
+        """Segundos restantes (inf si no hay límite, 0 si ha vencido o se ha cancelado)"""
+        if self.cancelled:
+            return 0.0
+        remaining = float('inf') if self.expires_at is None else max(0.0, self.expires_at - time.monotonic())
+        if self.parent is not None:
+            remaining = min(remaining, self.parent.remaining())
+        return remaining
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def cancel(self):
+        """Cancelar el plazo: las etapas que lo consulten se detendrán"""
+        self._cancelled.set()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str = None):
+        """
+        Punto de control de cancelación
+
+        Raises:
+            DeadlineExceeded: Si el plazo ha vencido o se ha cancelado
+        """
+        if self.expired():
+            raise DeadlineExceeded(f"Plazo agotado{f' antes de {stage}' if stage else ''}")
+
+    def budget(self, limit: float = None) -> Optional[float]:
+        """
+        Tiempo que puede esperar una operación con su propio límite
+
+        Args:
+            limit: Límite propio de la operación (None = sin límite)
+
+        Returns:
+            El menor entre `limit` y el tiempo restante (None si ninguno limita)
+
+        Raises:
+            DeadlineExceeded: Si el plazo ya ha vencido
+        """
+        self.check()
+        remaining = self.remaining()
+        if limit is None:
+            return None if remaining == float('inf') else remaining
+        return min(limit, remaining)
+
+    def allows(self, seconds: float) -> bool:
+        """Indicar si quedan más de `seconds` segundos"""
+        return self.remaining() > seconds
+
+# Plazo sin límite para el código que se ejecuta fuera de una petición
+NO_DEADLINE = Deadline()
+
+_current_deadline = contextvars.ContextVar('deadline', default=NO_DEADLINE)
+
+def current_deadline() -> Deadline:
+    """Plazo del contexto actual (sin límite fuera de una petición)"""
+    return _current_deadline.get()
+
+def set_deadline(deadline: Deadline) -> contextvars.Token:
+    """Establecer el plazo del contexto actual; devuelve el token para `reset_deadline`"""
+    return _current_deadline.set(deadline)
+
+def reset_deadline(token: contextvars.Token):
+    """Restaurar el plazo anterior a `set_deadline`"""
+    _current_deadline.reset(token)
+
+@contextmanager
+def deadline_scope(seconds: float = None):
+    """Abrir un plazo hijo del actual durante el bloque"""
+    deadline = Deadline(seconds, parent=current_deadline())
+    token = set_deadline(deadline)
+    try:
+        yield deadline
+    finally:
+        reset_deadline(token)
+
+def check_deadline(stage: str = None):
+    """Punto de control sobre el plazo actual (ver `Deadline.check`)"""
+    current_deadline().check(stage)
+
+def time_budget(limit: float = None) -> Optional[float]:
+    """Tiempo disponible para una operación con su propio límite (ver `Deadline.budget`)"""
+    return current_deadline().budget(limit)
+
+def allows_optional() -> bool:
+    """Indicar si queda margen para trabajo opcional (DEADLINE_OPTIONAL_RESERVE)"""
+    return current_deadline().allows(settings.DEADLINE_OPTIONAL_RESERVE)
+
+class TaskExecutor:
+    """Pool de hilos acotado para tareas con plazo"""
+
+    def __init__(self, workers: int, name: str = 'task'):
+        self.workers = workers
+        self.active = 0
+        self.abandoned = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+
+    def submit(self, func: Callable[..., Any], *args, deadline: Deadline = None, **kwargs) -> Future:
+        """
+        Encolar una tarea con el plazo indicado (por defecto, el actual)
+
+        La tarea se ejecuta en una copia del contexto de quien la envía, con
+        su plazo como plazo actual.
+        """
+        deadline = deadline or current_deadline()
+        context = contextvars.copy_context()
+
+        def run():
+            with self._lock:
+                self.active += 1
+            token = set_deadline(deadline)
+            try:
+                deadline.check()
+                return func(*args, **kwargs)
+            finally:
+                reset_deadline(token)
+                with self._lock:
+                    self.active -= 1
+
+        return self._executor.submit(context.run, run)
+
+    def run(self, func: Callable[..., Any], *args, timeout: float = None, **kwargs) -> Any:
+        """
+        Ejecutar una tarea y esperar su resultado como mucho `timeout` segundos
+
+        El plazo de la tarea es hijo del actual, así que tampoco supera el
+        tiempo restante de la petición.
+
+        Raises:
+            DeadlineExceeded: Si vence el plazo; la tarea se cancela
+            Exception: La que lance la tarea
+        """
+        deadline = Deadline(timeout, parent=current_deadline())
+        deadline.check(getattr(func, '__name__', None))
+        future = self.submit(func, *args, deadline=deadline, **kwargs)
+        remaining = deadline.remaining()
         try:
-            if isinstance(args, dict):
-                ret = func(**args)
-            else:
-                ret = func(*args)
-            result[0] = ret
-        except Exception as e:
-            error[0] = e
-    
-    thread = threading.Thread(target=worker)
-    thread.daemon = True
-    thread.start()
-    thread.join(timeout)
-    
-    if thread.is_alive():
-        logger.error("Timeout en operación")
-        raise TimeoutError("Operation timed out")
-    
-    if error[0] is not None:
-        raise error[0]
-    
-    return result[0] if result else None
+            return future.result(timeout=None if remaining == float('inf') else remaining)
+        except FutureTimeoutError:
+            deadline.cancel()
+            if not future.cancel():
+                with self._lock:
+                    self.abandoned += 1
+                logger.warning(f"Tarea {getattr(func, '__name__', func)} abandonada al vencer su plazo")
+            raise DeadlineExceeded("Operation timed out")
+
+    def shutdown(self, wait: bool = True):
+        """Cerrar el pool (solo para ejecutores propios, no el compartido)"""
+        self._executor.shutdown(wait=wait)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+register_gauge('omr_tasks_active', 'Tareas en ejecución en el ejecutor compartido',
+               lambda: _executor.active if _executor else 0)
+register_gauge('omr_tasks_abandoned_total', 'Tareas que seguían en marcha al vencer su plazo',
+               lambda: _executor.abandoned if _executor else 0, metric_type='counter')
+
+def get_task_executor() -> TaskExecutor:
+    """Obtener el ejecutor compartido del proceso, creándolo si no existe"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = TaskExecutor(settings.TASK_WORKERS)
+        return _executor
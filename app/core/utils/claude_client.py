@@ -0,0 +1,349 @@
+"""
+Pasarela concurrente hacia la API de Claude.
+
+Todas las peticiones del proceso pasan por un único cliente asíncrono
+(`anthropic.AsyncAnthropic`) que corre en un bucle de eventos propio, en un
+hilo de fondo, de modo que el código síncrono de Flask y de los trabajos
+puede lanzar varias peticiones a la vez. Sobre el cliente se aplican:
+
+    - Un máximo de peticiones en vuelo (CLAUDE_MAX_IN_FLIGHT)
+    - Un limitador de cubeta de fichas para peticiones y tokens por minuto
+      (CLAUDE_RPM, CLAUDE_TPM). Los tokens se estiman antes de enviar y se
+      corrigen con el uso real de la respuesta.
+    - Reintentos con espera exponencial y jitter ante 429, 5xx y errores de
+      conexión, respetando la cabecera retry-after si la hay
+    - Un cortocircuito: tras CLAUDE_BREAKER_THRESHOLD fallos seguidos se
+      rechazan las peticiones durante CLAUDE_BREAKER_COOLDOWN segundos y
+      después se deja pasar una de prueba
+
+CLAUDE_BASE_URL permite apuntar a un servidor que imite la Messages API y
+CLAUDE_STUB_URL al servidor de pruebas local (`tools/claude_stub.py`), que
+no necesita clave.
+"""
+
+import io
+import os
+import time
+import base64
+import random
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List
+import anthropic
+from PIL import Image
+from app.config import settings
+from app.core.utils.metrics import register_gauge
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PIXELS_PER_TOKEN = 750  # Estimación de tokens de imagen de la documentación de Claude
+DOCUMENT_TOKENS = 3000  # Estimación por documento PDF (texto e imagen de una página)
+
+class CircuitOpenError(RuntimeError):
+    """La pasarela rechaza peticiones tras demasiados fallos seguidos"""
+
+class TokenBucket:
+    """
+    Cubeta de fichas que se rellena de forma continua
+
+    Admite deuda: si una petición consume más de lo estimado, las
+    siguientes esperan hasta que la cubeta se recupera.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Segundos que faltan para poder consumir `amount` fichas"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self._tokens >= amount else (amount - self._tokens) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self._tokens -= amount
+
+    def refund(self, amount: float):
+        """Devolver (o cobrar, si es negativo) la diferencia con el consumo real"""
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens + amount)
+
+class CircuitBreaker:
+    """Cortocircuito por fallos consecutivos con estado semiabierto"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self) -> bool:
+        """Decidir si una petición puede salir (en semiabierto, solo una de prueba)"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Cortocircuito de Claude cerrado")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def release(self):
+        """Liberar la prueba del semiabierto sin contar éxito ni fallo"""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.error(f"Cortocircuito de Claude abierto tras {self.failures} fallos seguidos")
+            self.opened_at = time.monotonic()
+
+def is_retryable(error: Exception) -> bool:
+    """429, 5xx (incluido 529 de sobrecarga), timeouts y errores de conexión"""
+    if isinstance(error, (anthropic.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+def is_outage(error: Exception) -> bool:
+    """5xx, timeouts y errores de conexión: los fallos que cuenta el cortocircuito"""
+    return is_retryable(error) and not (isinstance(error, anthropic.APIStatusError) and error.status_code == 429)
+
+def retry_after(error: Exception) -> float:
+    """Segundos indicados por la cabecera retry-after, o None"""
+    response = getattr(error, 'response', None)
+    value = response.headers.get('retry-after') if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def estimate_tokens(request: Dict[str, Any]) -> int:
+    """Estimar los tokens (entrada y salida) de una petición a la Messages API"""
+    tokens = request.get('max_tokens', 0)
+    for message in request.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for block in content:
+            if block.get('type') == 'text':
+                tokens += len(block.get('text', '')) // 4
+            elif block.get('type') == 'image':
+                try:
+                    data = base64.b64decode(block['source']['data'])
+                    width, height = Image.open(io.BytesIO(data)).size
+                    tokens += width * height // IMAGE_PIXELS_PER_TOKEN
+                except Exception:
+                    tokens += 1600  # Máximo habitual de una imagen
+            elif block.get('type') == 'document':
+                tokens += DOCUMENT_TOKENS
+    return tokens
+
+class ClaudeGateway:
+    """Cliente asíncrono compartido con concurrencia, límites, reintentos y cortocircuito"""
+
+    def __init__(self, api_key: str, base_url: str = None, max_in_flight: int = 4,
+                 requests_per_minute: int = 50, tokens_per_minute: int = 40000,
+                 max_retries: int = 4, backoff_base: float = 1.0, backoff_max: float = 30.0,
+                 breaker_threshold: int = 5, breaker_cooldown: float = 30.0, timeout: float = 30.0):
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.requests_bucket = TokenBucket(requests_per_minute)
+        self.tokens_bucket = TokenBucket(tokens_per_minute)
+        self.in_flight = 0
+        self.retries = 0
+        self.rejected = 0
+
+        # El cliente se crea dentro del bucle para que sus conexiones pertenezcan a él
+        self._client_args = {'api_key': api_key, 'base_url': base_url, 'max_retries': 0, 'timeout': timeout}
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name='claude-gateway', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._client = anthropic.AsyncAnthropic(**self._client_args)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._limit_lock = asyncio.Lock()
+        self._ready.set()
+        self._loop.run_forever()
+
+    def submit(self, **request) -> Future:
+        """Encolar una petición a messages.create y devolver un Future con la respuesta"""
+        return asyncio.run_coroutine_threadsafe(self._create(request), self._loop)
+
+    def create(self, deadline: float = None, **request):
+        """
+        Equivalente síncrono de `messages.create` (bloquea hasta la respuesta)
+
+        Args:
+            deadline: Segundos máximos de espera, reintentos incluidos; al
+                vencer se cancela la petición
+
+        Raises:
+            TimeoutError: Si vence el plazo
+        """
+        future = self.submit(**request)
+        try:
+            return future.result(deadline)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError(f"Claude no respondió en {deadline}s")
+
+    def create_many(self, requests: List[Dict[str, Any]]) -> List[Any]:
+        """Lanzar varias peticiones a la vez; cada elemento es la respuesta o la excepción"""
+        futures = [self.submit(**request) for request in requests]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def _acquire_limits(self, tokens: int):
+        """Esperar a que ambas cubetas tengan capacidad y consumirla"""
+        async with self._limit_lock:
+            while True:
+                wait = max(self.requests_bucket.wait_time(1), self.tokens_bucket.wait_time(tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.requests_bucket.consume(1)
+            self.tokens_bucket.consume(tokens)
+
+    async def _create(self, request: Dict[str, Any]):
+        estimated = estimate_tokens(request)
+        attempt = 0
+        while True:
+            probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+            if not self.breaker.allow():
+                self.rejected += 1
+                raise CircuitOpenError("Claude no disponible temporalmente (cortocircuito abierto)")
+
+            try:
+                await self._acquire_limits(estimated)
+                async with self._semaphore:
+                    self.in_flight += 1
+                    try:
+                        response = await asyncio.wait_for(self._client.messages.create(**request), self.timeout)
+                    finally:
+                        self.in_flight -= 1
+            except asyncio.CancelledError:
+                # Cancelada al vencer el plazo de `create`: si era la petición de
+                # prueba del semiabierto, cuenta como fallo para que no quede pendiente
+                if probe:
+                    self.breaker.record_failure()
+                raise
+            except Exception as e:
+                retryable = is_retryable(e)
+                if is_outage(e):
+                    self.breaker.record_failure()
+                else:
+                    # Un 4xx (400, 401, 429 de nuestro propio ritmo...) no indica si
+                    # la API está caída o no: no cuenta, solo libera la prueba
+                    self.breaker.release()
+                if not retryable or attempt >= self.max_retries:
+                    raise
+
+                delay = retry_after(e)
+                if delay is None:
+                    # Espera exponencial con jitter completo
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"Petición a Claude fallida ({type(e).__name__}); "
+                               f"reintento {attempt}/{self.max_retries} en {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            self.breaker.record_success()
+            usage = getattr(response, 'usage', None)
+            if usage is not None:
+                actual = (getattr(usage, 'input_tokens', 0) or 0) + (getattr(usage, 'output_tokens', 0) or 0)
+                self.tokens_bucket.refund(estimated - actual)
+            return response
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+register_gauge('omr_claude_in_flight', 'Peticiones a Claude en curso',
+               lambda: _gateway.in_flight if _gateway else 0)
+register_gauge('omr_claude_retries_total', 'Reintentos de peticiones a Claude',
+               lambda: _gateway.retries if _gateway else 0, metric_type='counter')
+register_gauge('omr_claude_breaker_open', 'Cortocircuito de Claude abierto (1) o cerrado (0)',
+               lambda: int(_gateway is not None and _gateway.breaker.state == CircuitBreaker.OPEN))
+
+def get_claude_gateway() -> ClaudeGateway:
+    """
+    Obtener la pasarela de Claude del proceso, creándola si no existe
+
+    Raises:
+        ValueError: Si ANTHROPIC_API_KEY no está configurada (salvo con
+            CLAUDE_STUB_URL)
+    """
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            api_key = os.getenv("ANTHROPIC_API_KEY")
+            base_url = settings.CLAUDE_BASE_URL
+            if settings.CLAUDE_STUB_URL:
+                api_key, base_url = 'stub', settings.CLAUDE_STUB_URL
+                logger.warning(f"Usando el servidor de pruebas de Claude en {base_url}")
+            elif not api_key or api_key == "your_api_key_here":
+                raise ValueError("ANTHROPIC_API_KEY no está configurada en el archivo .env")
+            _gateway = ClaudeGateway(
+                api_key,
+                base_url=base_url,
+                max_in_flight=settings.CLAUDE_MAX_IN_FLIGHT,
+                requests_per_minute=settings.CLAUDE_RPM,
+                tokens_per_minute=settings.CLAUDE_TPM,
+                max_retries=settings.CLAUDE_MAX_RETRIES,
+                backoff_base=settings.CLAUDE_BACKOFF_BASE,
+                backoff_max=settings.CLAUDE_BACKOFF_MAX,
+                breaker_threshold=settings.CLAUDE_BREAKER_THRESHOLD,
+                breaker_cooldown=settings.CLAUDE_BREAKER_COOLDOWN,
+                timeout=settings.CLAUDE_TIMEOUT
+            )
+            logger.info(f"Pasarela de Claude: {settings.CLAUDE_MAX_IN_FLIGHT} peticiones en vuelo, "
+                        f"{settings.CLAUDE_RPM} peticiones/min, {settings.CLAUDE_TPM} tokens/min")
+        return _gateway
@@ -0,0 +1,228 @@
+"""
+Escritura en segundo plano de las imágenes de debug de las marcas.
+
+Los procesadores entregan las etapas de cada campo (gris, binaria, final,
+contornos...) junto con su porcentaje y umbral; la política de muestreo
+decide si se guardan y un hilo escritor las codifica y escribe fuera del
+camino de la petición. La cola es acotada: si se llena, las imágenes se
+descartan en lugar de bloquear el reconocimiento.
+
+Políticas (DEBUG_POLICY):
+    off        No se guarda nada
+    ambiguous  Solo campos cuyo porcentaje está a menos de
+               DEBUG_AMBIGUOUS_MARGIN puntos del umbral
+    sample     Uno de cada DEBUG_SAMPLE_RATE campos
+    all        Todos los campos
+
+Empaquetado (DEBUG_PACKING):
+    files      Un PNG por etapa y campo ({campo}_{etapa}.png)
+    mosaic     Un único debug_mosaic.png por hoja, con una fila por campo
+    zip        Un único debug_stages.zip por hoja con los PNG de cada etapa
+"""
+
+import os
+import queue
+import atexit
+import logging
+import zipfile
+import itertools
+import threading
+import cv2
+import numpy as np
+from typing import Dict, List, Tuple
+from app.config import settings
+from app.core.utils.metrics import register_gauge
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('off', 'ambiguous', 'sample', 'all')
+PACKINGS = ('files', 'mosaic', 'zip')
+
+MOSAIC_ROW_HEIGHT = 64  # Alto de cada etapa en el mosaico
+MOSAIC_LABEL_WIDTH = 120  # Margen izquierdo para el nombre del campo
+MOSAIC_GAP = 4
+
+class DebugSink:
+    """Cola acotada de imágenes de debug con un hilo escritor"""
+
+    def __init__(self, policy: str = 'ambiguous', packing: str = 'files', sample_rate: int = 10,
+                 ambiguous_margin: float = 5.0, queue_size: int = 256):
+        if policy not in POLICIES:
+            raise ValueError(f"Política de debug no válida: {policy}. Opciones: {', '.join(POLICIES)}")
+        if packing not in PACKINGS:
+            raise ValueError(f"Empaquetado de debug no válido: {packing}. Opciones: {', '.join(PACKINGS)}")
+
+        self.policy = policy
+        self.packing = packing
+        self.sample_rate = max(1, sample_rate)
+        self.ambiguous_margin = ambiguous_margin
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._counter = itertools.count()
+        self._sheets: Dict[str, List[Tuple[str, List[Tuple[str, np.ndarray]]]]] = {}
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.policy != 'off'
+
+    def wants(self, percentage: float = None, threshold: float = None) -> bool:
+        """Decidir según la política si se guardan las imágenes de un campo"""
+        if self.policy == 'all':
+            return True
+        if self.policy == 'sample':
+            return next(self._counter) % self.sample_rate == 0
+        if self.policy == 'ambiguous':
+            if percentage is None or threshold is None:
+                return False
+            return abs(percentage - threshold) <= self.ambiguous_margin
+        return False
+
+    def submit(self, folder: str, field_name: str, stages: List[Tuple[str, np.ndarray]]):
+        """
+        Encolar las etapas de un campo para escribirlas en segundo plano
+
+        Las imágenes se copian, ya que pueden ser vistas de una página que
+        deja de existir al terminar la petición.
+
+        Args:
+            folder: Carpeta de debug de la hoja
+            field_name: Nombre del campo
+            stages: Lista de (nombre_etapa, imagen)
+        """
+        stages = [(stage, image.copy()) for stage, image in stages if image is not None]
+        if stages:
+            self._put(('field', folder, field_name, stages))
+
+    def end_sheet(self, folder: str):
+        """Marcar el final de una hoja (cierra el mosaico o el zip de la carpeta)"""
+        if self.enabled and self.packing != 'files':
+            self._put(('sheet', folder, None, None))
+
+    def queue_size(self) -> int:
+        """Número de elementos pendientes de escribir"""
+        return self._queue.qsize()
+
+    def flush(self):
+        """Esperar a que se escriban todos los elementos encolados"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _put(self, item):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning(f"Cola de debug llena: {self.dropped} elementos descartados")
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='debug-sink', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            kind, folder, field_name, stages = self._queue.get()
+            try:
+                if kind == 'field':
+                    if self.packing == 'files':
+                        self._write_files(folder, field_name, stages)
+                    else:
+                        self._sheets.setdefault(folder, []).append((field_name, stages))
+                elif kind == 'sheet':
+                    self._write_sheet(folder)
+            except Exception as e:
+                logger.error(f"Error escribiendo imágenes de debug en {folder}: {e}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    def _write_files(self, folder: str, field_name: str, stages):
+        os.makedirs(folder, exist_ok=True)
+        for stage, image in stages:
+            cv2.imwrite(os.path.join(folder, f"{field_name}_{stage}.png"), image)
+            self.written += 1
+
+    def _write_sheet(self, folder: str):
+        fields = self._sheets.pop(folder, None)
+        if not fields:
+            return
+        os.makedirs(folder, exist_ok=True)
+
+        if self.packing == 'zip':
+            with zipfile.ZipFile(os.path.join(folder, 'debug_stages.zip'), 'w', zipfile.ZIP_STORED) as archive:
+                for field_name, stages in fields:
+                    for stage, image in stages:
+                        ok, buffer = cv2.imencode('.png', image)
+                        if ok:
+                            archive.writestr(f"{field_name}_{stage}.png", buffer.tobytes())
+        else:
+            cv2.imwrite(os.path.join(folder, 'debug_mosaic.png'), build_mosaic(fields))
+
+        self.written += 1
+        logger.debug(f"Debug de {len(fields)} campos empaquetado en {folder}")
+
+    def close(self):
+        """Escribir los mosaicos o zips pendientes y vaciar la cola"""
+        for folder in list(self._sheets):
+            self._put(('sheet', folder, None, None))
+        self.flush()
+
+def build_mosaic(fields: List[Tuple[str, List[Tuple[str, np.ndarray]]]]) -> np.ndarray:
+    """
+    Componer un mosaico con una fila por campo y una columna por etapa
+
+    Args:
+        fields: Lista de (campo, [(etapa, imagen), ...])
+
+    Returns:
+        Imagen BGR del mosaico
+    """
+    rows = []
+    for field_name, stages in fields:
+        tiles = []
+        for _, image in stages:
+            if image.ndim == 2:
+                image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+            h, w = image.shape[:2]
+            scale = MOSAIC_ROW_HEIGHT / max(h, 1)
+            tile = cv2.resize(image, (max(1, int(round(w * scale))), MOSAIC_ROW_HEIGHT), interpolation=cv2.INTER_NEAREST)
+            tiles.append(tile)
+            tiles.append(np.zeros((MOSAIC_ROW_HEIGHT, MOSAIC_GAP, 3), np.uint8))
+
+        label = np.zeros((MOSAIC_ROW_HEIGHT, MOSAIC_LABEL_WIDTH, 3), np.uint8)
+        cv2.putText(label, field_name, (4, MOSAIC_ROW_HEIGHT // 2 + 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+        rows.append(np.hstack([label] + tiles))
+
+    width = max(row.shape[1] for row in rows)
+    padded = [np.pad(row, ((0, MOSAIC_GAP), (0, width - row.shape[1]), (0, 0))) for row in rows]
+    return np.vstack(padded)
+
+_sink = None
+_sink_lock = threading.Lock()
+
+register_gauge('omr_debug_queue_depth', 'Imágenes de debug pendientes de escribir',
+               lambda: _sink.queue_size() if _sink else 0)
+register_gauge('omr_debug_dropped_total', 'Imágenes de debug descartadas por cola llena',
+               lambda: _sink.dropped if _sink else 0, metric_type='counter')
+
+def get_debug_sink() -> DebugSink:
+    """Obtener el sink de debug del proceso, creándolo si no existe"""
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = DebugSink(
+                policy=settings.DEBUG_POLICY,
+                packing=settings.DEBUG_PACKING,
+                sample_rate=settings.DEBUG_SAMPLE_RATE,
+                ambiguous_margin=settings.DEBUG_AMBIGUOUS_MARGIN,
+                queue_size=settings.DEBUG_QUEUE_SIZE
+            )
+            atexit.register(_sink.close)
+        return _sink
\ No newline at end of file
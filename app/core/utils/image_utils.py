@@ -3,6 +3,7 @@ import cv2
 import logging
 import numpy as np
 from app.config import settings
+from app.core.utils.page_cache import get_page
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +22,7 @@ def overlay_zones_on_image(image_path, zones_info, opacity=0.4, draw_labels=True
     """
     try:
         # Leer la imagen
-        image = cv2.imread(image_path)
+        image = get_page(image_path)
         if image is None:
             raise ValueError("No se pudo leer la imagen")
 
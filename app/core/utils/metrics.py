@@ -0,0 +1,141 @@
+"""
+Métricas de tiempo por etapa en memoria, exportables en formato Prometheus.
+
+Cada etapa se mide con `span('nombre')` como gestor de contexto. Las
+duraciones se acumulan en histogramas con recuento y suma totales y una
+ventana de las últimas muestras para calcular p50/p95/p99. Los gauges
+(sesiones activas, colas...) se registran con una función que devuelve su
+valor en el momento de exportar.
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW_SIZE = 1024  # Muestras recientes usadas para los cuantiles
+
+STAGE_METRIC = 'omr_stage_seconds'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class Histogram:
+    """Recuento, suma y ventana de muestras recientes de una métrica"""
+
+    def __init__(self, window_size: int = WINDOW_SIZE):
+        self.count = 0
+        self.sum = 0.0
+        self._window = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            self._window.append(value)
+
+    def snapshot(self) -> Tuple[int, float, Dict[float, float]]:
+        """Devolver (recuento, suma, {cuantil: valor})"""
+        with self._lock:
+            count, total, samples = self.count, self.sum, list(self._window)
+        if samples:
+            values = np.quantile(np.asarray(samples), QUANTILES)
+            quantiles = dict(zip(QUANTILES, (float(v) for v in values)))
+        else:
+            quantiles = {q: float('nan') for q in QUANTILES}
+        return count, total, quantiles
+
+class MetricsRegistry:
+    """Histogramas y gauges del proceso"""
+
+    def __init__(self):
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._help: Dict[str, str] = {}
+        self._gauges: List[Tuple[str, str, str, Callable[[], float]]] = []
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, help_text: str = None, **labels):
+        """Registrar una muestra en el histograma `name` con las etiquetas dadas"""
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            family = self._histograms.setdefault(name, {})
+            histogram = family.get(key)
+            if histogram is None:
+                histogram = family[key] = Histogram()
+            if help_text and name not in self._help:
+                self._help[name] = help_text
+        histogram.observe(value)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """Medir la duración de una etapa (también si lanza una excepción)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(STAGE_METRIC, time.perf_counter() - start,
+                         help_text='Duración de cada etapa del procesamiento', stage=stage)
+
+    def register_gauge(self, name: str, help_text: str, func: Callable[[], float], metric_type: str = 'gauge'):
+        """
+        Registrar un gauge evaluado al exportar
+
+        Args:
+            name: Nombre de la métrica
+            help_text: Descripción para la línea HELP
+            func: Función sin argumentos que devuelve el valor actual
+            metric_type: 'gauge' o 'counter'
+        """
+        with self._lock:
+            self._gauges = [g for g in self._gauges if g[0] != name]
+            self._gauges.append((name, help_text, metric_type, func))
+
+    def render_prometheus(self) -> str:
+        """Exportar todas las métricas en el formato de texto de Prometheus"""
+        lines = []
+        with self._lock:
+            histograms = {name: dict(family) for name, family in self._histograms.items()}
+            gauges = list(self._gauges)
+
+        for name, family in sorted(histograms.items()):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} summary")
+            for key, histogram in sorted(family.items()):
+                count, total, quantiles = histogram.snapshot()
+                for quantile, value in quantiles.items():
+                    lines.append(f"{name}{format_labels(key + (('quantile', str(quantile)),))} {value:.6f}")
+                lines.append(f"{name}_sum{format_labels(key)} {total:.6f}")
+                lines.append(f"{name}_count{format_labels(key)} {count}")
+
+        for name, help_text, metric_type, func in gauges:
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning(f"No se pudo leer la métrica {name}: {e}")
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels: Labels) -> str:
+    """Formatear etiquetas como {clave="valor",...}"""
+    if not labels:
+        return ""
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+registry = MetricsRegistry()
+
+span = registry.span
+observe = registry.observe
+register_gauge = registry.register_gauge
+render_prometheus = registry.render_prometheus
\ No newline at end of file
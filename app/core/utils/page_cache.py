@@ -0,0 +1,263 @@
+"""
+Caché de páginas decodificadas compartida por los endpoints.
+
+Decodificar la imagen de una página de 1786x2526 cuesta una lectura completa
+y ~13.5 MB en BGR. La caché guarda la imagen decodificada (y su versión en
+escala de grises) por ruta, con un presupuesto global de bytes y expulsión
+LRU. Cada entrada se valida con el mtime y el tamaño del archivo, de modo
+que si la imagen se reemplaza se vuelve a decodificar; `invalidate` la
+descarta explícitamente al subir una imagen nueva.
+
+Las páginas recién renderizadas se guardan con `write`: la imagen queda en
+la caché al momento y la copia PNG sin pérdida (cientos de ms por página)
+se escribe en segundo plano. Mientras tanto, `get` sirve la página desde
+la caché y solo espera a la escritura si se ha expulsado; quien necesite
+el archivo en disco usa `wait`.
+
+Las imágenes devueltas son de solo lectura: quien necesite dibujar sobre
+ellas debe trabajar sobre una copia.
+"""
+
+import os
+import logging
+import itertools
+import threading
+import cv2
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Tuple
+from app.config import settings
+from app.core.utils.metrics import register_gauge
+from app.core.utils.pdf_utils import save_page_image
+
+logger = logging.getLogger(__name__)
+
+BGR = 'bgr'
+GRAY = 'gray'
+
+
+class PageCache:
+    """Caché LRU de páginas decodificadas con presupuesto de bytes"""
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Tuple[float, int], np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._pending = {}  # Ruta -> (ficha, Future) de su escritura en curso
+        self._writes = itertools.count(1)
+        self._writer = None
+
+    def get(self, path: str, variant: str = BGR) -> Optional[np.ndarray]:
+        """
+        Obtener una página decodificada
+
+        Args:
+            path: Ruta de la imagen
+            variant: 'bgr' o 'gray'
+
+        Returns:
+            Imagen de solo lectura, o None si no se puede leer
+        """
+        token = self._pending_token(path)
+        if token is not None:
+            image = self._pending_entry(path, variant, token)
+            if image is not None:
+                return image
+            self.wait(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        signature = (stat.st_mtime, stat.st_size)
+
+        image = self._cached((path, variant), signature)
+        if image is not None:
+            self.hits += 1
+            return image
+        self.misses += 1
+        return self._decode(path, variant, signature)
+
+    def _pending_entry(self, path: str, variant: str, token) -> Optional[np.ndarray]:
+        """Variante de una página que se está escribiendo, si sigue en la caché"""
+        image = self._cached((path, variant), token)
+        if image is not None:
+            self.hits += 1
+            return image
+        bgr = self._cached((path, BGR), token) if variant == GRAY else None
+        if bgr is None:
+            return None
+        self.misses += 1
+        image = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+        image.flags.writeable = False
+        self._put((path, GRAY), token, image)
+        return image
+
+    def _cached(self, key, signature) -> Optional[np.ndarray]:
+        """Entrada vigente de la caché (sin contar acierto ni fallo)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                return entry[1]
+        return None
+
+    def _decode(self, path: str, variant: str, signature) -> Optional[np.ndarray]:
+        """Decodificar una variante y guardarla en la caché"""
+        if variant == GRAY:
+            # Derivar de la versión BGR para obtener lo mismo que cvtColor en los procesadores
+            bgr = self._cached((path, BGR), signature)
+            if bgr is None:
+                bgr = self._decode(path, BGR, signature)
+            image = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY) if bgr is not None else None
+        else:
+            image = cv2.imread(path)
+        if image is None:
+            return None
+
+        image.flags.writeable = False
+        self._put((path, variant), signature, image)
+        return image
+
+    def put(self, path: str, image: np.ndarray):
+        """
+        Guardar en la caché una página BGR que se acaba de escribir en `path`
+
+        Evita volver a decodificar una página recién renderizada. La imagen
+        debe coincidir con el contenido del archivo (formato sin pérdida) y
+        pasa a ser de solo lectura.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        self.invalidate(path)
+        image.flags.writeable = False
+        self._put((path, BGR), (stat.st_mtime, stat.st_size), image)
+
+    def write(self, path: str, image: np.ndarray) -> Future:
+        """
+        Guardar una página BGR como PNG y dejarla en la caché
+
+        Con PAGE_WRITE_ASYNC la imagen entra en la caché al momento y el PNG
+        se escribe en segundo plano. Hasta que termina, las entradas llevan
+        como firma una ficha propia de esta escritura, distinta de la de
+        cualquier otra a la misma ruta; después, la firma del archivo. La
+        imagen pasa a ser de solo lectura.
+
+        Returns:
+            Future de la escritura (ya resuelto si no es asíncrona)
+        """
+        image.flags.writeable = False
+        self.invalidate(path)
+        future = Future()
+        if not settings.PAGE_WRITE_ASYNC:
+            save_page_image(image, path)
+            self.put(path, image)
+            future.set_result(path)
+            return future
+
+        token = ('pending', next(self._writes))
+        with self._lock:
+            self._pending[path] = (token, future)
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='page-write')
+        self._put((path, BGR), token, image)
+
+        def run():
+            try:
+                save_page_image(image, path)
+                stat = os.stat(path)
+                self._settle(path, token, (stat.st_mtime, stat.st_size))
+                future.set_result(path)
+            except Exception as e:
+                logger.error(f"Error al guardar la página {path}: {e}", exc_info=True)
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    if self._pending.get(path, (None, None))[1] is future:
+                        del self._pending[path]
+
+        self._writer.submit(run)
+        return future
+
+    def _settle(self, path: str, token, signature):
+        """Dar la firma del archivo ya escrito a las entradas de su escritura"""
+        with self._lock:
+            for variant in (BGR, GRAY):
+                entry = self._entries.get((path, variant))
+                if entry is not None and entry[0] == token:
+                    self._entries[(path, variant)] = (signature, entry[1])
+
+    def _pending_token(self, path: str):
+        """Ficha de la escritura en curso de una ruta, o None"""
+        with self._lock:
+            return self._pending.get(path, (None, None))[0]
+
+    def is_pending(self, path: str) -> bool:
+        """Indicar si la página de una ruta se está escribiendo todavía"""
+        return self._pending_token(path) is not None
+
+    def version(self, path: str):
+        """
+        Versión del archivo de una página: su fecha de modificación o,
+        mientras se escribe, la ficha de esa escritura (distinta en cada una)
+        """
+        token = self._pending_token(path)
+        if token is not None:
+            return token
+        return os.path.getmtime(path)
+
+    def wait(self, path: str):
+        """Esperar a que termine la escritura en curso de una ruta, si la hay"""
+        with self._lock:
+            future = self._pending.get(path, (None, None))[1]
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                pass  # Ya registrado; quien lea verá que el archivo no existe
+
+    def exists(self, path: str) -> bool:
+        """Comprobar si existe una página, contando las que se están escribiendo"""
+        return self.is_pending(path) or os.path.exists(path)
+
+    def invalidate(self, path: str):
+        """Descartar todas las variantes de una ruta"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == path]:
+                self._remove(key)
+
+    def _put(self, key, signature, image: np.ndarray):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if image.nbytes > self.budget_bytes:
+                return
+            self._entries[key] = (signature, image)
+            self.bytes += image.nbytes
+            while self.bytes > self.budget_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                logger.debug(f"Página {oldest[0]} ({oldest[1]}) expulsada de la caché")
+
+    def _remove(self, key):
+        _, image = self._entries.pop(key)
+        self.bytes -= image.nbytes
+
+page_cache = PageCache(settings.PAGE_CACHE_MB * 1024 * 1024)
+
+get_page = page_cache.get
+cache_page = page_cache.put
+write_page = page_cache.write
+page_exists = page_cache.exists
+wait_page = page_cache.wait
+page_version = page_cache.version
+invalidate_page = page_cache.invalidate
+
+register_gauge('omr_page_cache_bytes', 'Bytes de páginas decodificadas en caché', lambda: page_cache.bytes)
+register_gauge('omr_page_cache_hits_total', 'Aciertos de la caché de páginas', lambda: page_cache.hits, metric_type='counter')
+register_gauge('omr_page_cache_misses_total', 'Fallos de la caché de páginas', lambda: page_cache.misses, metric_type='counter')
\ No newline at end of file
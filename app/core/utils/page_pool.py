@@ -0,0 +1,149 @@
+"""
+Pool de procesos para puntuar marcas de varias páginas en paralelo.
+
+Cada página decodificada se copia una sola vez a un bloque de memoria
+compartida; los workers la leen por nombre sin que el array de la página
+(~13.5 MB en BGR) se serialice en cada tarea. Cada worker mantiene su propio
+MarkProcessor inicializado y ejecuta el mismo núcleo que la vía en proceso
+(`app.core.pipeline.score_marks`), de modo que los resultados por página son
+idénticos.
+"""
+
+import os
+import time
+import atexit
+import logging
+import threading
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, Future
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Tuple
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Procesador del worker, creado por el inicializador del pool
+_worker_processor = None
+
+def _init_worker():
+    """Inicializar el worker con el MarkProcessor del registro listo para usar"""
+    global _worker_processor
+    from app.core.processors.registry import get_mark_processor
+    import app.core.pipeline  # noqa: F401 - importar antes de la primera tarea
+
+    _worker_processor = get_mark_processor()
+
+def _warm_up_task():
+    """Tarea vacía para forzar el arranque de los workers"""
+    time.sleep(0.1)
+    return os.getpid()
+
+def _attach(name: str) -> SharedMemory:
+    """Abrir un bloque de memoria compartida existente sin registrarlo de nuevo"""
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        return SharedMemory(name=name)
+
+def _score_page_marks(shm_name: str, shape: Tuple[int, ...], dtype: str, rects: List[Tuple[int, int, int, int]],
+                      roi_fields: List[str], debug_dir: str, preprocess_mode: str, scorer: str):
+    """Puntuar las marcas de una página leída desde memoria compartida (en el worker)"""
+    from app.core.pipeline import score_marks
+
+    shm = _attach(shm_name)
+    image = rois = None
+    try:
+        image = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        rois = [image[y:y+h, x:x+w] for (x, y, w, h) in rects]
+        return score_marks(_worker_processor, image, rois, roi_fields, rects, debug_dir, preprocess_mode, scorer)
+    finally:
+        # Liberar las vistas antes de cerrar el bloque
+        image = rois = None
+        shm.close()
+
+class PagePool:
+    """Pool de procesos precalentado para la etapa de marcas de páginas completas"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        context = multiprocessing.get_context(settings.PAGE_WORKER_START_METHOD)
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_worker
+        )
+        self._warm_up()
+
+    def _warm_up(self):
+        """Arrancar todos los workers antes de la primera página"""
+        start = time.perf_counter()
+        futures = [self._executor.submit(_warm_up_task) for _ in range(self.workers)]
+        pids = {future.result() for future in futures}
+        logger.info(f"Pool de páginas listo: {len(pids)} workers en {time.perf_counter() - start:.2f}s")
+
+    def submit_marks(self, image: np.ndarray, rects: List[Tuple[int, int, int, int]], roi_fields: List[str],
+                     debug_dir: str, preprocess_mode: str = None, scorer: str = None) -> Future:
+        """
+        Enviar la etapa de marcas de una página al pool
+
+        Args:
+            image: Imagen de la página
+            rects: Rectángulos (x, y, w, h) de las ROIs de marca
+            roi_fields: Campos correspondientes a cada rectángulo
+            debug_dir: Carpeta de debug de la sesión de la página
+            preprocess_mode: Modo de preprocesamiento de marcas
+            scorer: Scorer de marcas
+
+        Returns:
+            Future con la tupla (resultados_simples, resultados_detallados)
+        """
+        shm = SharedMemory(create=True, size=image.nbytes)
+        try:
+            np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[:] = image
+            future = self._executor.submit(
+                _score_page_marks, shm.name, image.shape, image.dtype.str,
+                list(rects), list(roi_fields), debug_dir, preprocess_mode, scorer
+            )
+        except Exception:
+            shm.close()
+            shm.unlink()
+            raise
+
+        def release(_):
+            shm.close()
+            shm.unlink()
+
+        future.add_done_callback(release)
+        return future
+
+    def shutdown(self):
+        """Detener los workers"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_page_pool() -> PagePool:
+    """
+    Obtener el pool de páginas del proceso, creándolo si no existe
+
+    Returns:
+        PagePool, o None si PAGE_WORKERS no habilita el pool
+    """
+    global _pool
+    if settings.PAGE_WORKERS <= 1:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = PagePool(settings.PAGE_WORKERS)
+            atexit.register(shutdown_page_pool)
+        return _pool
+
+def shutdown_page_pool():
+    """Detener el pool de páginas si está activo"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
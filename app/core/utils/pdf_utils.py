@@ -0,0 +1,319 @@
+import os
+import logging
+import tempfile
+import threading
+from typing import Iterator, Optional, Tuple
+import cv2
+import numpy as np
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image
+from app.config import settings
+from app.core.utils.metrics import span
+
+try:
+    import pymupdf
+except ImportError:  # PyMuPDF es opcional; sin él se usa Poppler
+    pymupdf = None
+
+logger = logging.getLogger(__name__)
+
+RASTERIZERS = ('auto', 'pymupdf', 'poppler')
+
+SCAN_COVERAGE = 0.98  # Fracción mínima de la página cubierta por la imagen de un escaneo
+
+def get_poppler_args():
+    """Obtener los argumentos de Poppler según el sistema operativo"""
+    if os.name == 'nt':  # Windows
+        poppler_path = r"C:\Python312\poppler-24.08.0\Library\bin"
+        logger.info(f"Windows: Usando Poppler desde: {poppler_path}")
+        return {'poppler_path': poppler_path}
+    else:  # Linux/Unix
+        logger.info("Linux: Usando Poppler del sistema")
+        return {}
+
+def iter_pdf_pages(pdf_path: str, first_page: int = 1, last_page: int = None,
+                   thread_count: int = None) -> Iterator[Tuple[int, Image.Image]]:
+    """
+    Renderizar las páginas de un PDF con Poppler de forma perezosa
+
+    Las páginas se convierten en bloques de `thread_count` páginas, de modo
+    que Poppler reparte cada bloque entre sus hilos sin materializar el
+    documento completo en memoria.
+
+    Args:
+        pdf_path: Ruta al PDF
+        first_page: Primera página (desde 1)
+        last_page: Última página (por defecto, la última del documento)
+        thread_count: Páginas por bloque e hilos de Poppler
+
+    Yields:
+        Tuplas (número_de_página, imagen PIL)
+    """
+    conversion_args = get_poppler_args()
+    thread_count = thread_count or settings.PDF_THREAD_COUNT
+    if last_page is None:
+        last_page = PopplerRasterizer().page_count(pdf_path)
+
+    for chunk_start in range(first_page, last_page + 1, thread_count):
+        chunk_end = min(chunk_start + thread_count - 1, last_page)
+
+        # Crear carpeta temporal para las imágenes del bloque
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with span('pdf_convert'):
+                images = convert_from_path(
+                    pdf_path,
+                    first_page=chunk_start,
+                    last_page=chunk_end,
+                    dpi=settings.PDF_DPI,
+                    output_folder=temp_dir,
+                    thread_count=min(thread_count, chunk_end - chunk_start + 1),
+                    grayscale=False,
+                    fmt='jpeg',
+                    jpegopt={'quality': 95},
+                    **conversion_args
+                )
+                # Cargar antes de que se borre la carpeta temporal
+                for image in images:
+                    image.load()
+            logger.info(f"Páginas {chunk_start}-{chunk_end} convertidas ({len(images)} imágenes)")
+
+        for offset, image in enumerate(images):
+            yield chunk_start + offset, image
+
+def fit_page(image: Image.Image) -> Image.Image:
+    """
+    Redimensionar una página al tamaño exacto de las plantillas
+
+    Raises:
+        ValueError: Si la imagen no queda con el tamaño esperado
+    """
+    target_size = settings.PAGE_SIZE
+    with span('resize'):
+        image = image.resize(target_size, Image.Resampling.LANCZOS)
+
+    width, height = image.size
+    if width != target_size[0] or height != target_size[1]:
+        raise ValueError(f"Error al redimensionar: {width}x{height} (debería ser {target_size[0]}x{target_size[1]})")
+    return image
+
+class Rasterizer:
+    """
+    Interfaz de los rasterizadores de PDF
+
+    `iter_pages` devuelve cada página como imagen BGR de NumPy con el tamaño
+    exacto de las plantillas (PAGE_SIZE), lista para los procesadores.
+    """
+
+    name = None
+
+    def page_count(self, pdf_path: str) -> int:
+        """Obtener el número de páginas de un PDF"""
+        raise NotImplementedError
+
+    def iter_pages(self, pdf_path: str, first_page: int = 1,
+                   last_page: int = None) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Renderizar las páginas de un PDF de forma perezosa
+
+        Args:
+            pdf_path: Ruta al PDF
+            first_page: Primera página (desde 1)
+            last_page: Última página (por defecto, la última del documento)
+
+        Yields:
+            Tuplas (número_de_página, imagen BGR de PAGE_SIZE)
+        """
+        raise NotImplementedError
+
+class PopplerRasterizer(Rasterizer):
+    """Poppler en un subproceso (pdf2image), con JPEG intermedio y redimensionado LANCZOS"""
+
+    name = 'poppler'
+
+    def page_count(self, pdf_path: str) -> int:
+        info = pdfinfo_from_path(pdf_path, **get_poppler_args())
+        return int(info.get('Pages', 0))
+
+    def iter_pages(self, pdf_path: str, first_page: int = 1,
+                   last_page: int = None) -> Iterator[Tuple[int, np.ndarray]]:
+        for page_number, page_image in iter_pdf_pages(pdf_path, first_page, last_page):
+            page_image = fit_page(page_image)
+            yield page_number, cv2.cvtColor(np.asarray(page_image.convert('RGB')), cv2.COLOR_RGB2BGR)
+
+def pixmap_to_bgr(pixmap) -> np.ndarray:
+    """Convertir un Pixmap de MuPDF (grises, RGB, CMYK, con o sin alfa) a imagen BGR"""
+    if pixmap.alpha:
+        pixmap = pymupdf.Pixmap(pixmap, 0)
+    if pixmap.n not in (1, 3):
+        pixmap = pymupdf.Pixmap(pymupdf.csRGB, pixmap)
+    samples = np.frombuffer(pixmap.samples_mv, dtype=np.uint8)
+    rows = samples.reshape(pixmap.height, pixmap.stride)[:, :pixmap.width * pixmap.n]
+    if pixmap.n == 1:
+        return cv2.cvtColor(np.ascontiguousarray(rows), cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(rows.reshape(pixmap.height, pixmap.width, 3), cv2.COLOR_RGB2BGR)
+
+class PyMuPDFRasterizer(Rasterizer):
+    """
+    MuPDF en el propio proceso
+
+    Cada página se renderiza directamente al tamaño de las plantillas (la
+    escala se calcula por eje a partir del tamaño de la página), sin
+    subproceso, carpeta temporal ni codificación intermedia. MuPDF no admite
+    varios hilos sobre la misma librería, así que el renderizado se
+    serializa con un cerrojo.
+
+    Las páginas escaneadas (una única imagen que cubre la página, sin
+    dibujos vectoriales ni texto visible) no se renderizan: la imagen
+    incrustada se decodifica una sola vez y se redimensiona, lo que evita
+    una segunda generación de artefactos JPEG sobre las marcas. La capa de
+    texto invisible que añade el OCR de algunos escáneres no impide la
+    extracción.
+    """
+
+    name = 'pymupdf'
+    _lock = threading.Lock()
+
+    def __init__(self, extract_scans: bool = None):
+        if pymupdf is None:
+            raise RuntimeError("PyMuPDF no está instalado (pip install pymupdf)")
+        self.extract_scans = settings.PDF_EXTRACT_SCANS if extract_scans is None else extract_scans
+
+    def page_count(self, pdf_path: str) -> int:
+        with self._lock, pymupdf.open(pdf_path) as document:
+            return document.page_count
+
+    def iter_pages(self, pdf_path: str, first_page: int = 1,
+                   last_page: int = None) -> Iterator[Tuple[int, np.ndarray]]:
+        width, height = settings.PAGE_SIZE
+        with self._lock:
+            document = pymupdf.open(pdf_path)
+        try:
+            if last_page is None:
+                last_page = document.page_count
+            for page_number in range(first_page, min(last_page, document.page_count) + 1):
+                image = self._extract_scan(document, page_number) if self.extract_scans else None
+                if image is None:
+                    image = self._render(document, page_number)
+
+                # Escaneos de otra resolución, o el redondeo de MuPDF a un píxel del tamaño pedido.
+                # Al ampliar se usa interpolación bilineal: la cúbica y LANCZOS realzan los
+                # artefactos JPEG de los escaneos y hacen pasar casillas vacías por marcadas.
+                if image.shape[1] != width or image.shape[0] != height:
+                    shrinking = image.shape[1] * image.shape[0] > width * height
+                    with span('resize'):
+                        image = cv2.resize(image, (width, height),
+                                           interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+                yield page_number, image
+        finally:
+            with self._lock:
+                document.close()
+
+    def _render(self, document, page_number: int) -> np.ndarray:
+        """Renderizar una página al tamaño de las plantillas"""
+        width, height = settings.PAGE_SIZE
+        with self._lock, span('pdf_convert'):
+            page = document[page_number - 1]
+            matrix = pymupdf.Matrix(width / page.rect.width, height / page.rect.height)
+            return pixmap_to_bgr(page.get_pixmap(matrix=matrix, colorspace=pymupdf.csRGB, alpha=False))
+
+    def _extract_scan(self, document, page_number: int) -> Optional[np.ndarray]:
+        """
+        Extraer la imagen incrustada de una página escaneada
+
+        Returns:
+            Imagen BGR a su resolución original, o None si la página no es
+            un escaneo de una sola imagen y hay que renderizarla
+        """
+        with self._lock:
+            page = document[page_number - 1]
+            if page.rotation:
+                return None
+
+            # get_image_info(xrefs=True) decodifica la imagen para calcular su hash:
+            # el xref se toma de los recursos de la página
+            placements = page.get_image_info()
+            resources = page.get_images(full=True)
+            if len(placements) != 1 or len(resources) != 1:
+                return None
+            info = placements[0]
+            xref, smask, image_width, image_height = resources[0][:4]
+            if (image_width, image_height) != (info['width'], info['height']):
+                return None
+            a, b, c, d, _, _ = info['transform']
+            # Solo imágenes sin máscara, sin giro ni espejo, que cubren la página
+            if smask or info['has-mask'] or abs(b) > 1e-3 or abs(c) > 1e-3 or a <= 0 or d <= 0:
+                return None
+            covered = pymupdf.Rect(info['bbox']) & page.rect
+            if covered.get_area() < SCAN_COVERAGE * page.rect.get_area():
+                return None
+            if page.get_cdrawings() or any(span_info['type'] != 3 for span_info in page.get_texttrace()):
+                return None
+
+            with span('pdf_extract'):
+                # JPEG en grises o RGB sin /Decode: se decodifica el flujo original con OpenCV
+                filter_type, filter_name = document.xref_get_key(xref, 'Filter')
+                decode_type, _ = document.xref_get_key(xref, 'Decode')
+                if filter_name == '/DCTDecode' and info['colorspace'] in (1, 3) and decode_type == 'null':
+                    raw = document.xref_stream_raw(xref)
+                else:
+                    raw = None
+                    image = pixmap_to_bgr(pymupdf.Pixmap(document, xref))
+
+        if raw is not None:
+            with span('pdf_extract'):
+                image = cv2.imdecode(np.frombuffer(raw, dtype=np.uint8),
+                                     cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+            if image is None:
+                return None
+        logger.debug(f"Página {page_number}: imagen escaneada de {image.shape[1]}x{image.shape[0]} extraída")
+        return image
+
+_rasterizer = None
+_rasterizer_lock = threading.Lock()
+
+def create_rasterizer(name: str = None) -> Rasterizer:
+    """
+    Crear un rasterizador por nombre
+
+    Args:
+        name: 'pymupdf', 'poppler' o 'auto' (PyMuPDF si está instalado);
+            por defecto, PDF_RASTERIZER
+    """
+    name = (name or settings.PDF_RASTERIZER).lower()
+    if name not in RASTERIZERS:
+        raise ValueError(f"Rasterizador no válido: {name}. Opciones: {', '.join(RASTERIZERS)}")
+    if name == 'auto':
+        name = 'pymupdf' if pymupdf is not None else 'poppler'
+    return PyMuPDFRasterizer() if name == 'pymupdf' else PopplerRasterizer()
+
+def get_rasterizer() -> Rasterizer:
+    """Obtener el rasterizador del proceso, creándolo si no existe"""
+    global _rasterizer
+    with _rasterizer_lock:
+        if _rasterizer is None:
+            _rasterizer = create_rasterizer()
+            logger.info(f"Rasterizador de PDF: {_rasterizer.name}")
+        return _rasterizer
+
+def get_page_count(pdf_path: str) -> int:
+    """Obtener el número de páginas de un PDF"""
+    return get_rasterizer().page_count(pdf_path)
+
+def iter_page_images(pdf_path: str, first_page: int = 1,
+                     last_page: int = None) -> Iterator[Tuple[int, np.ndarray]]:
+    """Renderizar las páginas de un PDF como imágenes BGR de PAGE_SIZE (ver `Rasterizer`)"""
+    return get_rasterizer().iter_pages(pdf_path, first_page, last_page)
+
+def save_page_image(image: np.ndarray, path: str):
+    """
+    Guardar una página como PNG sin pérdida
+
+    Se usa la compresión mínima: la página se escribe una vez y se lee
+    desde la caché de páginas decodificadas. Se escribe en un archivo
+    temporal que después se renombra, de modo que nadie lee un PNG a medias.
+    """
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.tmp-{threading.get_ident()}{ext}"
+    if not cv2.imwrite(tmp_path, image, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+        raise IOError(f"No se pudo guardar la imagen {path}")
+    os.replace(tmp_path, path)
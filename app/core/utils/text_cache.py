@@ -0,0 +1,133 @@
+"""
+Caché persistente de resultados de texto manuscrito.
+
+Cada campo reconocido por Claude se guarda con una clave que combina el
+hash del contenido enviado (los píxeles de la ROI en modo tira o el PDF
+completo en modo documento), el nombre del campo, la versión del prompt y
+el modelo. Volver a reconocer la misma hoja solo envía a la API los campos
+que no están en la caché.
+
+Los resultados se guardan en SQLite (compartido entre procesos) con un
+máximo de entradas; al superarlo se eliminan las menos usadas.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Dict, Iterable, Optional
+import numpy as np
+from app.config import settings
+from app.core.utils.metrics import register_gauge
+
+logger = logging.getLogger(__name__)
+
+def hash_roi(roi: np.ndarray) -> str:
+    """SHA-256 de los píxeles de una ROI (incluye forma y tipo)"""
+    digest = hashlib.sha256(f"{roi.shape}{roi.dtype}".encode('utf-8'))
+    digest.update(np.ascontiguousarray(roi).data)
+    return digest.hexdigest()
+
+def hash_file(path: str) -> str:
+    """SHA-256 del contenido de un archivo"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_text(text: str) -> str:
+    """Versión corta de un texto (p. ej. la plantilla de un prompt)"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+def make_key(content_hash: str, field_name: str, prompt_version: str, model: str) -> str:
+    """Clave de caché de un campo"""
+    return hashlib.sha256("\x1f".join((content_hash, field_name, prompt_version, model)).encode('utf-8')).hexdigest()
+
+class TextResultCache:
+    """Resultados de texto por clave en SQLite, con expulsión de los menos usados"""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS text_results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS text_results_last_access ON text_results (last_access)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        """Obtener los valores guardados de las claves indicadas (solo las que existen)"""
+        keys = list(keys)
+        if not keys:
+            return {}
+        conn = self._connect()
+        placeholders = ",".join("?" * len(keys))
+        found = dict(conn.execute(
+            f"SELECT key, value FROM text_results WHERE key IN ({placeholders})", keys
+        ).fetchall())
+        if found:
+            with conn:
+                conn.executemany(
+                    "UPDATE text_results SET last_access = ? WHERE key = ?",
+                    [(time.time(), key) for key in found]
+                )
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, str]):
+        """Guardar valores y expulsar las entradas menos usadas si se supera el máximo"""
+        if not items:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO text_results (key, value, last_access) VALUES (?, ?, ?)",
+                [(key, value, now) for key, value in items.items()]
+            )
+            excess = conn.execute("SELECT COUNT(*) FROM text_results").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM text_results WHERE key IN "
+                    "(SELECT key FROM text_results ORDER BY last_access LIMIT ?)", (excess,)
+                )
+                logger.info(f"{excess} resultados de texto expulsados de la caché")
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM text_results").fetchone()[0]
+
+_cache = None
+_cache_lock = threading.Lock()
+
+register_gauge('omr_text_cache_hits_total', 'Campos de texto servidos desde la caché',
+               lambda: _cache.hits if _cache else 0, metric_type='counter')
+register_gauge('omr_text_cache_misses_total', 'Campos de texto que no estaban en la caché',
+               lambda: _cache.misses if _cache else 0, metric_type='counter')
+
+def get_text_cache() -> Optional[TextResultCache]:
+    """Obtener la caché de resultados de texto, o None si está desactivada"""
+    global _cache
+    if not settings.TEXT_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = TextResultCache(str(settings.TEXT_CACHE_PATH), settings.TEXT_CACHE_MAX_ENTRIES)
+            logger.info(f"Caché de resultados de texto: {settings.TEXT_CACHE_PATH}")
+        return _cache
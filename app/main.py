@@ -1,7 +1,8 @@
 import os
 import sys
 import logging
-from flask import Flask
+import time
+from flask import Flask, g, request
 from dotenv import load_dotenv
 
 # Cargar variables de entorno antes de importar otros módulos
@@ -17,9 +18,11 @@ logger = logging.getLogger(__name__)
 
 # Importaciones internas
 from app.config import settings
-from app.api import routes_bp, uploads_bp, processing_bp
-from app.core.processors.handwriting import HandwritingProcessor
-from app.core.processors.mark import MarkProcessor
+from app.api import routes_bp, uploads_bp, processing_bp, jobs_bp, grading_bp
+from app.core.processors.registry import get_mark_processor, get_handwriting_processor
+from app.core.utils.page_pool import get_page_pool
+from app.core.utils.metrics import observe
+from app.core.utils.async_utils import Deadline, set_deadline, reset_deadline
 
 def create_app():
     """Crear y configurar la aplicación Flask"""
@@ -39,6 +42,29 @@ def create_app():
     app.register_blueprint(routes_bp)
     app.register_blueprint(uploads_bp)
     app.register_blueprint(processing_bp)
+    app.register_blueprint(jobs_bp)
+    app.register_blueprint(grading_bp)
+    
+    # Medir la duración de cada petición por endpoint y abrir su plazo
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.deadline_token = set_deadline(Deadline(settings.REQUEST_DEADLINE))
+    
+    @app.teardown_request
+    def close_deadline(exc):
+        token = g.pop('deadline_token', None)
+        if token is not None:
+            reset_deadline(token)
+    
+    @app.after_request
+    def record_request_time(response):
+        start = g.pop('request_start', None)
+        if start is not None and request.endpoint:
+            observe('omr_request_seconds', time.perf_counter() - start,
+                    help_text='Duración de las peticiones HTTP por endpoint',
+                    endpoint=request.endpoint, method=request.method)
+        return response
     
     return app
 
@@ -46,12 +72,13 @@ def initialize_processors():
     """Inicializar procesadores para que estén listos"""
     try:
         logger.info("Inicializando procesadores...")
-        handwriting_processor = HandwritingProcessor()
-        mark_processor = MarkProcessor()
+        # Crear los procesadores compartidos (prompts y pasarela de Claude)
+        get_handwriting_processor()
+        get_mark_processor()
         
-        handwriting_processor.initialize()
-        mark_processor.initialize()
-        mark_processor.set_debug_folder(str(settings.OCR_RESULTS_FOLDER))
+        # Arrancar el pool de páginas antes de la primera petición
+        if settings.PAGE_WORKERS > 1:
+            get_page_pool()
         
         logger.info("Procesadores inicializados correctamente")
     except Exception as e:
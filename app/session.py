@@ -1,17 +1,36 @@
+import os
 import uuid
+import json
 import time
+import sqlite3
 import logging
+import threading
+from collections import OrderedDict
+import numpy as np
 from typing import Dict, Any, Optional, List
+from app.config import settings
+from app.core.utils.metrics import register_gauge
+from app.core.template_cache import get_template
 
 logger = logging.getLogger(__name__)
 
+# Atributos derivados que no se guardan en almacenes persistentes
+TRANSIENT_ATTRS = ('binary_page', 'binary_page_source', 'mark_index', 'mark_index_source')
+
+# Atributos que se reconstruyen desde la plantilla compilada si la sesión la tiene
+TEMPLATE_ATTRS = ('zones_info', 'rois', 'text_fields', 'mark_fields')
+
+SESSION_BASE_SIZE = 4096  # Estimación en bytes de una sesión sin datos grandes
+
 class Session:
     """Gestiona datos de sesión para un proceso de análisis OMR"""
     
     def __init__(self, id=None):
         self.id = id or str(uuid.uuid4())
         self.created_at = time.time()
+        self.last_access = self.created_at
         self.json_path = None
+        self.template_hash = None  # SHA-256 de la plantilla compilada (ver app.core.template_cache)
         self.zones_info = None
         self.text_fields = []
         self.mark_fields = []
@@ -21,7 +40,15 @@ class Session:
         self.overlay_path = None
         self.completed_steps = []
         self.results = {}
+        self.results_version = 0  # Cambia con cada `store_results` (ver app.core.grading)
         self.rois = {}  # Diccionario para almacenar las ROIs
+        self.parent_id = None  # Sesión del PDF multipágina del que procede esta página
+        self.page_number = None  # Número de página dentro del PDF del lote
+        self.page_sessions = []  # IDs de las sesiones de cada página (modo lote)
+        self.binary_page = None  # Página binarizada (modo de preprocesamiento 'page')
+        self.binary_page_source = None  # (ruta, versión de la página) de la imagen binarizada
+        self.mark_index = None  # Índice integral de la página binarizada (scorer 'integral')
+        self.mark_index_source = None  # Origen de la página usada para el índice
         logger.debug(f"Nueva sesión inicializada con ID: {self.id}")
         
     def update(self, **kwargs):
@@ -43,64 +70,365 @@ class Session:
         logger.debug(f"Verificando paso '{step}' en sesión {self.id}: {'completado' if completed else 'pendiente'}")
         return completed
         
+    def store_results(self, results: Dict[str, Any]):
+        """Añadir resultados de reconocimiento (sustituyen a los de los mismos campos)"""
+        self.results = {**self.results, **results}
+        self.results_version += 1
+
     def to_dict(self):
         """Convierte la sesión a diccionario"""
         return {
             'id': self.id,
             'created_at': self.created_at,
+            'template_hash': self.template_hash,
             'text_fields': self.text_fields,
             'mark_fields': self.mark_fields,
             'completed_steps': self.completed_steps,
-            'rois': self.rois
+            'rois': self.rois,
+            'parent_id': self.parent_id,
+            'page_number': self.page_number,
+            'page_sessions': self.page_sessions
         }
+    
+    def to_state(self) -> Dict[str, Any]:
+        """Estado persistente de la sesión (sin atributos derivados)"""
+        state = {key: value for key, value in self.__dict__.items() if key not in TRANSIENT_ATTRS}
+        if self.template_hash:
+            for key in TEMPLATE_ATTRS:
+                state.pop(key, None)
+        return state
+        
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'Session':
+        """Reconstruir una sesión a partir de `to_state`"""
+        session = cls(state.get('id'))
+        session.__dict__.update(state)
+        if session.template_hash:
+            template = get_template(session.template_hash, session.json_path)
+            if template is not None:
+                session.zones_info = template.zones_info
+                session.rois = template.rois
+                session.text_fields = template.text_fields
+                session.mark_fields = template.mark_fields
+            else:
+                logger.warning(f"Plantilla {session.template_hash[:12]} no disponible para la sesión {session.id}")
+        return session
+        
+    def drop_transient(self) -> bool:
+        """
+        Descartar los atributos derivados (se recalculan al necesitarlos)
+
+        Returns:
+            True si la sesión tenía alguno
+        """
+        had = self.binary_page is not None or self.mark_index is not None
+        for key in TRANSIENT_ATTRS:
+            setattr(self, key, None)
+        return had
+
+    def estimated_size(self) -> int:
+        """Estimación de la memoria ocupada por la sesión en bytes"""
+        size = SESSION_BASE_SIZE + 256 * len(self.results) + 64 * len(self.page_sessions)
+        if not self.template_hash:
+            size += 128 * len(self.rois)
+        if isinstance(self.binary_page, np.ndarray):
+            size += self.binary_page.nbytes
+        if self.mark_index is not None:
+            size += self.mark_index.nbytes
+        return size
+
+def _json_default(value):
+    """Convertir escalares y arrays de NumPy al guardar en JSON"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+class MemorySessionStore:
+    """
+    Almacén de sesiones en memoria del proceso
+    
+    Las sesiones se reparten entre `stripes` particiones, cada una con su
+    propio lock, orden LRU y fracción del límite de entradas y del
+    presupuesto de memoria. Al superar el presupuesto se descartan primero
+    los atributos derivados de las sesiones más antiguas (página binarizada
+    e índice integral, que se recalculan) y solo si no basta, sesiones
+    enteras. Una sesión caduca `ttl` segundos después de su último acceso.
+    """
+    
+    def __init__(self, ttl: float, max_entries: int, memory_budget: int, stripes: int = 16):
+        self.ttl = ttl
+        self._stripes = [OrderedDict() for _ in range(stripes)]
+        self._sizes = [dict() for _ in range(stripes)]
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._max_entries = max(1, max_entries // stripes)
+        self._budget = max(1, memory_budget // stripes)
+        
+    def _stripe(self, session_id: str) -> int:
+        return hash(session_id) % len(self._stripes)
+        
+    def put(self, session: Session):
+        """Guardar o actualizar una sesión"""
+        i = self._stripe(session.id)
+        with self._locks[i]:
+            sessions, sizes = self._stripes[i], self._sizes[i]
+            sessions[session.id] = session
+            sessions.move_to_end(session.id)
+            sizes[session.id] = session.estimated_size()
+            self._evict(i, keep=session.id)
+            
+    def get(self, session_id: str) -> Optional[Session]:
+        """Obtener una sesión si existe y no ha caducado"""
+        i = self._stripe(session_id)
+        with self._locks[i]:
+            session = self._stripes[i].get(session_id)
+            if session is None:
+                return None
+            now = time.time()
+            if now - session.last_access > self.ttl:
+                self._remove(i, session_id)
+                return None
+            session.last_access = now
+            self._stripes[i].move_to_end(session_id)
+            return session
+            
+    def delete(self, session_id: str):
+        i = self._stripe(session_id)
+        with self._locks[i]:
+            self._remove(i, session_id)
+            
+    def sweep(self) -> int:
+        """
+        Eliminar las sesiones caducadas y devolver cuántas se eliminaron
+        
+        Además se vuelve a medir el resto de sesiones, por si alguna creció
+        sin guardarse, y se descartan las necesarias para respetar el
+        presupuesto.
+        """
+        removed = 0
+        now = time.time()
+        for i in range(len(self._stripes)):
+            with self._locks[i]:
+                sessions, sizes = self._stripes[i], self._sizes[i]
+                expired = [sid for sid, s in sessions.items() if now - s.last_access > self.ttl]
+                for session_id in expired:
+                    self._remove(i, session_id)
+                removed += len(expired)
+                for session_id, session in sessions.items():
+                    sizes[session_id] = session.estimated_size()
+                self._evict(i, keep=None)
+        return removed
+        
+    def __len__(self):
+        return sum(len(sessions) for sessions in self._stripes)
+        
+    def memory_usage(self) -> int:
+        """Memoria estimada de todas las sesiones en bytes"""
+        return sum(sum(sizes.values()) for sizes in self._sizes)
+        
+    def _remove(self, i: int, session_id: str):
+        self._stripes[i].pop(session_id, None)
+        self._sizes[i].pop(session_id, None)
+        
+    def _evict(self, i: int, keep: str):
+        sessions, sizes = self._stripes[i], self._sizes[i]
+        # Primero, los atributos derivados de las sesiones más antiguas
+        for session_id, session in sessions.items():
+            if sum(sizes.values()) <= self._budget:
+                break
+            if session_id != keep and session.drop_transient():
+                sizes[session_id] = session.estimated_size()
+                logger.info(f"Datos derivados de la sesión {session_id} descartados por límite de memoria")
+        while len(sessions) > 1 and (len(sessions) > self._max_entries or sum(sizes.values()) > self._budget):
+            oldest = next(iter(sessions))
+            if oldest == keep:
+                break
+            self._remove(i, oldest)
+            logger.info(f"Sesión {oldest} descartada por límite de memoria o de entradas")
+
+class SQLiteSessionStore:
+    """
+    Almacén de sesiones en SQLite, compartido entre procesos
+    
+    Cada sesión se guarda como JSON con `Session.to_state`; los atributos
+    derivados (página binarizada, índice integral) no se guardan y se
+    recalculan en el proceso que los necesite. Cada hilo usa su propia
+    conexión.
+    """
+    
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, data TEXT NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access)")
+            
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+        
+    def put(self, session: Session):
+        """Guardar o actualizar una sesión"""
+        data = json.dumps(session.to_state(), default=_json_default)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, last_access) VALUES (?, ?, ?)",
+                (session.id, data, session.last_access)
+            )
+            
+    def get(self, session_id: str) -> Optional[Session]:
+        """Obtener una sesión si existe y no ha caducado"""
+        conn = self._connect()
+        row = conn.execute("SELECT data, last_access FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        data, last_access = row
+        now = time.time()
+        if now - last_access > self.ttl:
+            self.delete(session_id)
+            return None
+        
+        session = Session.from_state(json.loads(data))
+        # Renovar el acceso como mucho una vez por minuto para no escribir en cada lectura
+        if now - last_access > 60:
+            with conn:
+                conn.execute("UPDATE sessions SET last_access = ? WHERE id = ?", (now, session_id))
+        session.last_access = now
+        return session
+        
+    def delete(self, session_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            
+    def sweep(self) -> int:
+        """Eliminar las sesiones caducadas y devolver cuántas se eliminaron"""
+        with self._connect() as conn:
+            cursor = conn.execute("DELETE FROM sessions WHERE last_access < ?", (time.time() - self.ttl,))
+            return cursor.rowcount
+            
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+def create_store():
+    """Crear el almacén de sesiones indicado en SESSION_BACKEND"""
+    if settings.SESSION_BACKEND == 'sqlite':
+        logger.info(f"Almacén de sesiones SQLite: {settings.SESSION_DB_PATH}")
+        return SQLiteSessionStore(str(settings.SESSION_DB_PATH), settings.SESSION_TTL)
+    if settings.SESSION_BACKEND != 'memory':
+        raise ValueError(f"SESSION_BACKEND no válido: {settings.SESSION_BACKEND}. Opciones: memory, sqlite")
+    return MemorySessionStore(
+        settings.SESSION_TTL,
+        settings.SESSION_MAX_ENTRIES,
+        settings.SESSION_MEMORY_BUDGET_MB * 1024 * 1024,
+        settings.SESSION_STRIPES
+    )
 
 class SessionManager:
     """Gestiona el almacenamiento y recuperación de sesiones"""
     
-    _sessions: Dict[str, Session] = {}
+    _store = None
+    _store_lock = threading.Lock()
+    _sweeper = None
+    
+    @classmethod
+    def get_store(cls):
+        """Obtener el almacén de sesiones, creándolo (y arrancando el barrido) si no existe"""
+        if cls._store is None:
+            with cls._store_lock:
+                if cls._store is None:
+                    cls._store = create_store()
+                    cls._start_sweeper()
+        return cls._store
+    
+    @classmethod
+    def _start_sweeper(cls):
+        """Arrancar el hilo que elimina periódicamente las sesiones caducadas"""
+        def sweep_forever():
+            while True:
+                time.sleep(settings.SESSION_SWEEP_INTERVAL)
+                cls.cleanup_sessions()
+                
+        cls._sweeper = threading.Thread(target=sweep_forever, name='session-sweeper', daemon=True)
+        cls._sweeper.start()
     
     @classmethod
     def create_session(cls) -> Session:
         """Crea una nueva sesión"""
         session = Session()
-        cls._sessions[session.id] = session
+        cls.get_store().put(session)
         logger.info(f"Sesión creada: {session.id}")
-        logger.debug(f"Total de sesiones activas: {len(cls._sessions)}")
-        logger.debug(f"IDs de sesiones activas: {list(cls._sessions.keys())}")
         return session
     
     @classmethod
     def get_session(cls, session_id: str) -> Optional[Session]:
         """Obtiene una sesión existente"""
-        session = cls._sessions.get(session_id)
+        session = cls.get_store().get(session_id) if session_id else None
         if session is None:
             logger.warning(f"Sesión no encontrada: {session_id}")
-            logger.debug(f"Total de sesiones activas: {len(cls._sessions)}")
-            logger.debug(f"IDs de sesiones activas: {list(cls._sessions.keys())}")
         else:
             logger.debug(f"Sesión encontrada: {session_id}")
         return session
     
     @classmethod
-    def cleanup_sessions(cls, max_age=3600):
-        """Limpia sesiones antiguas"""
-        now = time.time()
-        to_delete = []
+    def save_session(cls, session: Session):
+        """
+        Guardar los cambios de una sesión
         
-        for session_id, session in cls._sessions.items():
-            if (now - session.created_at) > max_age:
-                to_delete.append(session_id)
-                
-        for session_id in to_delete:
-            del cls._sessions[session_id]
-            
-        if to_delete:
-            logger.info(f"Limpiadas {len(to_delete)} sesiones antiguas")
-            logger.debug(f"Sesiones eliminadas: {to_delete}")
-            logger.debug(f"Sesiones restantes: {list(cls._sessions.keys())}")
+        Debe llamarse tras modificar una sesión para que los cambios lleguen
+        a almacenes compartidos entre procesos; en memoria actualiza además
+        su tamaño estimado y su posición LRU.
+        """
+        cls.get_store().put(session)
+    
+    @classmethod
+    def save_results(cls, session: Session, results: Dict[str, Any]):
+        """
+        Guardar los resultados de reconocimiento de una sesión
+
+        Si la sesión es una página de un lote, cambia también la versión de
+        resultados del lote para que su tensor de marcas se reconstruya.
+        """
+        session.store_results(results)
+        cls.save_session(session)
+        if session.parent_id:
+            parent = cls.get_store().get(session.parent_id)
+            if parent is not None:
+                parent.results_version += 1
+                cls.save_session(parent)
+
+    @classmethod
+    def count(cls) -> int:
+        """Número de sesiones guardadas"""
+        return len(cls.get_store())
+    
+    @classmethod
+    def cleanup_sessions(cls):
+        """Limpia sesiones caducadas"""
+        try:
+            removed = cls.get_store().sweep()
+            if removed:
+                logger.info(f"Limpiadas {removed} sesiones caducadas")
+        except Exception as e:
+            logger.error(f"Error limpiando sesiones: {e}", exc_info=True)
+
+register_gauge('omr_active_sessions', 'Sesiones activas en el almacén de sesiones', SessionManager.count)
 
 # Estas variables DEBEN estar definidas a nivel de módulo para que puedan ser importadas
-sessions = SessionManager._sessions
 create_session = SessionManager.create_session
 get_session = SessionManager.get_session
+save_session = SessionManager.save_session
+save_results = SessionManager.save_results
 cleanup_sessions = SessionManager.cleanup_sessions
\ No newline at end of file
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Medir los detectores de marcas sobre hojas sintéticas con verdad conocida.
+
+Las hojas se generan con `synthetic_sheets.py` a partir de un JSON de zonas
+(o de la plantilla de ejemplo) y se puntúan con cada configuración:
+
+    mark/roi         MarkProcessor, preprocesado por ROI
+    mark/page        MarkProcessor, página binarizada una vez
+    mark/integral    MarkProcessor, índice integral de la página
+    enhanced/roi     EnhancedMarkProcessor (app/core/processors/image.py)
+
+Como cada hoja es nueva, los modos page e integral incluyen en su tiempo la
+binarización de la página y la construcción del índice.
+
+Para cada una se informa de la latencia por hoja (mediana y p95), el número
+de ROIs por segundo, el pico de memoria asignada al puntuar una hoja
+(tracemalloc, en una pasada aparte para no alterar los tiempos) y la
+precisión y exhaustividad frente a la verdad de referencia. Los resultados
+se pueden guardar en JSON junto con las versiones y el commit para
+comparar entre versiones.
+
+Uso:
+    python benchmarks/bench_marks.py [--zones zonas.json] [--sheets 20] [--configs mark/roi,mark/page]
+                                     [--json salida.json]
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+from datetime import datetime, timezone
+from dataclasses import asdict
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_sheets import load_zones, iter_sheets, add_degradation_args, degradation_from_args  # noqa: E402
+from app.core.processors.mark import MarkProcessor  # noqa: E402
+from app.core.processors.image import EnhancedMarkProcessor  # noqa: E402
+from app.core.pipeline import score_marks, detect_mark_types  # noqa: E402
+
+CONFIGS = ('mark/roi', 'mark/page', 'mark/integral', 'enhanced/roi')
+
+def make_scorer(config: str):
+    """Función (imagen, rois, campos, rectángulos) -> {campo: marcado} de una configuración"""
+    detector, mode = config.split('/')
+    if detector == 'enhanced':
+        processor = EnhancedMarkProcessor()
+        processor.initialize()
+
+        def score(image, rois, fields, rects):
+            processor.set_mark_fields(set(fields))
+            processor.set_mark_types(detect_mark_types(fields, rois))
+            return processor.process_batch(rois, fields)[0]
+        return score
+
+    processor = MarkProcessor()
+    processor.initialize()
+    preprocess_mode, scorer = ('page', 'integral') if mode == 'integral' else (mode, 'default')
+
+    def score(image, rois, fields, rects):
+        return score_marks(processor, image, rois, fields, rects, None, preprocess_mode, scorer)[0]
+    return score
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[int(q * (len(samples) - 1))] if samples else None
+
+def bench_config(config, sheets, fields, rects):
+    """Puntuar todas las hojas con una configuración y resumir tiempos, memoria y aciertos"""
+    score = make_scorer(config)
+    image, truth = sheets[0]
+    rois = [image[y:y + h, x:x + w] for (x, y, w, h) in rects]
+    score(image, rois, fields, rects)  # Calentamiento
+
+    # Pico de memoria en una pasada aparte (tracemalloc ralentiza la ejecución)
+    tracemalloc.start()
+    score(image, rois, fields, rects)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = []
+    tp = fp = fn = tn = 0
+    for image, truth in sheets:
+        start = time.perf_counter()
+        rois = [image[y:y + h, x:x + w] for (x, y, w, h) in rects]
+        results = score(image, rois, fields, rects)
+        latencies.append(time.perf_counter() - start)
+
+        for field in fields:
+            predicted, expected = bool(results.get(field, False)), truth[field]
+            tp += predicted and expected
+            fp += predicted and not expected
+            fn += expected and not predicted
+            tn += not predicted and not expected
+
+    total_time = sum(latencies)
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    return {
+        'sheets': len(sheets),
+        'rois_per_sheet': len(fields),
+        'latency_median_ms': round(statistics.median(latencies) * 1000, 2),
+        'latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'rois_per_second': round(len(fields) * len(sheets) / total_time, 1) if total_time else None,
+        'peak_memory_mb': round(peak / (1024 * 1024), 2),
+        'precision': round(precision, 4),
+        'recall': round(recall, 4),
+        'f1': round(2 * precision * recall / (precision + recall), 4) if precision + recall else 0.0,
+        'accuracy': round((tp + tn) / (tp + fp + fn + tn), 4),
+        'confusion': {'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn}
+    }
+
+def environment():
+    """Versiones y commit con los que se obtuvieron los resultados"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Medir los detectores de marcas sobre hojas sintéticas")
+    parser.add_argument('--zones', help="JSON de zonas (por defecto, plantilla de ejemplo)")
+    parser.add_argument('--sheets', type=int, default=20, help="Número de hojas")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--configs', default=','.join(CONFIGS),
+                        help=f"Configuraciones separadas por comas ({', '.join(CONFIGS)})")
+    parser.add_argument('--json', help="Guardar los resultados en un archivo JSON")
+    add_degradation_args(parser)
+    args = parser.parse_args()
+
+    configs = [c.strip() for c in args.configs.split(',') if c.strip()]
+    unknown = [c for c in configs if c not in CONFIGS]
+    if unknown:
+        parser.error(f"Configuraciones desconocidas: {', '.join(unknown)}")
+
+    # Los procesadores registran cada marca; basta con los avisos
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('app').setLevel(logging.WARNING)
+
+    _, template = load_zones(args.zones)
+    rects = [tuple(template.rois[name]) for name in template.mark_fields if name in template.rois]
+    fields = [name for name in template.mark_fields if name in template.rois]
+    if not fields:
+        parser.error("El JSON de zonas no tiene campos de marca válidos")
+
+    params = degradation_from_args(args)
+    start = time.perf_counter()
+    sheets = list(iter_sheets(template, args.sheets, args.seed, params))
+    print(f"{len(sheets)} hojas de {len(fields)} marcas generadas en {time.perf_counter() - start:.1f}s")
+
+    results = {}
+    for config in configs:
+        results[config] = bench_config(config, sheets, fields, rects)
+
+    print(f"{'config':<14} {'mediana ms':>10} {'p95 ms':>8} {'ROIs/s':>9} {'mem MB':>7} "
+          f"{'precisión':>9} {'recall':>7} {'F1':>7}")
+    for config, row in results.items():
+        print(f"{config:<14} {row['latency_median_ms']:>10} {row['latency_p95_ms']:>8} {row['rois_per_second']:>9} "
+              f"{row['peak_memory_mb']:>7} {row['precision']:>9} {row['recall']:>7} {row['f1']:>7}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'environment': environment(),
+                'parameters': {'zones': args.zones, 'sheets': args.sheets, 'seed': args.seed,
+                               'rois_per_sheet': len(fields), 'degradation': asdict(params)},
+                'results': results
+            }, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Comparar los rasterizadores de PDF sobre hojas reales.
+
+Para cada backend disponible (Poppler y PyMuPDF) se mide, por página:
+
+    render   Renderizado hasta la imagen BGR de PAGE_SIZE
+    store    Escritura de la página tal como la guarda la aplicación
+             (JPEG q95 el camino anterior, PNG sin pérdida el actual)
+    decode   Lectura posterior con cv2.imread (el camino actual la evita
+             dejando la página en la caché de páginas decodificadas)
+
+Si ambos backends están disponibles se indica también la diferencia media
+por píxel entre sus renders.
+
+Uso:
+    python benchmarks/bench_rasterizers.py hojas/*.pdf [--repeat 3] [--json salida.json]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+import cv2
+import numpy as np
+from pdf2image.exceptions import PDFInfoNotInstalledError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.utils.pdf_utils import create_rasterizer, save_page_image, pymupdf  # noqa: E402
+
+def available_backends():
+    """Backends que se pueden crear en este entorno"""
+    backends = []
+    for name in ('poppler', 'pymupdf'):
+        if name == 'pymupdf' and pymupdf is None:
+            continue
+        rasterizer = create_rasterizer(name)
+        if name == 'poppler':
+            try:
+                rasterizer.page_count(os.devnull)
+            except PDFInfoNotInstalledError as e:
+                print(f"Poppler no disponible: {e}", file=sys.stderr)
+                continue
+            except Exception:
+                pass  # Poppler instalado; /dev/null no es un PDF válido
+        backends.append(rasterizer)
+    return backends
+
+def bench_backend(rasterizer, pdf_paths, repeat, work_dir):
+    """Medir un backend; devuelve tiempos por página y la última imagen de cada página"""
+    timings = {'render': [], 'store': [], 'decode': []}
+    pages = {}
+    legacy = rasterizer.name == 'poppler'
+
+    for _ in range(repeat):
+        for pdf_path in pdf_paths:
+            start = time.perf_counter()
+            iterator = rasterizer.iter_pages(pdf_path)
+            while True:
+                try:
+                    page_number, image = next(iterator)
+                except StopIteration:
+                    break
+                timings['render'].append(time.perf_counter() - start)
+
+                path = os.path.join(work_dir, f"{rasterizer.name}_{page_number}.{'jpg' if legacy else 'png'}")
+                start = time.perf_counter()
+                if legacy:
+                    cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+                else:
+                    save_page_image(image, path)
+                timings['store'].append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                if legacy:
+                    cv2.imread(path)
+                timings['decode'].append(time.perf_counter() - start)
+
+                pages[(pdf_path, page_number)] = image
+                start = time.perf_counter()
+
+    return timings, pages
+
+def summarize(timings):
+    """Mediana y p95 en milisegundos de cada etapa"""
+    summary = {}
+    for stage, samples in timings.items():
+        samples = sorted(samples)
+        summary[stage] = {
+            'median_ms': round(statistics.median(samples) * 1000, 2) if samples else None,
+            'p95_ms': round(samples[int(0.95 * (len(samples) - 1))] * 1000, 2) if samples else None
+        }
+    total = [sum(stage) for stage in zip(*timings.values())]
+    summary['total'] = {
+        'median_ms': round(statistics.median(total) * 1000, 2) if total else None,
+        'p95_ms': round(sorted(total)[int(0.95 * (len(total) - 1))] * 1000, 2) if total else None
+    }
+    summary['pages'] = len(total)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Comparar los rasterizadores de PDF")
+    parser.add_argument('pdfs', nargs='+', help="PDFs de hojas de examen")
+    parser.add_argument('--repeat', type=int, default=3, help="Repeticiones de cada PDF")
+    parser.add_argument('--json', help="Guardar los resultados en un archivo JSON")
+    args = parser.parse_args()
+
+    backends = available_backends()
+    if not backends:
+        parser.error("No hay ningún rasterizador disponible")
+
+    results = {}
+    renders = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for rasterizer in backends:
+            timings, pages = bench_backend(rasterizer, args.pdfs, args.repeat, work_dir)
+            results[rasterizer.name] = summarize(timings)
+            renders[rasterizer.name] = pages
+
+    if len(renders) == 2:
+        poppler, mupdf = renders['poppler'], renders['pymupdf']
+        diffs = [float(np.mean(cv2.absdiff(poppler[key], mupdf[key]))) for key in poppler if key in mupdf]
+        if diffs:
+            results['mean_abs_diff'] = round(statistics.mean(diffs), 3)
+
+    print(f"{'backend':<10} {'etapa':<8} {'mediana ms':>11} {'p95 ms':>9}")
+    for name in ('poppler', 'pymupdf'):
+        if name not in results:
+            continue
+        for stage in ('render', 'store', 'decode', 'total'):
+            row = results[name][stage]
+            print(f"{name:<10} {stage:<8} {row['median_ms']:>11} {row['p95_ms']:>9}")
+    if 'mean_abs_diff' in results:
+        print(f"Diferencia media por píxel entre backends: {results['mean_abs_diff']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Generador de hojas de respuestas sintéticas con marcas conocidas.
+
+A partir de un JSON de zonas (el mismo formato que se sube a la aplicación)
+se renderizan páginas de PAGE_SIZE (1786x2526) con las casillas impresas y
+una parte de ellas marcadas a bolígrafo. Cada hoja se devuelve junto con la
+verdad de referencia {campo: marcado}. Si no se indica JSON se usa una
+plantilla de ejemplo con 60 preguntas (A-D), reservas y la rejilla del DNI.
+
+Las marcas imitan trazos reales (relleno irregular, garabato o aspa, con
+tinta azul o negra y grosor variable) y algunas casillas vacías reciben
+restos de borrado o puntos sueltos. Después se degrada la página entera:
+giro y desplazamiento leves, ruido de escáner, desenfoque (que suaviza
+también el ruido, como la óptica del escáner) y, opcionalmente, recompresión
+JPEG.
+
+Uso:
+    python benchmarks/synthetic_sheets.py salida/ [--zones zonas.json] [--sheets 10] [--seed 0]
+"""
+
+import os
+import sys
+import json
+import argparse
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import settings  # noqa: E402
+from app.core.template_cache import CompiledTemplate, MARK, CIRCLE, group_for  # noqa: E402
+
+PAPER = 238  # Tono del papel
+PRINT = 70  # Tono de las casillas impresas
+INKS = ((120, 45, 20), (40, 35, 35), (95, 40, 30))  # Azul, negro y azul oscuro (BGR)
+
+@dataclass
+class Degradation:
+    """Parámetros de degradación de la página"""
+    skew: float = 0.25  # Giro máximo en grados (±)
+    shift: int = 3  # Desplazamiento máximo en píxeles (±)
+    blur: float = 0.6  # Sigma máxima del desenfoque gaussiano
+    noise: float = 3.0  # Desviación típica del ruido de escáner
+    jpeg_quality: int = 0  # Recompresión JPEG (0 = sin recompresión)
+    stray_rate: float = 0.05  # Fracción de casillas vacías con borrones o puntos
+
+def default_zones() -> List[Dict[str, int]]:
+    """Plantilla de ejemplo: datos personales, DNI, reservas y 60 preguntas de 4 opciones"""
+    zones = [
+        {'name': 'NOMBRE', 'left': 560, 'top': 160, 'width': 1000, 'height': 80},
+        {'name': 'APELLIDO1', 'left': 560, 'top': 270, 'width': 1000, 'height': 80},
+        {'name': 'APELLIDO2', 'left': 560, 'top': 380, 'width': 1000, 'height': 80}
+    ]
+    # Rejilla del DNI: 8 columnas de dígitos (0-9), casillas cuadradas
+    for col in range(8):
+        for row in range(10):
+            zones.append({'name': f'D{row}{col}', 'left': 120 + col * 46, 'top': 160 + row * 46,
+                          'width': 32, 'height': 32})
+    # Reservas R1-R5 y preguntas 1-60 en cuatro columnas, casillas circulares
+    for q in range(1, 6):
+        for o, letter in enumerate('ABCD'):
+            zones.append({'name': f'R{q}{letter}', 'left': 600 + (q - 1) * 210 + o * 44, 'top': 560,
+                          'width': 26, 'height': 26})
+    for q in range(1, 61):
+        column, row = divmod(q - 1, 15)
+        for o, letter in enumerate('ABCD'):
+            zones.append({'name': f'{q}{letter}', 'left': 160 + column * 410 + o * 50, 'top': 760 + row * 100,
+                          'width': 26, 'height': 26})
+    return zones
+
+def load_zones(path: str = None) -> Tuple[bytes, CompiledTemplate]:
+    """Leer y compilar un JSON de zonas (o la plantilla de ejemplo)"""
+    if path:
+        with open(path, 'rb') as f:
+            raw = f.read()
+    else:
+        raw = json.dumps(default_zones()).encode('utf-8')
+    return raw, CompiledTemplate.compile(raw)
+
+def choose_truth(template: CompiledTemplate, rng: np.random.Generator) -> Dict[str, bool]:
+    """
+    Elegir qué casillas van marcadas
+
+    En cada grupo de rejilla (pregunta, reserva o columna del DNI) se marca
+    normalmente una opción; a veces ninguna o dos. Las casillas sin grupo se
+    marcan de forma independiente.
+    """
+    truth = {}
+    groups = {}
+    for name, kind, valid in zip(template.names, template.kinds, template.valid):
+        if kind != MARK or not valid:
+            continue
+        group = group_for(name)
+        if group is None:
+            truth[name] = bool(rng.random() < 0.3)
+        else:
+            groups.setdefault(group, []).append(name)
+
+    for group, names in groups.items():
+        truth.update({name: False for name in names})
+        if group.startswith('DNI'):
+            count = 1
+        else:
+            count = rng.choice([0, 1, 2], p=[0.1, 0.85, 0.05])
+        for name in rng.choice(names, size=min(count, len(names)), replace=False):
+            truth[str(name)] = True
+    return truth
+
+def draw_box(page: np.ndarray, rect, shape: int):
+    """Dibujar la casilla impresa"""
+    x, y, w, h = rect
+    if shape == CIRCLE:
+        cv2.ellipse(page, (x + w // 2, y + h // 2), (w // 2 - 2, h // 2 - 2), 0, 0, 360, (PRINT,) * 3, 1, cv2.LINE_AA)
+    else:
+        cv2.rectangle(page, (x + 2, y + 2), (x + w - 3, y + h - 3), (PRINT,) * 3, 1, cv2.LINE_AA)
+
+def draw_mark(page: np.ndarray, rect, rng: np.random.Generator):
+    """Dibujar una marca de bolígrafo: relleno irregular, garabato o aspa"""
+    x, y, w, h = rect
+    cx, cy = x + w / 2 + rng.normal(0, w * 0.04), y + h / 2 + rng.normal(0, h * 0.04)
+    radius = min(w, h) / 2 - 3
+    ink = tuple(int(np.clip(c + rng.normal(0, 12), 0, 255)) for c in INKS[rng.integers(len(INKS))])
+    thickness = max(2, int(round(min(w, h) / 10 + rng.integers(0, 2))))
+    style = rng.choice(['fill', 'scribble', 'cross'], p=[0.7, 0.25, 0.05])
+
+    if style == 'fill':
+        angles = np.sort(rng.uniform(0, 2 * np.pi, 14))
+        radii = radius * rng.uniform(0.75, 1.0, 14)
+        points = np.stack([cx + radii * np.cos(angles), cy + radii * np.sin(angles)], axis=1)
+        cv2.fillPoly(page, [np.round(points).astype(np.int32)], ink, cv2.LINE_AA)
+    elif style == 'scribble':
+        rows = np.linspace(cy - radius * 0.8, cy + radius * 0.8, int(rng.integers(5, 8)))
+        points = []
+        for i, row in enumerate(rows):
+            half = np.sqrt(max(radius ** 2 - (row - cy) ** 2, 0)) * rng.uniform(0.8, 1.0)
+            points.append((cx - half if i % 2 == 0 else cx + half, row + rng.normal(0, 1)))
+        cv2.polylines(page, [np.round(points).astype(np.int32)], False, ink, thickness + 1, cv2.LINE_AA)
+    else:
+        r = radius * 0.9
+        for dx in (-1, 1):
+            start = (int(cx - r), int(cy - dx * r))
+            end = (int(cx + r), int(cy + dx * r))
+            cv2.line(page, start, end, ink, thickness + 1, cv2.LINE_AA)
+
+def draw_stray(page: np.ndarray, rect, rng: np.random.Generator):
+    """Dibujar un resto de borrado o un punto suelto en una casilla vacía"""
+    x, y, w, h = rect
+    if rng.random() < 0.5:
+        # Borrón gris claro de una marca borrada
+        tone = int(rng.integers(195, 220))
+        axes = (max(2, int(w * rng.uniform(0.2, 0.35))), max(2, int(h * rng.uniform(0.2, 0.35))))
+        cv2.ellipse(page, (x + w // 2, y + h // 2), axes, float(rng.uniform(0, 180)), 0, 360, (tone,) * 3, -1, cv2.LINE_AA)
+    else:
+        # Punto de bolígrafo cerca del borde
+        px = int(x + w * rng.choice([0.2, 0.8]))
+        py = int(y + h * rng.uniform(0.2, 0.8))
+        cv2.circle(page, (px, py), 1, INKS[0], -1, cv2.LINE_AA)
+
+def degrade(page: np.ndarray, params: Degradation, rng: np.random.Generator) -> np.ndarray:
+    """Aplicar giro, desplazamiento, ruido, desenfoque y JPEG a la página"""
+    height, width = page.shape[:2]
+    if params.skew or params.shift:
+        angle = rng.uniform(-params.skew, params.skew)
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+        matrix[:, 2] += rng.uniform(-params.shift, params.shift, 2)
+        page = cv2.warpAffine(page, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=(PAPER,) * 3)
+    if params.noise:
+        noise = rng.normal(0, params.noise, page.shape[:2]).astype(np.float32)
+        page = np.clip(page.astype(np.float32) + noise[..., np.newaxis], 0, 255).astype(np.uint8)
+    if params.blur:
+        sigma = rng.uniform(0, params.blur)
+        if sigma > 0.1:
+            page = cv2.GaussianBlur(page, (0, 0), sigma)
+    if params.jpeg_quality:
+        _, buffer = cv2.imencode('.jpg', page, [cv2.IMWRITE_JPEG_QUALITY, params.jpeg_quality])
+        page = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    return page
+
+def generate_sheet(template: CompiledTemplate, rng: np.random.Generator,
+                   params: Degradation = None) -> Tuple[np.ndarray, Dict[str, bool]]:
+    """
+    Renderizar una hoja con marcas conocidas
+
+    Args:
+        template: Plantilla compilada con las zonas
+        rng: Generador aleatorio (la misma semilla produce la misma hoja)
+        params: Degradación de la página (por defecto `Degradation()`)
+
+    Returns:
+        Tupla (imagen BGR de PAGE_SIZE, {campo de marca: marcado})
+    """
+    params = params or Degradation()
+    width, height = settings.PAGE_SIZE
+    page = np.full((height, width, 3), PAPER, dtype=np.uint8)
+
+    # Gradiente suave de iluminación del escáner
+    gradient = np.linspace(-6, 6, width, dtype=np.float32) * rng.choice([-1, 1])
+    page = np.clip(page + gradient[np.newaxis, :, np.newaxis], 0, 255).astype(np.uint8)
+
+    truth = choose_truth(template, rng)
+    for name, rect, kind, shape, valid in zip(template.names, template.rects, template.kinds,
+                                              template.mark_types, template.valid):
+        if not valid:
+            continue
+        rect = tuple(int(v) for v in rect)
+        if kind != MARK:
+            x, y, w, h = rect
+            cv2.rectangle(page, (x, y), (x + w - 1, y + h - 1), (PRINT,) * 3, 1)
+            continue
+        draw_box(page, rect, shape)
+        if truth[name]:
+            draw_mark(page, rect, rng)
+        elif rng.random() < params.stray_rate:
+            draw_stray(page, rect, rng)
+
+    return degrade(page, params, rng), truth
+
+def iter_sheets(template: CompiledTemplate, count: int, seed: int = 0, params: Degradation = None):
+    """Generar `count` hojas reproducibles a partir de una semilla"""
+    for i in range(count):
+        yield generate_sheet(template, np.random.default_rng([seed, i]), params)
+
+def add_degradation_args(parser: argparse.ArgumentParser):
+    """Añadir a un parser las opciones de degradación"""
+    defaults = Degradation()
+    parser.add_argument('--skew', type=float, default=defaults.skew, help="Giro máximo en grados")
+    parser.add_argument('--shift', type=int, default=defaults.shift, help="Desplazamiento máximo en píxeles")
+    parser.add_argument('--blur', type=float, default=defaults.blur, help="Sigma máxima del desenfoque")
+    parser.add_argument('--noise', type=float, default=defaults.noise, help="Ruido de escáner (desviación típica)")
+    parser.add_argument('--jpeg-quality', type=int, default=defaults.jpeg_quality, help="Recompresión JPEG (0 = no)")
+    parser.add_argument('--stray-rate', type=float, default=defaults.stray_rate,
+                        help="Fracción de casillas vacías con borrones")
+
+def degradation_from_args(args) -> Degradation:
+    return Degradation(args.skew, args.shift, args.blur, args.noise, args.jpeg_quality, args.stray_rate)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generar hojas de respuestas sintéticas")
+    parser.add_argument('output', help="Carpeta de salida")
+    parser.add_argument('--zones', help="JSON de zonas (por defecto, plantilla de ejemplo)")
+    parser.add_argument('--sheets', type=int, default=10, help="Número de hojas")
+    parser.add_argument('--seed', type=int, default=0)
+    add_degradation_args(parser)
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    raw, template = load_zones(args.zones)
+    with open(os.path.join(args.output, 'zones.json'), 'wb') as f:
+        f.write(raw)
+
+    params = degradation_from_args(args)
+    truths = {}
+    for i, (page, truth) in enumerate(iter_sheets(template, args.sheets, args.seed, params), start=1):
+        filename = f"sheet_{i:03d}.png"
+        cv2.imwrite(os.path.join(args.output, filename), page)
+        truths[filename] = truth
+
+    with open(os.path.join(args.output, 'truth.json'), 'w') as f:
+        json.dump({'seed': args.seed, 'degradation': asdict(params), 'sheets': truths}, f, indent=2)
+    print(f"{args.sheets} hojas generadas en {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+import os
+import sys
+import logging
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+# Los procesadores registran cada ROI; en las pruebas solo interesan los fallos
+logging.getLogger('app').setLevel(logging.WARNING)
+
+from synthetic_sheets import load_zones, generate_sheet  # noqa: E402
+
+@pytest.fixture(scope='session')
+def template():
+    """Plantilla de ejemplo de `synthetic_sheets` (60 preguntas, reservas y DNI)"""
+    return load_zones()[1]
+
+@pytest.fixture(scope='session')
+def sheet(template):
+    """Hoja sintética reproducible con su verdad de referencia"""
+    image, truth = generate_sheet(template, np.random.default_rng(0))
+    fields = [name for name in template.mark_fields if name in template.rois]
+    rects = [tuple(template.rois[name]) for name in fields]
+    return image, truth, fields, rects
@@ -0,0 +1,104 @@
+import time
+import threading
+
+import anthropic
+import pytest
+
+from app.core.utils.claude_client import ClaudeGateway, CircuitBreaker, CircuitOpenError
+from claude_stub import create_server, parse_args
+
+REQUEST = {'model': 'stub', 'max_tokens': 16, 'messages': [{'role': 'user', 'content': 'hola'}]}
+
+@pytest.fixture
+def stub():
+    """Arrancar `tools/claude_stub.py` en un puerto libre con las opciones dadas"""
+    servers = []
+
+    def start(*options):
+        server = create_server(parse_args(['--port', '0', '--jitter', '0', '--seed', '0', *options]))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        host, port = server.server_address[:2]
+        return server, f"http://{host}:{port}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def make_gateway(base_url, **options):
+    options = {'max_retries': 0, 'backoff_base': 0.01, 'backoff_max': 0.05, 'timeout': 10, **options}
+    return ClaudeGateway('stub', base_url=base_url, **options)
+
+def test_retries_overloaded_responses(stub):
+    """Los 529 se reintentan hasta max_retries y luego se propagan"""
+    _, url = stub('--latency', '0', '--error-rate', '1')
+    gateway = make_gateway(url, max_retries=2, breaker_threshold=10)
+    with pytest.raises(anthropic.APIStatusError) as error:
+        gateway.create(**REQUEST)
+    assert error.value.status_code == 529
+    assert gateway.retries == 2
+    assert gateway.breaker.failures == 3
+
+def test_breaker_opens_and_rejects(stub):
+    """Tras `threshold` fallos seguidos las peticiones se rechazan sin salir"""
+    _, url = stub('--latency', '0', '--error-rate', '1')
+    gateway = make_gateway(url, breaker_threshold=2, breaker_cooldown=60)
+    for _ in range(2):
+        with pytest.raises(anthropic.APIStatusError):
+            gateway.create(**REQUEST)
+    assert gateway.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        gateway.create(**REQUEST)
+    assert gateway.rejected == 1
+
+def test_cancelled_probe_counts_as_failure(stub):
+    """Una prueba del semiabierto cancelada por el plazo no deja el cortocircuito bloqueado"""
+    _, url = stub('--latency', '1')
+    gateway = make_gateway(url, breaker_threshold=1, breaker_cooldown=0.3)
+    gateway.breaker.record_failure()
+    time.sleep(0.35)
+    assert gateway.breaker.state == CircuitBreaker.HALF_OPEN
+
+    with pytest.raises(TimeoutError):
+        gateway.create(deadline=0.2, **REQUEST)
+    time.sleep(0.1)  # La cancelación llega al bucle de la pasarela
+    assert gateway.breaker.state == CircuitBreaker.OPEN
+
+    # Pasado el enfriamiento se admite otra prueba, que cierra el cortocircuito
+    time.sleep(0.35)
+    response = gateway.create(deadline=5, **REQUEST)
+    assert response.content[0].text
+    assert gateway.breaker.state == CircuitBreaker.CLOSED
+
+def test_rate_limits_do_not_trip_breaker(stub):
+    """Los 429 se reintentan según retry-after pero no cuentan como fallos"""
+    _, url = stub('--latency', '0', '--rate-limit-rate', '1', '--retry-after', '0')
+    gateway = make_gateway(url, max_retries=2, breaker_threshold=1)
+    with pytest.raises(anthropic.RateLimitError):
+        gateway.create(**REQUEST)
+    assert gateway.retries == 2
+    assert gateway.breaker.failures == 0
+    assert gateway.breaker.state == CircuitBreaker.CLOSED
+
+def test_client_errors_do_not_count(stub):
+    """Un 400 ni reinicia la racha de fallos ni cierra el cortocircuito desde el semiabierto"""
+    _, url = stub('--latency', '0')
+    invalid = {**REQUEST, 'messages': []}
+    gateway = make_gateway(url, breaker_threshold=3, breaker_cooldown=0.2)
+    gateway.breaker.record_failure()
+    with pytest.raises(anthropic.BadRequestError):
+        gateway.create(**invalid)
+    assert gateway.breaker.failures == 1
+
+    gateway.breaker.record_failure()
+    gateway.breaker.record_failure()
+    time.sleep(0.25)
+    assert gateway.breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(anthropic.BadRequestError):
+        gateway.create(**invalid)
+    assert gateway.breaker.state == CircuitBreaker.HALF_OPEN
+
+    # La prueba quedó libre: la siguiente petición válida cierra el cortocircuito
+    assert gateway.create(deadline=5, **REQUEST).content[0].text
+    assert gateway.breaker.state == CircuitBreaker.CLOSED
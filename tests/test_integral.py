@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from app.core.processors.mark import MarkProcessor
+from app.core.processors.integral import IntegralMarkIndex
+from app.core.pipeline import bounding_rect
+
+def test_moments_match_direct_sums():
+    """Los momentos del índice coinciden con los calculados píxel a píxel"""
+    rng = np.random.default_rng(1)
+    page = ((rng.random((600, 500)) < 0.3) * 255).astype(np.uint8)
+    index = IntegralMarkIndex(page, (20, 30, 450, 550))
+    rects = []
+    for _ in range(50):
+        w, h = (int(v) for v in rng.integers(5, 60, 2))
+        rects.append((int(rng.integers(20, 470 - w)), int(rng.integers(30, 580 - h)), w, h))
+    assert all(index.covers(rect) for rect in rects)
+    # Σx² de la región completa no cabe en int32: no se considera cubierta
+    assert not index.covers((20, 30, 450, 550))
+
+    moments = index.moments(rects)
+    for i, (x, y, w, h) in enumerate(rects):
+        ys, xs = np.nonzero(page[y:y + h, x:x + w])
+        assert moments['count'][i] == len(xs)
+        assert moments['sum_x'][i] == xs.sum()
+        assert moments['sum_y'][i] == ys.sum()
+        assert moments['sum_xx'][i] == (xs.astype(np.int64)**2).sum()
+        assert moments['sum_yy'][i] == (ys.astype(np.int64)**2).sum()
+
+def test_integral_matches_square_path(sheet):
+    """
+    Con todas las casillas cuadradas, el índice integral puntúa como el modo
+    página salvo la penalización por conectividad (más de 3 componentes)
+    """
+    image, _, fields, rects = sheet
+    processor = MarkProcessor()
+    processor.initialize()
+    binary_page = processor.preprocess_page(image)
+    rois = [image[y:y + h, x:x + w] for (x, y, w, h) in rects]
+    binary_rois = [binary_page[y:y + h, x:x + w] for (x, y, w, h) in rects]
+    mark_types = {field: 'square' for field in fields}
+
+    _, regular = processor.process_batch(rois, fields, binary_rois, mark_types=mark_types)
+    index = IntegralMarkIndex(binary_page, bounding_rect(rects))
+    _, integral = processor.process_batch(rois, fields, binary_rois, index, rects, mark_types=mark_types)
+
+    for field in fields:
+        assert integral[field]['metadata']['scorer'] == 'integral'
+        expected = regular[field]['percentage']
+        if regular[field]['metadata'].get('num_components', 0) > 3:
+            expected /= 0.85
+        assert integral[field]['percentage'] == pytest.approx(expected, abs=1e-9)
@@ -0,0 +1,35 @@
+import pytest
+
+from app.config import settings
+from app.core.processors.mark import MarkProcessor
+from app.core.pipeline import detect_mark_types
+
+@pytest.fixture(scope='module')
+def processor():
+    processor = MarkProcessor()
+    processor.initialize()
+    return processor
+
+@pytest.mark.parametrize('mode', ['roi', 'page'])
+def test_vectorized_matches_per_roi(processor, sheet, mode, monkeypatch):
+    """El motor vectorizado decide y puntúa igual que `process_mark` ROI a ROI"""
+    image, truth, fields, rects = sheet
+    rois = [image[y:y + h, x:x + w] for (x, y, w, h) in rects]
+    mark_types = detect_mark_types(fields, rois)
+    binary_rois = None
+    if mode == 'page':
+        binary_page = processor.preprocess_page(image)
+        binary_rois = [binary_page[y:y + h, x:x + w] for (x, y, w, h) in rects]
+
+    monkeypatch.setattr(settings, 'MARK_VECTORIZED_BATCH', True)
+    vectorized, vectorized_details = processor.process_batch(rois, fields, binary_rois, mark_types=mark_types)
+    monkeypatch.setattr(settings, 'MARK_VECTORIZED_BATCH', False)
+    per_roi, per_roi_details = processor.process_batch(rois, fields, binary_rois, mark_types=mark_types)
+
+    assert vectorized == per_roi
+    for field in fields:
+        assert vectorized_details[field]['percentage'] == pytest.approx(per_roi_details[field]['percentage'], abs=1e-9)
+
+    # La hoja sintética se lee casi sin errores
+    accuracy = sum(vectorized[field] == truth[field] for field in fields) / len(fields)
+    assert accuracy > 0.9
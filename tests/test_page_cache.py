@@ -0,0 +1,74 @@
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from app.config import settings
+from app.core.utils import page_cache as page_cache_module
+from app.core.utils.page_cache import PageCache, BGR, GRAY
+from app.core.utils.pdf_utils import save_page_image
+
+def test_async_write_serves_page_before_file(tmp_path, monkeypatch):
+    """La página se sirve desde la caché mientras el PNG se escribe y coincide con él al terminar"""
+    monkeypatch.setattr(settings, 'PAGE_WRITE_ASYNC', True)
+    cache = PageCache(64 * 1024 * 1024)
+    path = str(tmp_path / 'page.png')
+    image = np.random.default_rng(0).integers(0, 256, (300, 200, 3), dtype=np.uint8)
+
+    future = cache.write(path, image)
+    assert cache.exists(path)
+    assert cache.get(path) is image
+    gray = cache.get(path, GRAY)
+
+    future.result()
+    cache.wait(path)
+    assert not cache.is_pending(path)
+    assert os.path.exists(path)
+    np.testing.assert_array_equal(cv2.imread(path), image)
+    # Tras escribirse, las entradas pendientes toman la firma del archivo
+    hits = cache.hits
+    assert cache.get(path) is image
+    assert cache.get(path, GRAY) is gray
+    assert cache.hits == hits + 2
+    assert cache.version(path) == os.path.getmtime(path)
+
+def test_sync_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'PAGE_WRITE_ASYNC', False)
+    cache = PageCache(64 * 1024 * 1024)
+    path = str(tmp_path / 'page.png')
+    image = np.zeros((50, 40, 3), dtype=np.uint8)
+    assert cache.write(path, image).done()
+    assert os.path.exists(path)
+    assert cache._cached((path, BGR), (os.stat(path).st_mtime, os.stat(path).st_size)) is image
+
+def test_queued_writes_have_distinct_versions(tmp_path, monkeypatch):
+    """Dos escrituras seguidas a la misma ruta no comparten versión ni entradas"""
+    monkeypatch.setattr(settings, 'PAGE_WRITE_ASYNC', True)
+    release = threading.Event()
+
+    def slow_save(image, path):
+        release.wait(5)
+        save_page_image(image, path)
+
+    monkeypatch.setattr(page_cache_module, 'save_page_image', slow_save)
+    cache = PageCache(64 * 1024 * 1024)
+    path = str(tmp_path / 'page.png')
+    first = np.zeros((40, 30, 3), dtype=np.uint8)
+    second = np.full((40, 30, 3), 255, dtype=np.uint8)
+
+    cache.write(path, first)
+    first_version = cache.version(path)
+    assert cache.get(path) is first
+    future = cache.write(path, second)
+    second_version = cache.version(path)
+    assert second_version != first_version
+    assert cache.get(path) is second
+    assert cache.get(path, GRAY).max() == 255
+
+    release.set()
+    future.result(5)
+    cache.wait(path)
+    assert cache.version(path) == os.path.getmtime(path)
+    assert cache.get(path) is second
+    np.testing.assert_array_equal(cv2.imread(path), second)
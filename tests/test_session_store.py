@@ -0,0 +1,31 @@
+import numpy as np
+
+from app.session import Session, MemorySessionStore
+
+def test_evicts_derived_data_before_sessions():
+    """Dos sesiones grandes en la misma partición sobreviven; se descartan sus páginas binarizadas"""
+    store = MemorySessionStore(ttl=3600, max_entries=100, memory_budget=64 * 1024 * 1024, stripes=1)
+    sessions = []
+    for _ in range(2):
+        session = Session()
+        session.results = {'1A': {'type': 'mark', 'marked': True}}
+        session.binary_page = np.zeros((6000, 6000), dtype=np.uint8)  # 36 MB
+        session.binary_page_source = ('page.png', 1.0)
+        store.put(session)
+        sessions.append(session)
+
+    first, second = sessions
+    assert store.get(first.id) is first
+    assert store.get(second.id) is second
+    assert first.results and first.binary_page is None and first.binary_page_source is None
+    assert second.binary_page is not None
+    assert store.memory_usage() <= 64 * 1024 * 1024
+
+def test_evicts_sessions_when_derived_data_is_not_enough():
+    store = MemorySessionStore(ttl=3600, max_entries=100, memory_budget=10 * 1024, stripes=1)
+    sessions = [Session() for _ in range(4)]
+    for session in sessions:
+        store.put(session)
+    assert len(store) == 2
+    assert store.get(sessions[0].id) is None
+    assert store.get(sessions[-1].id) is sessions[-1]
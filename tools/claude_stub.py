@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Servidor local que imita la Messages API de Anthropic para pruebas sin red.
+
+Acepta peticiones POST /v1/messages con bloques 'text', 'image' y
+'document' (base64) y responde con el JSON {"campos": [...]} de los campos
+pedidos en el prompt, con valores deterministas según el campo y el
+contenido enviado: la misma hoja devuelve siempre los mismos valores. Si el
+prompt no enumera campos (reconocimiento de una sola ROI) responde texto
+plano.
+
+Latencia, errores y límites de uso son configurables para medir la
+concurrencia, los reintentos y la caché de la etapa de texto:
+
+    --latency / --jitter    Espera por petición (segundos, ± fracción)
+    --error-rate            Fracción de respuestas 529 overloaded_error
+    --rate-limit-rate       Fracción de respuestas 429 aleatorias
+    --rpm                   Límite de peticiones por minuto (429 al superarlo)
+    --retry-after           Segundos de la cabecera retry-after de los 429
+    --malformed-rate        Fracción de respuestas que no son JSON válido
+    --unrecognized-rate     Fracción de campos devueltos como NO_RECONOCIDO
+
+GET /stats devuelve los contadores (peticiones, errores, 429, máximo de
+peticiones simultáneas...) y DELETE /stats los reinicia.
+
+Para usarlo desde la aplicación basta con CLAUDE_STUB_URL:
+
+    python tools/claude_stub.py --port 8765 --latency 2 --error-rate 0.05
+    CLAUDE_STUB_URL=http://127.0.0.1:8765 python start.py
+"""
+
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FIELDS_PATTERN = re.compile(r'campos[^:\n]*:\n\n(.+)\n')
+BLOCK_TYPES = ('text', 'image', 'document')
+IMAGE_TOKENS = 1600  # Estimación aproximada por imagen
+DOCUMENT_TOKENS = 3000  # Estimación aproximada por documento PDF
+
+NAMES = ('JUAN', 'MARIA', 'CARMEN', 'JOSE', 'ANA', 'PABLO', 'LUCIA', 'JAVIER', 'ELENA', 'DAVID')
+SURNAMES = ('GARCIA', 'MARTINEZ', 'LOPEZ', 'SANCHEZ', 'PEREZ', 'GOMEZ', 'RUIZ', 'DIAZ', 'MORENO', 'ALONSO')
+DNI_LETTERS = "TRWAGMYFPDXBNJZSQVHLCKE"
+
+class ApiError(Exception):
+    """Error con el formato de la API: código HTTP, tipo y mensaje"""
+
+    def __init__(self, status: int, error_type: str, message: str, headers: dict = None):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+        self.headers = headers or {}
+
+def fake_value(field_name: str, seed: bytes) -> str:
+    """Valor determinista y con formato plausible para un campo"""
+    digest = hashlib.sha256(field_name.encode('utf-8') + seed).digest()
+    number = int.from_bytes(digest[:8], 'big')
+    name = field_name.upper()
+    if 'DNI' in name:
+        dni = number % 100000000
+        return f"{dni:08d}{DNI_LETTERS[dni % 23]}"
+    if 'FECHA' in name:
+        return f"{number % 28 + 1:02d}/{number // 28 % 12 + 1:02d}/{1990 + number // 336 % 30}"
+    if 'APELLIDO' in name:
+        return SURNAMES[number % len(SURNAMES)]
+    if 'NOMBRE' in name:
+        return NAMES[number % len(NAMES)]
+    return f"TEXTO{number % 1000}"
+
+class StubState:
+    """Configuración, contadores y limitador compartidos por los hilos del servidor"""
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.recent = deque()  # Instantes de las peticiones admitidas del último minuto
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {
+                'requests': 0, 'ok': 0, 'errors': 0, 'rate_limited': 0, 'malformed': 0,
+                'invalid': 0, 'fields': 0, 'in_flight': 0, 'peak_in_flight': 0
+            }
+
+    def count(self, key: str, amount: int = 1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def chance(self, rate: float) -> bool:
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def admit(self):
+        """
+        Aplicar los límites de uso y los errores simulados
+
+        Raises:
+            ApiError: 429 (rate_limit_error) o 529 (overloaded_error)
+        """
+        args = self.args
+        if args.rpm:
+            with self.lock:
+                now = time.monotonic()
+                while self.recent and now - self.recent[0] >= 60:
+                    self.recent.popleft()
+                if len(self.recent) >= args.rpm:
+                    wait = max(1, int(60 - (now - self.recent[0])) + 1)
+                    raise ApiError(429, 'rate_limit_error', f"Límite de {args.rpm} peticiones por minuto superado",
+                                   {'retry-after': str(wait)})
+                self.recent.append(now)
+        if self.chance(args.rate_limit_rate):
+            raise ApiError(429, 'rate_limit_error', "Límite de uso simulado",
+                           {'retry-after': str(args.retry_after)})
+        if self.chance(args.error_rate):
+            raise ApiError(529, 'overloaded_error', "Sobrecarga simulada")
+
+    def latency(self) -> float:
+        args = self.args
+        with self.lock:
+            return max(0.0, args.latency * (1 + self.random.uniform(-args.jitter, args.jitter)))
+
+def parse_request(body: dict):
+    """
+    Validar una petición de messages.create y extraer prompt, contenido y tokens estimados
+
+    Raises:
+        ApiError: 400 invalid_request_error si la petición no es válida
+    """
+    for key in ('model', 'max_tokens', 'messages'):
+        if key not in body:
+            raise ApiError(400, 'invalid_request_error', f"{key}: Field required")
+    if not body['messages']:
+        raise ApiError(400, 'invalid_request_error', "messages: at least one message is required")
+
+    content = body['messages'][-1].get('content')
+    if isinstance(content, str):
+        content = [{'type': 'text', 'text': content}]
+
+    prompt = []
+    digest = hashlib.sha256()
+    tokens = 0
+    for block in content or []:
+        block_type = block.get('type')
+        if block_type not in BLOCK_TYPES:
+            raise ApiError(400, 'invalid_request_error', f"Unsupported content block type: {block_type}")
+        if block_type == 'text':
+            prompt.append(block.get('text', ''))
+            tokens += len(block.get('text', '')) // 4
+            continue
+        source = block.get('source') or {}
+        if source.get('type') != 'base64' or not source.get('data'):
+            raise ApiError(400, 'invalid_request_error', f"{block_type}.source: base64 data required")
+        digest.update(source['data'].encode('ascii'))
+        tokens += IMAGE_TOKENS if block_type == 'image' else DOCUMENT_TOKENS
+
+    return "\n".join(prompt), digest.digest(), max(tokens, 1)
+
+def build_reply(state: StubState, prompt: str, seed: bytes) -> str:
+    """Texto de la respuesta: JSON de campos, texto plano o una respuesta mal formada"""
+    match = FIELDS_PATTERN.search(prompt)
+    if not match:
+        return fake_value('TEXTO', seed)
+    if state.chance(state.args.malformed_rate):
+        state.count('malformed')
+        return "Lo siento, no puedo leer los campos de esta imagen {"
+
+    fields = [field.strip() for field in match.group(1).split(',') if field.strip()]
+    state.count('fields', len(fields))
+    campos = []
+    for field in fields:
+        value = "NO_RECONOCIDO" if state.chance(state.args.unrecognized_rate) else fake_value(field, seed)
+        campos.append({'nombre': field, 'valor': value})
+    return json.dumps({'campos': campos}, ensure_ascii=False, indent=2)
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Conexiones keep-alive, como la API real
+
+        def log_message(self, format, *args):
+            if state.args.verbose:
+                super().log_message(format, *args)
+
+        def _send(self, status: int, payload: dict, headers: dict = None):
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('content-type', 'application/json')
+            self.send_header('content-length', str(len(data)))
+            self.send_header('request-id', f"req_stub_{uuid.uuid4().hex[:24]}")
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_error(self, error: ApiError):
+            self._send(error.status, {'type': 'error', 'error': {'type': error.error_type, 'message': str(error)}},
+                       error.headers)
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/stats':
+                with state.lock:
+                    self._send(200, dict(state.stats))
+            else:
+                self._send_error(ApiError(404, 'not_found_error', f"Not found: {self.path}"))
+
+        def do_DELETE(self):
+            if self.path.rstrip('/') == '/stats':
+                state.reset()
+                self._send(200, {'reset': True})
+            else:
+                self._send_error(ApiError(404, 'not_found_error', f"Not found: {self.path}"))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('content-length', 0)))
+            if self.path.split('?')[0].rstrip('/') != '/v1/messages':
+                self._send_error(ApiError(404, 'not_found_error', f"Not found: {self.path}"))
+                return
+
+            state.count('requests')
+            with state.lock:
+                state.stats['in_flight'] += 1
+                state.stats['peak_in_flight'] = max(state.stats['peak_in_flight'], state.stats['in_flight'])
+            try:
+                try:
+                    request = json.loads(body)
+                    prompt, seed, input_tokens = parse_request(request)
+                except ValueError as e:
+                    state.count('invalid')
+                    raise ApiError(400, 'invalid_request_error', f"Invalid JSON body: {e}")
+                except ApiError:
+                    state.count('invalid')
+                    raise
+
+                state.admit()
+                time.sleep(state.latency())
+                text = build_reply(state, prompt, seed)
+                state.count('ok')
+                self._send(200, {
+                    'id': f"msg_stub_{uuid.uuid4().hex[:24]}",
+                    'type': 'message',
+                    'role': 'assistant',
+                    'model': request['model'],
+                    'content': [{'type': 'text', 'text': text}],
+                    'stop_reason': 'end_turn',
+                    'stop_sequence': None,
+                    'usage': {'input_tokens': input_tokens, 'output_tokens': max(1, len(text) // 4)}
+                })
+            except ApiError as e:
+                if e.status == 429:
+                    state.count('rate_limited')
+                elif e.status >= 500:
+                    state.count('errors')
+                self._send_error(e)
+            finally:
+                with state.lock:
+                    state.stats['in_flight'] -= 1
+
+    return Handler
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor local que imita la Messages API de Anthropic")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=1.0, help="Segundos de espera por petición")
+    parser.add_argument('--jitter', type=float, default=0.2, help="Variación de la latencia (fracción, ±)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fracción de respuestas 529")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Fracción de respuestas 429 aleatorias")
+    parser.add_argument('--rpm', type=int, default=0, help="Peticiones por minuto admitidas (0 = sin límite)")
+    parser.add_argument('--retry-after', type=int, default=1, help="Cabecera retry-after de los 429 aleatorios")
+    parser.add_argument('--malformed-rate', type=float, default=0.0, help="Fracción de respuestas sin JSON válido")
+    parser.add_argument('--unrecognized-rate', type=float, default=0.0, help="Fracción de campos NO_RECONOCIDO")
+    parser.add_argument('--seed', type=int, default=None, help="Semilla de los errores y la latencia simulados")
+    parser.add_argument('--verbose', action='store_true', help="Registrar cada petición")
+    return parser.parse_args(argv)
+
+def create_server(args) -> ThreadingHTTPServer:
+    """Crear el servidor (sin arrancarlo); con --port 0 se elige un puerto libre"""
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(StubState(args)))
+    server.daemon_threads = True
+    return server
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = create_server(args)
+    host, port = server.server_address[:2]
+    print(f"Servidor de pruebas de Claude en http://{host}:{port} "
+          f"(CLAUDE_STUB_URL=http://{host}:{port})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()